@@ -0,0 +1,81 @@
+# @Author: Sacha Haidinger <sachahai>
+# @Date:   2026-10-18T10:00:00+10:00
+# @Email:  sacha.haidinger@epfl.ch
+# @Project: Learning methods for Cell Profiling
+# @Last modified by:   sachahai
+# @Last modified time: 2026-10-18T10:00:00+10:00
+
+'''
+Data-parallel training of a VAE / InfoMAX VAE on several CPU processes (torch.distributed, gloo)
+c.f util/distributed.py. Launch with torchrun, e.g on one machine with 8 processes :
+
+    torchrun --nproc_per_node=8 Distributed_training.py --data ../DataSets/Synthetic_Data_1 --infomax
+
+or on 2 machines (run on each machine, with its own --node_rank) :
+
+    torchrun --nnodes=2 --node_rank=0 --nproc_per_node=8 --master_addr=HOST --master_port=29500 Distributed_training.py ...
+
+--batch_size is per process : the global batch size (and number of InfoNCE negatives) is
+batch_size x number of processes. The time of each epoch is printed by the main process.
+'''
+
+import argparse
+import datetime
+from timeit import default_timer as timer
+
+import torch
+import torch.optim as optim
+import torch.distributed as dist
+
+from models.networks import Skip_VAE
+from models.infoMAX_VAE import CNN_VAE, MLP_MI_estimator, Conv_MI_estimator
+from models.train_net import train_VAE_model, train_InfoMAX_model
+from util.data_processing import get_train_val_dataloader
+from util.distributed import init_distributed, is_main_process
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Data-parallel VAE training on CPU processes')
+    parser.add_argument('--data', required=True, help='Folder containing the dataset (one subfolder per class)')
+    parser.add_argument('--infomax', action='store_true', help='Train an InfoMAX VAE (CNN_VAE + MI estimator) instead of a Skip_VAE')
+    parser.add_argument('--conv_critic', action='store_true', help='Use Conv_MI_estimator instead of MLP_MI_estimator')
+    parser.add_argument('--input_size', type=int, default=64)
+    parser.add_argument('--input_channels', type=int, default=3)
+    parser.add_argument('--batch_size', type=int, default=32, help='Per process')
+    parser.add_argument('--epochs', type=int, default=40)
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the train / validation split, same in all processes')
+    parser.add_argument('--threads', type=int, default=1, help='Torch threads per process')
+    parser.add_argument('--name', default=f'Distributed_model_{datetime.date.today()}')
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    rank, world_size = init_distributed(backend='gloo')
+    torch.manual_seed(args.seed) #Weights are also broadcast from rank 0 by the trainers
+
+    train_loader, valid_loader = get_train_val_dataloader(args.data,args.input_size,args.batch_size,test_split=0.15,
+        seed=args.seed,world_size=world_size,rank=rank)
+
+    start = timer()
+    if args.infomax:
+        model = CNN_VAE(zdim=3,input_channels=args.input_channels, alpha=20, beta=1, base_enc=64, base_dec=64)
+        if args.conv_critic:
+            MLP = Conv_MI_estimator(args.input_channels,args.input_size,zdim=3)
+        else:
+            MLP = MLP_MI_estimator(args.input_size*args.input_size*args.input_channels,zdim=3)
+        opti_VAE = optim.Adam(model.parameters(), lr=0.0001, betas=(0.9, 0.999))
+        opti_MLP = optim.Adam(MLP.parameters(), lr=0.0005, betas=(0.9, 0.999))
+        model, MLP, history, best_epoch = train_InfoMAX_model(args.epochs, model, MLP, opti_VAE, opti_MLP, train_loader, valid_loader,
+            saving_path=f'{args.name}.pth', train_on_gpu=False)
+    else:
+        model = Skip_VAE(zdim=3,input_channels=args.input_channels, beta=1, base_enc=32, base_dec=32, depth_factor_dec=2)
+        optimizer = optim.Adam(model.parameters(), lr=0.0001, betas=(0.9, 0.999))
+        model, history, best_epoch = train_VAE_model(args.epochs, model, optimizer, train_loader, valid_loader,
+            saving_path=f'{args.name}.pth', train_on_gpu=False)
+    total_time = timer() - start
+
+    if is_main_process():
+        print(f'{world_size} process(es), global batch size {args.batch_size*world_size} : {total_time/len(history):.2f} seconds per epoch')
+        history.to_csv(f'loss_evo_{args.name}.csv')
+
+    if dist.is_initialized():
+        dist.destroy_process_group()
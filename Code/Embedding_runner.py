@@ -0,0 +1,287 @@
+# @Author: Sacha Haidinger <sachahai>
+# @Date:   2026-10-18T10:00:00+10:00
+# @Email:  sacha.haidinger@epfl.ch
+# @Project: Learning methods for Cell Profiling
+# @Last modified by:   sachahai
+# @Last modified time: 2026-10-18T10:00:00+10:00
+
+'''
+Standalone batch inference with an exported VAE encoder
+(c.f models/inference.py, export_encoder() saves a TorchScript '.pt' or ONNX '.onnx' file)
+
+Only needs torch (or onnxruntime), numpy, pandas and scikit-image; the training code is NOT imported.
+Single cell images (tiff / png, H x W x C) are found recursively in a folder, read and
+preprocessed in a thread pool (same zero padding / rescaling as zPad_or_Rescale_inference),
+streamed by batch through the encoder, and the latent codes are appended to a csv file
+with their Unique_ID (the file name).
+With --incremental, the csv is kept as a store and only new or modified images are encoded.
+
+Usage :
+    python Embedding_runner.py --model encoder.pt --data ../DataSets/Synthetic_Data_1 --out latent_codes.csv
+    python Embedding_runner.py --model encoder.pt --data ../DataSets/Synthetic_Data_1 --out latent_codes.csv --incremental
+'''
+
+import os
+import json
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from timeit import default_timer as timer
+
+import numpy as np
+import pandas as pd
+from skimage import io
+from skimage.util import img_as_float
+from skimage.transform import resize
+
+EXTENSIONS = ('.png','.jpg','.tif','.tiff')
+
+
+###############################
+#### Exported Encoder #########
+###############################
+
+class Exported_Encoder(object):
+    '''Load an encoder exported with models.inference.export_encoder()
+    Calling it on a B x C x H x W float32 ndarray returns (mu_z, logvar_z) as B x zdim ndarrays'''
+    def __init__(self, path, num_threads=None):
+        with open(path + '.json') as f:
+            self.meta = json.load(f)
+        self.input_size = self.meta['input_size']
+        self.input_channels = self.meta['input_channels']
+        self.zdim = self.meta['zdim']
+
+        if self.meta['format'] == 'onnx':
+            import onnxruntime
+            options = onnxruntime.SessionOptions()
+            if num_threads is not None:
+                options.intra_op_num_threads = num_threads
+            self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+            self.model = None
+        else:
+            import torch
+            if num_threads is not None:
+                torch.set_num_threads(num_threads)
+            self.model = torch.jit.load(path, map_location='cpu')
+            self.model.eval()
+
+    def __call__(self, batch):
+        if self.model is None:
+            mu_z, logvar_z = self.session.run(['mu_z','logvar_z'], {'x': batch})
+        else:
+            import torch
+            with torch.no_grad():
+                mu_z, logvar_z = self.model(torch.from_numpy(batch))
+            mu_z, logvar_z = mu_z.numpy(), logvar_z.numpy()
+        return mu_z.reshape(-1,self.zdim), logvar_z.reshape(-1,self.zdim)
+
+
+###############################
+#### Image preprocessing ######
+###############################
+
+def read_image(path):
+    '''Load a H x W x C single cell image as float64 0-1'''
+    if path.endswith(('.tif','.tiff')):
+        sample = io.imread(path,plugin='tifffile')
+    else:
+        sample = io.imread(path)
+    return img_as_float(sample)
+
+def zPad_or_Rescale_array(img_arr, input_size):
+    '''Same as zPad_or_Rescale_inference (util/data_processing.py)
+    if any dimension is bigger than input_size -> RESCALE
+    if both dimension are smaller than input_size -> Zero Pad
+    Return a C x input_size x input_size float32 ndarray'''
+    if img_arr.ndim == 2:
+        img_arr = img_arr[:,:,None]
+    h = img_arr.shape[0]
+    w = img_arr.shape[1]
+
+    if ((h > input_size) or (w > input_size)):
+        img_resized = resize(img_arr,(input_size,input_size),preserve_range=False, anti_aliasing=True)
+    else:
+        diff_h = input_size - h
+        diff_w = input_size - w
+        img_resized = np.pad(img_arr,((int(np.round(diff_h/2.)),diff_h-int(np.round(diff_h/2.))),(int(np.round(diff_w/2.)),diff_w-int(np.round(diff_w/2.))),(0,0)))
+
+    return np.ascontiguousarray(img_resized.transpose((2,0,1)), dtype=np.float32)
+
+def load_and_preprocess(path, input_size):
+    return zPad_or_Rescale_array(read_image(path), input_size)
+
+def list_images(dataset_dir):
+    '''All the single cell images of a folder (and its subfolders), sorted'''
+    files = []
+    for root, _, file_names in os.walk(dataset_dir):
+        for file_name in file_names:
+            if file_name.lower().endswith(EXTENSIONS) and not file_name.startswith('.'):
+                files.append(os.path.join(root,file_name))
+    files.sort()
+    return files
+
+def latent_columns(zdim):
+    '''Names of the latent code columns, same as metadata_latent_space (util/helpers.py) if zdim <= 3'''
+    if zdim <= 3:
+        return ['VAE_x_coord','VAE_y_coord','VAE_z_coord'][:zdim]
+    return [f'VAE_dim_{i}' for i in range(zdim)]
+
+
+###############################
+#### Batch Inference ##########
+###############################
+
+def model_checksum(model_path):
+    '''sha256 of the exported encoder file, changes whenever the weights change'''
+    sha = hashlib.sha256()
+    with open(model_path,'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def encode_files(encoder, files, batch_size=256, num_workers=8, with_logvar=False):
+    '''Generator yielding one DataFrame of latent codes per batch of 'files' (column 'Unique_ID' is
+    the file name). Images are read and preprocessed in a pool of 'num_workers' threads, while
+    the previous batch goes through the encoder.'''
+    columns = latent_columns(encoder.zdim)
+    batches = [files[i:i+batch_size] for i in range(0,len(files),batch_size)]
+
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        def submit(batch_files):
+            return [pool.submit(load_and_preprocess, f, encoder.input_size) for f in batch_files]
+
+        pending = submit(batches[0]) if len(batches) > 0 else None
+        for i, batch_files in enumerate(batches):
+            batch = np.stack([future.result() for future in pending],axis=0)
+            #Prefetch next batch while the current one is encoded
+            pending = submit(batches[i+1]) if i+1 < len(batches) else None
+
+            mu_z, logvar_z = encoder(batch)
+            batch_df = pd.DataFrame(mu_z, columns=columns)
+            if with_logvar:
+                for d in range(encoder.zdim):
+                    batch_df[f'logvar_{d}'] = logvar_z[:,d]
+            batch_df.insert(0,'Unique_ID',[os.path.basename(f) for f in batch_files])
+
+            print(f'In progress...{i*batch_size+len(batch_files)}/{len(files)}',end='\r')
+            yield batch_df
+
+
+def run_embedding(model_path, dataset_dir, csv_path, batch_size=256, num_workers=8, num_threads=None, with_logvar=False):
+    '''
+    Produce the latent codes of all the single cell images of 'dataset_dir' with an exported encoder,
+    and write them in a csv file (one row per cell, 'Unique_ID' is the file name).
+
+    Images are read and preprocessed in a pool of 'num_workers' threads, while the previous batch
+    goes through the encoder. Rows are appended to the csv batch by batch, memory use does not grow
+    with the size of the dataset.
+
+    Params :
+        model_path (string) : path to the exported encoder (a json file with the same name + '.json' must exist)
+        dataset_dir (string) : path to the folder containing the single cell images
+        csv_path (string) : where to write the latent codes
+        batch_size (int) : number of images per forward pass
+        num_workers (int) : number of threads used to read and preprocess the images
+        num_threads (int) : number of threads used by the encoder (default of the backend if None)
+        with_logvar (boolean) : If True, logvar_z is also saved
+
+    Return the number of images processed
+    '''
+    encoder = Exported_Encoder(model_path, num_threads=num_threads)
+    files = list_images(dataset_dir)
+
+    start = timer()
+    if os.path.exists(csv_path):
+        os.remove(csv_path)
+
+    for i, batch_df in enumerate(encode_files(encoder, files, batch_size, num_workers, with_logvar)):
+        batch_df.to_csv(csv_path, mode='a', header=(i==0), index=False)
+
+    total_time = timer() - start
+    print(f'{len(files)} images encoded in {total_time:.2f} seconds ({len(files)/max(total_time,1e-9):.1f} images/s)')
+    print(f'Latent codes saved to : {csv_path}')
+    return len(files)
+
+
+###############################
+#### Incremental Embedding ####
+###############################
+
+def update_embedding(model_path, dataset_dir, csv_path, batch_size=256, num_workers=8, num_threads=None, with_logvar=False):
+    '''
+    Incremental version of run_embedding() : the csv file is a store of latent codes keyed by
+    Unique_ID and file modification time (column 'file_mtime', in ns), valid for one model
+    (sha256 checksum of the exported encoder, saved in csv_path + '.json').
+    Only the images that are new, or modified since they were encoded, go through the encoder
+    and are appended to the store. Rows of deleted or modified images are dropped.
+    If the model changed (different checksum) or the store is missing, everything is re-encoded.
+
+    Params : same as run_embedding()
+
+    Return the number of images encoded (0 if the store was already up to date)
+    '''
+    checksum = model_checksum(model_path)
+    meta_path = csv_path + '.json'
+    files = list_images(dataset_dir)
+    mtimes = {os.path.basename(f): os.stat(f).st_mtime_ns for f in files}
+
+    store = None
+    if os.path.exists(csv_path) and os.path.exists(meta_path):
+        with open(meta_path) as f:
+            store_meta = json.load(f)
+        if store_meta.get('model_checksum') == checksum and store_meta.get('with_logvar') == with_logvar:
+            store = pd.read_csv(csv_path)
+        else:
+            print('Model changed since the last embedding, all the images are re-encoded')
+    if store is None:
+        store = pd.DataFrame(columns=['Unique_ID','file_mtime'])
+
+    #Rows still valid : file present and not modified since it was encoded
+    valid = store.Unique_ID.map(mtimes) == store.file_mtime
+    kept = store[valid]
+    kept_ids = set(kept.Unique_ID)
+    to_encode = [f for f in files if os.path.basename(f) not in kept_ids]
+
+    start = timer()
+    if not valid.all() or len(kept) == 0:
+        #Rewrite only the valid rows (no encoding), new rows are then appended
+        if len(kept) > 0:
+            kept.to_csv(csv_path, index=False)
+        elif os.path.exists(csv_path):
+            os.remove(csv_path)
+
+    if len(to_encode) > 0:
+        encoder = Exported_Encoder(model_path, num_threads=num_threads)
+        header = len(kept) == 0
+        columns = None if header else list(kept.columns)
+        for batch_df in encode_files(encoder, to_encode, batch_size, num_workers, with_logvar):
+            batch_df['file_mtime'] = batch_df.Unique_ID.map(mtimes)
+            if columns is None:
+                columns = list(batch_df.columns)
+            batch_df[columns].to_csv(csv_path, mode='a', header=header, index=False)
+            header = False
+
+    with open(meta_path,'w') as f:
+        json.dump({'model_checksum':checksum, 'with_logvar':with_logvar, 'model_path':model_path}, f, indent=2)
+
+    total_time = timer() - start
+    print(f'{len(to_encode)} new or modified images encoded in {total_time:.2f} seconds, {len(files)-len(to_encode)} reused')
+    print(f'Latent codes store up to date : {csv_path}')
+    return len(to_encode)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Batch inference of latent codes with an exported VAE encoder')
+    parser.add_argument('--model', required=True, help="Exported encoder ('.pt' TorchScript or '.onnx')")
+    parser.add_argument('--data', required=True, help='Folder containing the single cell images')
+    parser.add_argument('--out', required=True, help='Path of the csv file to write')
+    parser.add_argument('--batch_size', type=int, default=256)
+    parser.add_argument('--workers', type=int, default=8, help='Threads used to read and preprocess images')
+    parser.add_argument('--threads', type=int, default=None, help='Threads used by the encoder')
+    parser.add_argument('--with_logvar', action='store_true')
+    parser.add_argument('--incremental', action='store_true', help='Only encode new or modified images (c.f update_embedding)')
+    args = parser.parse_args()
+
+    embed = update_embedding if args.incremental else run_embedding
+    embed(args.model, args.data, args.out, batch_size=args.batch_size,
+        num_workers=args.workers, num_threads=args.threads, with_logvar=args.with_logvar)
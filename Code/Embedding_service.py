@@ -0,0 +1,260 @@
+# @Author: Sacha Haidinger <sachahai>
+# @Date:   2026-10-18T10:00:00+10:00
+# @Email:  sacha.haidinger@epfl.ch
+# @Project: Learning methods for Cell Profiling
+# @Last modified by:   sachahai
+# @Last modified time: 2026-10-18T10:00:00+10:00
+
+'''
+Local HTTP service that returns the latent code of single cell images on demand.
+
+Wraps a VAE encoder (exported with models.inference.export_encoder(), or any trained VAE
+in memory with Torch_Encoder), so that newly segmented cells can be embedded continuously,
+without running the whole VAE_framework.py / metadata_latent_space() pipeline on a folder.
+
+- Requests contain ONE raw uint8 crop of any size (H x W x C, C-order bytes); it is preprocessed
+  in the request thread with the same zero padding / rescaling as zPad_or_Rescale_inference
+- Requests are grouped by a micro-batcher : a batch is run as soon as 'max_batch' crops are
+  waiting, or 'max_latency_ms' after the first crop of the batch arrived
+- Latency (p50 / p99) and throughput are exposed
+
+Endpoints :
+    POST /embed?h=H&w=W&c=C   body : H*W*C uint8 bytes   -> {"mu_z": [...], "logvar_z": [...]}
+    GET  /metrics                                          -> latency and throughput statistics
+    GET  /health
+
+Usage :
+    python Embedding_service.py --model encoder.pt --port 8000
+    curl -X POST --data-binary @cell.raw "http://localhost:8000/embed?h=54&w=61&c=3"
+'''
+
+import json
+import time
+import queue
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+
+from Embedding_runner import Exported_Encoder, zPad_or_Rescale_array
+
+
+###############################
+#### Encoders #################
+###############################
+
+class Torch_Encoder(object):
+    '''Use a VAE model (or Inference_Encoder) in memory instead of an exported file
+    Calling it on a B x C x H x W float32 ndarray returns (mu_z, logvar_z) as B x zdim ndarrays'''
+    def __init__(self, model, input_size, input_channels=None, device='cpu'):
+        import torch
+        self.torch = torch
+        self.model = model.to(device).eval()
+        self.device = device
+        self.zdim = model.zdim
+        self.input_size = input_size
+        self.input_channels = input_channels if input_channels is not None else model.input_channels
+
+    def __call__(self, batch):
+        with self.torch.no_grad():
+            mu_z, logvar_z = self.model.encode(self.torch.from_numpy(batch).to(self.device))
+        return mu_z.cpu().numpy().reshape(-1,self.zdim), logvar_z.cpu().numpy().reshape(-1,self.zdim)
+
+
+###############################
+#### Micro-batching ###########
+###############################
+
+class Latency_Metrics(object):
+    '''Thread-safe record of the latency of the last 'history' requests'''
+    def __init__(self, history=10000, window=60.):
+        self.lock = threading.Lock()
+        self.records = deque(maxlen=history) #(time of completion, latency in s)
+        self.batch_sizes = deque(maxlen=history)
+        self.window = window
+        self.total = 0
+        self.start = time.time()
+
+    def add_batch(self, latencies):
+        now = time.time()
+        with self.lock:
+            for latency in latencies:
+                self.records.append((now, latency))
+            self.batch_sizes.append(len(latencies))
+            self.total += len(latencies)
+
+    def summary(self):
+        with self.lock:
+            records = list(self.records)
+            batch_sizes = list(self.batch_sizes)
+            total = self.total
+        now = time.time()
+        latencies = np.array([r[1] for r in records]) * 1000.
+        recent = sum(1 for r in records if now - r[0] <= self.window)
+        window = min(self.window, now - self.start)
+        return {
+            'requests_total' : total,
+            'p50_ms' : float(np.percentile(latencies,50)) if len(latencies) else None,
+            'p99_ms' : float(np.percentile(latencies,99)) if len(latencies) else None,
+            'mean_ms' : float(np.mean(latencies)) if len(latencies) else None,
+            'throughput_per_s' : recent / window if window > 0 else 0.,
+            'mean_batch_size' : float(np.mean(batch_sizes)) if len(batch_sizes) else None,
+            'uptime_s' : now - self.start
+        }
+
+
+class Micro_Batcher(object):
+    '''Group single crops coming from concurrent requests in batches for the encoder.
+    A batch is run when 'max_batch' crops are waiting, or 'max_latency_ms' after the
+    arrival of its first crop, whichever comes first.'''
+    def __init__(self, encoder, max_batch=64, max_latency_ms=5.):
+        self.encoder = encoder
+        self.max_batch = max_batch
+        self.max_latency = max_latency_ms / 1000.
+        self.queue = queue.Queue()
+        self.metrics = Latency_Metrics()
+        self.running = True
+        self.worker = threading.Thread(target=self._loop, daemon=True)
+        self.worker.start()
+
+    def submit(self, sample, arrival=None):
+        '''sample : preprocessed C x input_size x input_size float32 ndarray. Return a Future'''
+        future = Future()
+        self.queue.put((sample, future, arrival if arrival is not None else time.perf_counter()))
+        return future
+
+    def _loop(self):
+        while self.running:
+            try:
+                first = self.queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            batch = [first]
+            deadline = time.perf_counter() + self.max_latency
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._run(batch)
+
+    def _run(self, batch):
+        try:
+            mu_z, logvar_z = self.encoder(np.stack([item[0] for item in batch],axis=0))
+        except Exception as e:
+            for _, future, _ in batch:
+                future.set_exception(e)
+            return
+        done = time.perf_counter()
+        for i, (_, future, _) in enumerate(batch):
+            future.set_result((mu_z[i], logvar_z[i]))
+        self.metrics.add_batch([done - item[2] for item in batch])
+
+    def close(self):
+        self.running = False
+        self.worker.join()
+
+
+###############################
+#### HTTP Service #############
+###############################
+
+def make_handler(batcher, input_size, input_channels):
+    class Embedding_Handler(BaseHTTPRequestHandler):
+
+        def _send_json(self, obj, status=200):
+            body = json.dumps(obj).encode()
+            self.send_response(status)
+            self.send_header('Content-Type','application/json')
+            self.send_header('Content-Length',str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            path = urlparse(self.path).path
+            if path == '/metrics':
+                self._send_json(batcher.metrics.summary())
+            elif path == '/health':
+                self._send_json({'status':'ok'})
+            else:
+                self._send_json({'error':'unknown endpoint'},404)
+
+        def do_POST(self):
+            arrival = time.perf_counter()
+            url = urlparse(self.path)
+            if url.path != '/embed':
+                self._send_json({'error':'unknown endpoint'},404)
+                return
+            try:
+                params = parse_qs(url.query)
+                h, w = int(params['h'][0]), int(params['w'][0])
+                c = int(params.get('c',[1])[0])
+                raw = self.rfile.read(int(self.headers['Content-Length']))
+                if h <= 0 or w <= 0:
+                    raise ValueError(f'h and w must be positive, got {h} x {w}')
+                if c != input_channels:
+                    raise ValueError(f'the encoder expects {input_channels} channels, got {c}')
+                crop = np.frombuffer(raw, dtype=np.uint8).reshape(h,w,c)
+            except (KeyError, ValueError, TypeError) as e:
+                #Rejected before the micro-batch, a bad crop would fail the requests batched with it
+                self._send_json({'error':f'expected H*W*C uint8 bytes and h, w, c query parameters ({e})'},400)
+                return
+
+            #uint8 0-255 -> float64 0-1, as img_as_float in the DataLoaders
+            sample = zPad_or_Rescale_array(crop / 255., input_size)
+            try:
+                mu_z, logvar_z = batcher.submit(sample, arrival).result()
+            except Exception as e:
+                self._send_json({'error':f'encoder failed ({e})'},500)
+                return
+            self._send_json({'mu_z':mu_z.tolist(),'logvar_z':logvar_z.tolist()})
+
+        def log_message(self, format, *args):
+            return #Do not print every request
+
+    return Embedding_Handler
+
+
+def serve(encoder, host='127.0.0.1', port=8000, max_batch=64, max_latency_ms=5.):
+    '''
+    Start the embedding service (blocking) around an encoder
+    (Exported_Encoder loaded from an exported file, or Torch_Encoder around a model in memory)
+
+    Params :
+        encoder : callable, B x C x input_size x input_size float32 ndarray -> (mu_z, logvar_z)
+            It needs 'input_size' and 'input_channels' attributes
+        host, port : address of the service (local only by default)
+        max_batch (int) : maximum number of crops per forward pass
+        max_latency_ms (float) : maximum time a crop waits for other crops before its batch is run
+    '''
+    batcher = Micro_Batcher(encoder, max_batch=max_batch, max_latency_ms=max_latency_ms)
+    server = ThreadingHTTPServer((host,port), make_handler(batcher, encoder.input_size, encoder.input_channels))
+    print(f'Embedding service listening on http://{host}:{port} (max batch {max_batch}, max latency {max_latency_ms} ms)')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local service returning latent codes of single cell crops')
+    parser.add_argument('--model', required=True, help="Exported encoder ('.pt' TorchScript or '.onnx')")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max_batch', type=int, default=64)
+    parser.add_argument('--max_latency_ms', type=float, default=5.)
+    parser.add_argument('--threads', type=int, default=None, help='Threads used by the encoder')
+    args = parser.parse_args()
+
+    serve(Exported_Encoder(args.model, num_threads=args.threads), host=args.host, port=args.port,
+        max_batch=args.max_batch, max_latency_ms=args.max_latency_ms)
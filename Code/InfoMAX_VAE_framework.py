@@ -28,9 +28,10 @@ import plotly.offline
 from torchsummary import summary
 from torch import cuda, optim
 
-from models.infoMAX_VAE import CNN_VAE, CNN_128_VAE, MLP_MI_estimator, MLP_MI_128_estimator
+from models.infoMAX_VAE import CNN_VAE, CNN_128_VAE, MLP_MI_estimator, MLP_MI_128_estimator, Conv_MI_estimator
 from util.data_processing import get_train_val_dataloader, imshow_tensor, get_inference_dataset
 from models.train_net import train_InfoMAX_model
+from optimization.autotune import autotune
 from util.helpers import plot_train_result, save_checkpoint, load_checkpoint, save_brute, load_brute, metadata_latent_space, save_reconstruction, plot_from_csv
 
 
@@ -57,6 +58,10 @@ print(f'Train on gpu: {train_on_gpu}')
 input_size = 64
 # Change to fit hardware
 batch_size = 128
+# Effective batch size is batch_size x accumulation_steps (gradient accumulation, same memory)
+accumulation_steps = 1
+# BatchNorm with accumulation : 'batch', 'momentum' or 'frozen' (c.f set_batchnorm_mode in models/train_net.py)
+bn_mode = 'batch'
 # Number of channel of the raw dataset (4 for Chaffer Dataset, 3 otherwise)
 input_channel = 3
 
@@ -80,6 +85,12 @@ MLP = MLP_MI_estimator(input_size*input_size*input_channel,zdim=3)
 #VAE = CNN_128_VAE(zdim=3,input_channels=input_channel, alpha=20, beta=1, base_enc=64, base_dec=64)
 #MLP = MLP_MI_128_estimator(input_size*input_size*input_channel,zdim=3)
 
+#### Lighter MI estimator (strided conv stem instead of MLP on pixels), any input size multiple of 16 ####
+#MLP = Conv_MI_estimator(input_channel,input_size,zdim=3)
+
+#Batch size and learning rates recommended for this dataset and hardware (probe + LR range test)
+#config, batch_table, lr_curve = autotune(VAE, train_loader, MLP=MLP, memory_budget_mb=4000, train_on_gpu=train_on_gpu)
+
 opti_VAE = optim.Adam(VAE.parameters(), lr=0.0001, betas=(0.9, 0.999))
 opti_MLP = optim.Adam(MLP.parameters(), lr=0.0005, betas=(0.9, 0.999))
 
@@ -96,7 +107,11 @@ epochs = 50
 model_name = f'Name_of_model_{datetime.date.today()}'
 save_model_path = f'{model_name}.pth'
 
-VAE, MLP, history, best_epoch = train_InfoMAX_model(epochs, VAE, MLP, opti_VAE, opti_MLP, train_loader, valid_loader,saving_path=save_model_path, train_on_gpu=train_on_gpu)
+#Number of InfoNCE negatives is batch_size - 1 + queue_size (MLP_g embeddings of past batches)
+queue_size = 0
+
+VAE, MLP, history, best_epoch = train_InfoMAX_model(epochs, VAE, MLP, opti_VAE, opti_MLP, train_loader, valid_loader,saving_path=save_model_path, train_on_gpu=train_on_gpu,
+    accumulation_steps=accumulation_steps, queue_size=queue_size, bn_mode=bn_mode)
 fig = plot_train_result(history, best_epoch,save_path=None, infoMAX = True)
 fig.show()
 plt.show()
@@ -114,6 +129,7 @@ history.to_csv(history_save)
 infer_data, infer_dataloader = get_inference_dataset(dataset_path,batch_size,input_size,droplast=False)
 
 #Possibility of reloading a model trained in the past, or use the variable defined above
+#model_VAE, _ = load_checkpoint(f'{model_name}_VAE_.pth') #Best model saved by the early stopping
 #model_VAE = load_brute('path_to_model.pth')
 #model_name='Model_name_string'
 
@@ -129,7 +145,13 @@ figplotly = plot_from_csv(metadata_csv,dim=3,num_class=7)
 #figplotly = plot_from_csv(metadata_csv,dim=3,column='Sub_population',as_str=True)
 html_save = f'{model_name}_Representation.html'
 plotly.offline.plot(figplotly, filename=html_save, auto_open=True)
+#For large datasets, browse the latent space in a local viewer instead (c.f Latent_viewer.py)
+#from Latent_viewer import serve; serve(metadata_csv, dataset_path)
 
 #save image of reconstruction and generated samples
 image_save = f'{model_name}.png'
 save_reconstruction(infer_dataloader,VAE,image_save,train_on_gpu)
+#Decoded latent grid (32^3 points) and traversals of each cluster, as mosaics (c.f util/latent_generation.py)
+#from util.latent_generation import generate_latent_grid, generate_cluster_traversals
+#generate_latent_grid(VAE, f'{model_name}_grid/', points_per_dim=32)
+#generate_cluster_traversals(VAE, f'{model_name}_traversals/', metadata_csv, label_column='GT_label')
@@ -0,0 +1,331 @@
+# @Author: Sacha Haidinger <sachahai>
+# @Date:   2026-10-18T10:00:00+10:00
+# @Email:  sacha.haidinger@epfl.ch
+# @Project: Learning methods for Cell Profiling
+# @Last modified by:   sachahai
+# @Last modified time: 2026-10-18T10:00:00+10:00
+
+'''
+Local viewer of a latent space, for embeddings too large for a plotly html file.
+
+The latent table (metadata csv of metadata_latent_space()) stays in memory on the server. The points
+are sorted along a Morton (Z-order) curve : the cells of a quadtree (2-D latent codes) or an octree (3-D)
+are then contiguous slices of the table, found with a binary search (for 3-D codes, a second ordering
+on the first 2 dimensions only makes the columns of tiles contiguous too). The browser asks for the tiles
+of the region it displays at a given level of detail, and each tile returns at most 'tile_budget'
+points (a random but fixed subset, the same points stay visible when zooming in). Single cell
+thumbnails are read from the dataset only when hovered.
+
+Endpoints :
+    GET /                                  -> minimal canvas client (pan / zoom, hover thumbnails)
+    GET /meta                              -> number of points, dimension, bounds, max level, classes
+    GET /tiles/{level}/{x}/{y}[/{z}]       -> points of a tile : {"x":[...],"y":[...],("z":[...]),"label":[...],"id":[...],"count":N}
+                                              (for 3-D codes without z, all the tiles of the column)
+    GET /thumbnail/{Unique_ID}             -> PNG thumbnail of the cell
+
+Usage :
+    python Latent_viewer.py --csv VAE_metedata.csv --dataset DataSets/Peter_Horvath_Subsample/ --port 8050
+'''
+
+import os
+import io
+import json
+import argparse
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, unquote
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+from skimage import io as skio
+from skimage.util import img_as_ubyte
+
+from util.packed_store import Packed_Dataset, is_packed_store
+from util.sprites import Sprite_Atlas
+
+
+###############################
+#### Level of detail tree #####
+###############################
+
+def morton_codes(cells, bits):
+    '''Interleave the bits of the integer cell coordinates (N x dim) -> Z-order code of each point'''
+    cells = cells.astype(np.uint64)
+    codes = np.zeros(len(cells), dtype=np.uint64)
+    dim = cells.shape[1]
+    for bit in range(bits):
+        for d in range(dim):
+            codes |= ((cells[:,d] >> np.uint64(bit)) & np.uint64(1)) << np.uint64(bit*dim + (dim-1-d))
+    return codes
+
+
+class LOD_Tree(object):
+    '''
+    Implicit quadtree (dim 2) / octree (dim 3) over latent codes. The tile (level, index) is the cell
+    'index' of the regular 2^level grid over the bounding box of the codes. For an octree, the points are
+    also sorted by the Morton code of their first 2 coordinates only, to query the columns of tiles
+    along the 3rd dimension (2-D view of 3-D codes) as one slice.
+
+    Params :
+        codes (array N x dim) : latent codes
+        max_level (int) : depth of the tree (finest tiles are 2^-max_level of the bounding box)
+        tile_budget (int) : maximal number of points returned per tile
+        seed (int) : random priority of the points (which points are shown first)
+    '''
+    def __init__(self, codes, max_level=None, tile_budget=2000, seed=0):
+        codes = np.asarray(codes, dtype=np.float64)
+        self.dim = codes.shape[1]
+        assert self.dim in (2,3), 'Latent codes must be 2-D (quadtree) or 3-D (octree)'
+        self.max_level = max_level if max_level is not None else (16 if self.dim == 2 else 10)
+        self.tile_budget = tile_budget
+        self.low = np.nanmin(codes, axis=0)
+        self.high = np.nanmax(codes, axis=0)
+        self.extent = np.where(self.high > self.low, self.high - self.low, 1.)
+
+        n_cells = 2**self.max_level
+        cells = np.clip(((codes - self.low) / self.extent * n_cells).astype(np.int64), 0, n_cells-1)
+        z_codes = morton_codes(cells, self.max_level)
+        self.order = np.argsort(z_codes, kind='stable') #row of the table of each sorted point
+        self.z_codes = z_codes[self.order]
+        priority = np.random.default_rng(seed).permutation(len(codes))
+        self.priority = priority[self.order]
+        if self.dim == 3:
+            xy_codes = morton_codes(cells[:,:2], self.max_level)
+            self.xy_order = np.argsort(xy_codes, kind='stable')
+            self.xy_codes = xy_codes[self.xy_order]
+            self.xy_priority = priority[self.xy_order]
+
+    def tile_range(self, level, index):
+        '''Slice [start, stop) of the sorted points in the tile (level, index). For an octree, an index of
+        length 2 is a column of tiles : slice of the points sorted by xy Morton code (xy_order)'''
+        index = np.asarray(index, dtype=np.uint64)
+        z_codes = self.xy_codes if len(index) < self.dim else self.z_codes
+        shift = np.uint64(len(index) * (self.max_level - level))
+        first = morton_codes(index[None,:], level)[0] << shift
+        last = first + (np.uint64(1) << shift)
+        return np.searchsorted(z_codes, first, 'left'), np.searchsorted(z_codes, last, 'left')
+
+    def query(self, level, index):
+        '''Rows of the table of the points shown in a tile (at most tile_budget, the ones of lowest priority),
+        and the total number of points in the tile. For a 3-D tree, 'index' of length 2 is the whole
+        column of tiles along the 3rd dimension'''
+        assert 0 <= level <= self.max_level, f'level must be in [0, {self.max_level}]'
+        order, priority = (self.xy_order, self.xy_priority) if len(index) < self.dim else (self.order, self.priority)
+        start, stop = self.tile_range(level, index)
+        positions = np.arange(start, stop)
+        count = len(positions)
+        if count > self.tile_budget:
+            keep = np.argpartition(priority[positions], self.tile_budget)[:self.tile_budget]
+            positions = positions[keep]
+        return order[positions], count
+
+
+###############################
+#### Thumbnails ###############
+###############################
+
+class Thumbnail_Store(object):
+    '''
+    Read single cell images by Unique_ID when requested, and keep the last 'cache_size' PNG thumbnails.
+    The dataset is a tiff dataset (one subfolder per class, the file names are the Unique_IDs) or a
+    packed store (c.f util/packed_store.py). Only the file names are listed at start, no image is read.
+    With the sprite sheets of the dataset (c.f util/sprites.py), thumbnails are cut from the sheets instead.
+    '''
+    def __init__(self, dataset_dir, size=96, cache_size=4096, sprites_dir=None):
+        self.size = size
+        self.atlas = Sprite_Atlas(sprites_dir) if sprites_dir is not None else None
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        if dataset_dir is None:
+            self.packed = None
+            self.rows = {}
+        elif is_packed_store(dataset_dir):
+            self.packed = Packed_Dataset(dataset_dir)
+            self.rows = {uid: i for i, uid in enumerate(self.packed.unique_ids)}
+        else:
+            self.packed = None
+            self.rows = {}
+            for class_subfolder in os.listdir(dataset_dir):
+                folder = os.path.join(dataset_dir, class_subfolder)
+                if os.path.isdir(folder):
+                    for file_name in os.listdir(folder):
+                        self.rows[file_name] = os.path.join(folder, file_name)
+
+    def _read(self, unique_id):
+        if self.atlas is not None and unique_id in self.atlas:
+            return self.atlas.get(unique_id)
+        if self.packed is not None:
+            return self.packed.read(self.rows[unique_id])
+        return skio.imread(self.rows[unique_id], plugin='tifffile')
+
+    def render(self, img):
+        '''H x W x C image -> RGB uint8 PNG of at most size x size (first 3 channels, gray if only one)'''
+        if img.ndim == 2:
+            img = img[:,:,None]
+        img = img_as_ubyte(img[:,:,:3]) if img.dtype != np.uint8 else img[:,:,:3]
+        if img.shape[2] == 1:
+            img = np.repeat(img, 3, axis=2)
+        elif img.shape[2] == 2:
+            img = np.concatenate([img, np.zeros_like(img[:,:,:1])], axis=2)
+        thumbnail = Image.fromarray(np.ascontiguousarray(img))
+        thumbnail.thumbnail((self.size, self.size))
+        buffer = io.BytesIO()
+        thumbnail.save(buffer, format='PNG')
+        return buffer.getvalue()
+
+    def get(self, unique_id):
+        '''PNG bytes of the thumbnail, None if the Unique_ID is not in the dataset'''
+        with self.lock:
+            if unique_id in self.cache:
+                self.cache.move_to_end(unique_id)
+                return self.cache[unique_id]
+        if unique_id not in self.rows and not (self.atlas is not None and unique_id in self.atlas):
+            return None
+        png = self.render(self._read(unique_id))
+        with self.lock:
+            self.cache[unique_id] = png
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return png
+
+
+###############################
+#### HTTP Service #############
+###############################
+
+CLIENT_PAGE = '''<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Latent space viewer</title>
+<style>body{margin:0;overflow:hidden;font-family:sans-serif}#info{position:absolute;top:8px;left:8px;background:#fffc;padding:4px}
+#thumb{position:absolute;pointer-events:none;border:1px solid #333;display:none}</style></head>
+<body><canvas id="c"></canvas><div id="info"></div><img id="thumb">
+<script>
+const cv=document.getElementById('c'),ctx=cv.getContext('2d'),info=document.getElementById('info'),thumb=document.getElementById('thumb');
+const colors=['#1f77b4','#ff7f0e','#2ca02c','#d62728','#9467bd','#8c564b','#e377c2','#7f7f7f','#bcbd22','#17becf'];
+let meta,view,tiles=new Map(),shown=[];
+function resize(){cv.width=innerWidth;cv.height=innerHeight;draw();}
+function toScreen(x,y){return[(x-view.x0)/(view.x1-view.x0)*cv.width,(1-(y-view.y0)/(view.y1-view.y0))*cv.height];}
+function level(){const f=Math.max((meta.high[0]-meta.low[0])/(view.x1-view.x0),(meta.high[1]-meta.low[1])/(view.y1-view.y0));
+  return Math.max(0,Math.min(meta.max_level,Math.round(Math.log2(f))+2));}
+async function load(){const L=level(),n=2**L,w=(meta.high[0]-meta.low[0])/n,h=(meta.high[1]-meta.low[1])/n;
+  const ix0=Math.max(0,Math.floor((view.x0-meta.low[0])/w)),ix1=Math.min(n-1,Math.floor((view.x1-meta.low[0])/w));
+  const iy0=Math.max(0,Math.floor((view.y0-meta.low[1])/h)),iy1=Math.min(n-1,Math.floor((view.y1-meta.low[1])/h));
+  const keys=[];for(let i=ix0;i<=ix1;i++)for(let j=iy0;j<=iy1;j++)keys.push(`${L}/${i}/${j}`);
+  await Promise.all(keys.filter(k=>!tiles.has(k)).map(k=>fetch('/tiles/'+k).then(r=>r.json()).then(t=>tiles.set(k,t))));
+  shown=keys.map(k=>tiles.get(k)).filter(t=>t);draw();}
+function draw(){if(!meta)return;ctx.clearRect(0,0,cv.width,cv.height);let n=0;
+  for(const t of shown)for(let i=0;i<t.x.length;i++){const[p,q]=toScreen(t.x[i],t.y[i]);
+    ctx.fillStyle=colors[meta.classes.indexOf(t.label[i])%colors.length];ctx.fillRect(p-1.5,q-1.5,3,3);n++;}
+  info.textContent=`${n} of ${meta.n} cells shown, level ${level()}`;}
+cv.onwheel=e=>{e.preventDefault();const s=e.deltaY>0?1.25:0.8,fx=e.offsetX/cv.width,fy=1-e.offsetY/cv.height;
+  const cx=view.x0+fx*(view.x1-view.x0),cy=view.y0+fy*(view.y1-view.y0);
+  view={x0:cx-(cx-view.x0)*s,x1:cx+(view.x1-cx)*s,y0:cy-(cy-view.y0)*s,y1:cy+(view.y1-cy)*s};load();};
+let drag=null;cv.onmousedown=e=>drag=[e.clientX,e.clientY];onmouseup=()=>drag=null;
+cv.onmousemove=e=>{if(drag){const dx=(e.clientX-drag[0])/cv.width*(view.x1-view.x0),dy=(e.clientY-drag[1])/cv.height*(view.y1-view.y0);
+  view={x0:view.x0-dx,x1:view.x1-dx,y0:view.y0+dy,y1:view.y1+dy};drag=[e.clientX,e.clientY];draw();load();return;}
+  let best=null,bd=36;for(const t of shown)for(let i=0;i<t.x.length;i++){const[p,q]=toScreen(t.x[i],t.y[i]),d=(p-e.offsetX)**2+(q-e.offsetY)**2;if(d<bd){bd=d;best=t.id[i];}}
+  if(best){thumb.src='/thumbnail/'+encodeURIComponent(best);thumb.style.left=(e.clientX+12)+'px';thumb.style.top=(e.clientY+12)+'px';thumb.style.display='block';thumb.title=best;}
+  else thumb.style.display='none';};
+fetch('/meta').then(r=>r.json()).then(m=>{meta=m;view={x0:m.low[0],x1:m.high[0],y0:m.low[1],y1:m.high[1]};resize();load();});
+onresize=resize;
+</script></body></html>'''
+
+
+def make_handler(table, tree, thumbnails, coords, label_column):
+    codes = table[coords].to_numpy(dtype=np.float32)
+    labels = table[label_column].astype(object).where(table[label_column].notna(), None).tolist() if label_column in table else [None]*len(table)
+    unique_ids = table['Unique_ID'].astype(str).tolist()
+    classes = sorted(set(labels), key=str)
+    meta = {'n':len(table), 'dim':tree.dim, 'coords':coords, 'low':tree.low.tolist(), 'high':tree.high.tolist(),
+        'max_level':tree.max_level, 'tile_budget':tree.tile_budget, 'classes':classes}
+
+    class Viewer_Handler(BaseHTTPRequestHandler):
+
+        def _send(self, body, content_type, status=200):
+            self.send_response(status)
+            self.send_header('Content-Type',content_type)
+            self.send_header('Content-Length',str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_json(self, obj, status=200):
+            self._send(json.dumps(obj).encode(), 'application/json', status)
+
+        def do_GET(self):
+            parts = [unquote(p) for p in urlparse(self.path).path.strip('/').split('/')]
+            if parts == ['']:
+                self._send(CLIENT_PAGE.encode(), 'text/html')
+            elif parts == ['meta']:
+                self._send_json(meta)
+            elif parts[0] == 'tiles':
+                try:
+                    level, index = int(parts[1]), [int(p) for p in parts[2:]]
+                    assert len(index) in (tree.dim-1, tree.dim) and len(index) >= 2
+                    rows, count = tree.query(level, index)
+                except (IndexError, ValueError, AssertionError) as e:
+                    self._send_json({'error':f'expected /tiles/level/x/y[/z] ({e})'},400)
+                    return
+                tile = {name: codes[rows,d].tolist() for d, name in enumerate(['x','y','z'][:tree.dim])}
+                tile.update({'label':[labels[r] for r in rows], 'id':[unique_ids[r] for r in rows], 'count':int(count)})
+                self._send_json(tile)
+            elif parts[0] == 'thumbnail' and len(parts) == 2 and thumbnails is not None:
+                png = thumbnails.get(parts[1])
+                if png is None:
+                    self._send_json({'error':'unknown Unique_ID'},404)
+                else:
+                    self._send(png, 'image/png')
+            else:
+                self._send_json({'error':'unknown endpoint'},404)
+
+        def log_message(self, format, *args):
+            return #Do not print every request
+
+    return Viewer_Handler
+
+
+def serve(metadata_csv, dataset_dir=None, coords=['VAE_x_coord','VAE_y_coord','VAE_z_coord'], label_column='GT_label',
+        host='127.0.0.1', port=8050, tile_budget=2000, thumbnail_size=96, sprites_dir=None):
+    '''
+    Start the latent space viewer (blocking)
+
+    Params :
+        metadata_csv (string or pandas DataFrame) : latent codes and metadata, one row per cell, with a 'Unique_ID' column
+        dataset_dir (string) : dataset of the single cell images, for the thumbnails (no thumbnails if None)
+        coords ([string]) : 2 or 3 columns of the latent codes (quadtree / octree)
+        label_column (string) : column used to color the points
+        host, port : address of the viewer (local only by default)
+        tile_budget (int) : maximal number of points sent per tile
+        thumbnail_size (int) : size of the thumbnails (pixels)
+        sprites_dir (string) : sprite sheets of the dataset (c.f util/sprites.py), thumbnails without reading the dataset
+    '''
+    table = pd.read_csv(metadata_csv) if isinstance(metadata_csv, str) else metadata_csv
+    tree = LOD_Tree(table[coords].to_numpy(), tile_budget=tile_budget)
+    thumbnails = None
+    if dataset_dir is not None or sprites_dir is not None:
+        thumbnails = Thumbnail_Store(dataset_dir, size=thumbnail_size, sprites_dir=sprites_dir)
+    server = ThreadingHTTPServer((host,port), make_handler(table, tree, thumbnails, coords, label_column))
+    print(f'Latent space viewer of {len(table)} cells on http://{host}:{port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local viewer of a large latent space')
+    parser.add_argument('--csv', required=True, help='Metadata csv with the latent codes (c.f metadata_latent_space)')
+    parser.add_argument('--dataset', default=None, help='Dataset folder or packed store, for the thumbnails')
+    parser.add_argument('--coords', nargs='+', default=['VAE_x_coord','VAE_y_coord','VAE_z_coord'])
+    parser.add_argument('--sprites', default=None, help='Sprite sheets of the dataset (c.f util/sprites.py), for the thumbnails')
+    parser.add_argument('--label', default='GT_label')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8050)
+    parser.add_argument('--tile_budget', type=int, default=2000)
+    args = parser.parse_args()
+
+    serve(args.csv, args.dataset, coords=args.coords, label_column=args.label, host=args.host, port=args.port,
+        tile_budget=args.tile_budget, sprites_dir=args.sprites)
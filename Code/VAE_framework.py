@@ -32,6 +32,8 @@ from models.networks import VAE, Skip_VAE
 from models.infoMAX_VAE import CNN_128_VAE
 from util.data_processing import get_train_val_dataloader, imshow_tensor, get_inference_dataset
 from models.train_net import train_VAE_model
+from optimization.autotune import autotune
+from models.inference import Inference_Encoder
 from util.helpers import plot_train_result, save_checkpoint, load_checkpoint, save_brute, load_brute, plot_from_csv, metadata_latent_space, save_reconstruction
 
 
@@ -58,6 +60,10 @@ print(f'Train on gpu: {train_on_gpu}')
 input_size = 64
 # Change to fit hardware
 batch_size = 64
+# Effective batch size is batch_size x accumulation_steps (gradient accumulation, same memory)
+accumulation_steps = 1
+# BatchNorm with accumulation : 'batch', 'momentum' or 'frozen' (c.f set_batchnorm_mode in models/train_net.py)
+bn_mode = 'batch'
 
 train_loader, valid_loader = get_train_val_dataloader(dataset_path,input_size,batch_size,test_split=0.15)
 
@@ -77,6 +83,9 @@ if train_on_gpu:
 
 #summary(model,input_size=(3,input_size,input_size),batch_size=32)
 
+#Batch size and learning rate recommended for this dataset and hardware (probe + LR range test)
+#config, batch_table, lr_curve = autotune(model, train_loader, memory_budget_mb=4000, train_on_gpu=train_on_gpu)
+
 optimizer = optim.Adam(model.parameters(), lr=0.0001, betas=(0.9, 0.999))
 
 epochs = 40
@@ -84,7 +93,7 @@ epochs = 40
 model_name = f'Name_of_model_{datetime.date.today()}'
 save_model_path = f'{model_name}.pth'
 
-VAE, history, best_epoch = train_VAE_model(epochs, model, optimizer, train_loader, valid_loader,saving_path=save_model_path, train_on_gpu=train_on_gpu)
+VAE, history, best_epoch = train_VAE_model(epochs, model, optimizer, train_loader, valid_loader,saving_path=save_model_path, train_on_gpu=train_on_gpu, accumulation_steps=accumulation_steps, bn_mode=bn_mode)
 fig = plot_train_result(history, best_epoch,save_path=None, infoMAX = False)
 fig.show()
 plt.show()
@@ -102,7 +111,7 @@ history.to_csv(history_save)
 infer_data, infer_dataloader = get_inference_dataset(dataset_path,batch_size,input_size,droplast=False)
 
 #Possibility of reloading a model trained in the past, or use the variable defined above
-#model_VAE = load_brute(save_model_path)
+#model_VAE, _ = load_checkpoint(f'{model_name}_VAE_.pth') #Best model saved by the early stopping
 #model_VAE = load_brute('path_to_model.pth')
 #model_name='Model_name_string'
 
@@ -112,6 +121,8 @@ save_csv = True
 #Store raw image data in csv (results in heavy file
 store_raw = False
 
+#Faster inference : encoder only, with BatchNorm folded in the weights (same latent codes)
+#metadata_csv = metadata_latent_space(Inference_Encoder(VAE), infer_dataloader, train_on_gpu, GT_csv_path=path_to_GT, save_csv=save_csv, with_rawdata=store_raw,csv_path=csv_save_output)
 metadata_csv = metadata_latent_space(VAE, infer_dataloader, train_on_gpu, GT_csv_path=path_to_GT, save_csv=save_csv, with_rawdata=store_raw,csv_path=csv_save_output)
 figplotly = plot_from_csv(metadata_csv,dim=3,num_class=7)#column='Sub_population',as_str=True)
 #For Chaffer Dataset
@@ -119,7 +130,13 @@ figplotly = plot_from_csv(metadata_csv,dim=3,num_class=7)#column='Sub_population
 
 html_save = f'{model_name}_Representation.html'
 plotly.offline.plot(figplotly, filename=html_save, auto_open=True)
+#For large datasets, browse the latent space in a local viewer instead (c.f Latent_viewer.py)
+#from Latent_viewer import serve; serve(metadata_csv, dataset_path)
 
 #save image of reconstruction and generated samples
 image_save = f'{model_name}.png'
 save_reconstruction(infer_dataloader,VAE,image_save,train_on_gpu)
+#Decoded latent grid (32^3 points) and traversals of each cluster, as mosaics (c.f util/latent_generation.py)
+#from util.latent_generation import generate_latent_grid, generate_cluster_traversals
+#generate_latent_grid(VAE, f'{model_name}_grid/', points_per_dim=32)
+#generate_cluster_traversals(VAE, f'{model_name}_traversals/', metadata_csv, label_column='GT_label')
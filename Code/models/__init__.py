@@ -5,6 +5,8 @@
 # @Last modified by:   sachahai
 # @Last modified time: 2020-08-31T10:19:06+10:00
 
+from models import ensemble
+from models import inference
 from models import infoMAX_VAE
 from models import networks
 from models import nn_modules
@@ -0,0 +1,287 @@
+# @Author: Sacha Haidinger <sachahai>
+# @Date:   2026-10-18T10:00:00+10:00
+# @Email:  sacha.haidinger@epfl.ch
+# @Project: Learning methods for Cell Profiling
+# @Last modified by:   sachahai
+# @Last modified time: 2026-10-18T10:00:00+10:00
+
+'''
+Train K VAEs of the same architecture at once (e.g different seeds and / or beta values),
+as a single vectorized model : the parameters of the K members are stacked along a first
+dimension, and one forward / backward pass runs the K members on the same batch with
+torch.func.functional_call + vmap. Small VAEs (3D latent space) underuse the CPU, the
+K members then train for a cost close to the one of a single model.
+
+Each member keeps its own parameters, BatchNorm statistics, reparameterization noise, loss
+weight (beta of each model) and optimizer state (Adam moments are element-wise, so one
+optimizer on the stacked parameters is K independent optimizers), and can have its own
+learning rate. members() splits the ensemble back into K usual models, each with its own
+optimizer attached, that can be saved (util.helpers.save_checkpoint) or trained further
+with the usual trainers.
+
+    models = [VAE(zdim=3, beta=beta, base_enc=32, base_dec=32) for beta in (1,2,5,10)]
+    ensemble = VAE_Ensemble(models)
+    optimizer = Ensemble_Optimizer(ensemble, optim.Adam, lrs=0.0001, betas=(0.9, 0.999))
+    models, history = train_ensemble(40, ensemble, optimizer, train_loader, valid_loader)
+'''
+
+import copy
+from timeit import default_timer as timer
+
+import numpy as np
+import pandas as pd
+import torch
+from torch import nn
+
+from util.checkpoint import model_config
+
+try:
+    from torch.func import stack_module_state, functional_call, vmap
+except ImportError: #pytorch < 2.0
+    stack_module_state = functional_call = vmap = None
+
+#Constructor arguments that can differ between the members of an ensemble (loss weights)
+MEMBER_ARGS = ('beta', 'alpha')
+
+
+class VAE_Ensemble(object):
+    '''
+    K VAEs (VAE, CNN_VAE or any VAE of the repo with forward(x) -> x_recon, mu_z, logvar_z, z)
+    stacked in a single vectorized model
+
+    Params :
+        models (list of nn.Module) : the members, same class and same architecture. They can differ
+            by their weights (seeds) and their loss weights ('beta')
+    '''
+    def __init__(self, models):
+        assert stack_module_state is not None, 'VAE_Ensemble needs torch.func (pytorch >= 2.0)'
+        configs = [model_config(m) for m in models]
+        for config in configs[1:]:
+            same = {k:v for k,v in config['kwargs'].items() if k not in MEMBER_ARGS}
+            assert config['class'] == configs[0]['class'] and same == {k:v for k,v in configs[0]['kwargs'].items() if k not in MEMBER_ARGS}, \
+                'All the members of an ensemble need the same architecture'
+
+        self.K = len(models)
+        self.configs = configs
+        self.epochs = getattr(models[0], 'epochs', 0)
+        self.params, self.buffers = stack_module_state(models) #{name : K x ...} tensors, params are leaves
+        self.betas = torch.tensor([float(m.beta) for m in models], device=next(models[0].parameters()).device)
+        #Stateless copy of the architecture, only used for its forward
+        self.base = copy.deepcopy(models[0]).to('meta')
+        self._forward = vmap(self._member_forward, in_dims=(0,0,None), randomness='different')
+
+    def _member_forward(self, params, buffers, x):
+        return functional_call(self.base, (params, buffers), (x,))
+
+    def __call__(self, x):
+        '''x : B x C x H x W, the same batch for all the members.
+        Return x_recon (K x B x C x H x W), mu_z, logvar_z, z (K x B x zdim)'''
+        return self._forward(self.params, self.buffers, x)
+
+    def parameters(self):
+        return list(self.params.values())
+
+    def train(self):
+        self.base.train()
+        return self
+
+    def eval(self):
+        self.base.eval()
+        return self
+
+    def kl_divergence(self, mu, logvar):
+        '''KL divergence of each member, as VAE.kl_divergence. Return a K tensor'''
+        return -0.5 * (1 + logvar - mu ** 2 - logvar.exp()).sum(-1).mean(-1)
+
+    def members(self, optimizer=None):
+        '''Split the ensemble in K independent models (copies, on the same device).
+        If the Ensemble_Optimizer is given, each model gets its own optimizer (model.optimizer) with
+        its slice of the optimizer state'''
+        models = []
+        for k in range(self.K):
+            model = copy.deepcopy(self.base).to_empty(device=self.betas.device)
+            model.load_state_dict({name:t[k].detach().clone() for name, t in list(self.params.items()) + list(self.buffers.items())})
+            for arg in MEMBER_ARGS:
+                if arg in self.configs[k]['kwargs']:
+                    setattr(model, arg, self.configs[k]['kwargs'][arg])
+            model.epochs = self.epochs
+            if optimizer is not None:
+                model.optimizer = optimizer.member_optimizer(k, model)
+            models.append(model)
+        return models
+
+
+class Ensemble_Optimizer(object):
+    '''
+    Optimizer on the stacked parameters of a VAE_Ensemble, with a learning rate per member
+
+    For element-wise optimizers (Adam, SGD, RMSprop...), each member has its own optimizer state.
+    If the members have different learning rates, the inner optimizer runs with lr=1 and the update
+    of member k is scaled by lrs[k] (updates of these optimizers are proportional to the learning rate)
+
+    Params :
+        ensemble (VAE_Ensemble) : ensemble to optimize
+        optimizer_class : e.g optim.Adam
+        lrs (float or list of K floats) : learning rate of each member
+        **kwargs : other arguments of the optimizer (betas...)
+    '''
+    def __init__(self, ensemble, optimizer_class, lrs=0.0001, **kwargs):
+        lrs = [float(lrs)]*ensemble.K if np.isscalar(lrs) else [float(lr) for lr in lrs]
+        assert len(lrs) == ensemble.K, f'{len(lrs)} learning rates for {ensemble.K} members'
+        self.ensemble = ensemble
+        self.lrs = lrs
+        self.same_lr = len(set(lrs)) == 1
+        self.optimizer = optimizer_class(ensemble.parameters(), lr=lrs[0] if self.same_lr else 1., **kwargs)
+        self.scales = torch.tensor(lrs, device=ensemble.betas.device)
+
+    @property
+    def param_groups(self): #For lr schedulers
+        return self.optimizer.param_groups
+
+    def zero_grad(self):
+        self.optimizer.zero_grad()
+
+    @torch.no_grad()
+    def step(self):
+        if self.same_lr:
+            self.optimizer.step()
+            return
+        previous = [p.detach().clone() for p in self.ensemble.parameters()]
+        self.optimizer.step()
+        for p, p_prev in zip(self.ensemble.parameters(), previous):
+            scale = self.scales.view(-1, *([1]*(p.dim()-1)))
+            p.copy_(p_prev + scale * (p - p_prev))
+
+    def state_dict(self):
+        return self.optimizer.state_dict()
+
+    def load_state_dict(self, state_dict):
+        self.optimizer.load_state_dict(state_dict)
+
+    def member_optimizer(self, k, model):
+        '''A usual optimizer on the parameters of 'model' (member k, c.f VAE_Ensemble.members),
+        with the state of member k'''
+        group = self.optimizer.param_groups[0]
+        kwargs = {key:v for key, v in group.items() if key in self.optimizer.defaults and key != 'lr'}
+        lr = group['lr'] * (1. if self.same_lr else self.lrs[k])
+        optimizer = type(self.optimizer)(model.parameters(), lr=lr, **kwargs)
+        names = list(self.ensemble.params.keys())
+        params = dict(model.named_parameters())
+        for name, stacked in zip(names, self.ensemble.parameters()):
+            state = self.optimizer.state.get(stacked, {})
+            #Per-element states (moments) are sliced, others (step) are shared by all the members
+            optimizer.state[params[name]] = {key:(v[k].clone() if torch.is_tensor(v) and v.shape == stacked.shape else copy.deepcopy(v))
+                for key, v in state.items()}
+        return optimizer
+
+
+###############################
+#### Training #################
+###############################
+
+def ensemble_loss(ensemble, data):
+    '''ELBO of each member on the same batch, as in train_net.train. Return 3 K tensors :
+    loss_VAE (recon + beta * KL), loss_recon, loss_kl'''
+    x_recon, mu_z, logvar_z, _ = ensemble(data)
+    target = data.unsqueeze(0).expand_as(x_recon)
+    loss_recon = nn.functional.binary_cross_entropy_with_logits(x_recon, target, reduction='none').flatten(1).mean(1)
+    loss_recon = loss_recon * data.size(1)*data.size(2)*data.size(3)
+    loss_kl = ensemble.kl_divergence(mu_z, logvar_z)
+    return loss_recon + ensemble.betas * loss_kl, loss_recon, loss_kl
+
+
+def train_ensemble_epoch(epoch, ensemble, optimizer, train_loader, train_on_gpu=False):
+    '''
+    Train all the members of a VAE_Ensemble with standard ELBO objective function for one single epoch
+
+    Params :
+        epoch (int) : the considered epoch
+        ensemble (VAE_Ensemble) : the members to train
+        optimizer (Ensemble_Optimizer) : Optimizer used for training
+        train_loader (DataLoader) : Dataloader used for training
+
+    Return the average loss, KL and reconstruction terms of each member (3 K arrays)
+    '''
+    ensemble.train()
+    global_VAE_iter, kl_loss_iter, recon_loss_iter = [], [], []
+    for batch_idx, (data, _) in enumerate(train_loader):
+        if train_on_gpu:
+            data = data.cuda()
+        loss_VAE, loss_recon, loss_kl = ensemble_loss(ensemble, data)
+        optimizer.zero_grad()
+        #Members have disjoint parameters : gradient of the sum = gradient of each member's own loss
+        loss_VAE.sum().backward()
+        optimizer.step()
+
+        global_VAE_iter.append(loss_VAE.detach().cpu().numpy())
+        recon_loss_iter.append(loss_recon.detach().cpu().numpy())
+        kl_loss_iter.append(loss_kl.detach().cpu().numpy())
+
+        if batch_idx % 2 == 0:
+            print('Train Epoch: {} [{}/{} ({:.0f}%)]\tMean loss of the {} members: {:.6f}'.format(
+                epoch, batch_idx * len(data), len(train_loader.dataset),
+                       100. * batch_idx / len(train_loader), ensemble.K,
+                       loss_VAE.mean().item() ),end='\r')
+
+    return np.mean(global_VAE_iter,axis=0), np.mean(kl_loss_iter,axis=0), np.mean(recon_loss_iter,axis=0)
+
+
+def test_ensemble_epoch(epoch, ensemble, test_loader, train_on_gpu=False):
+    '''Evaluate all the members of a VAE_Ensemble. Return the average loss, KL and reconstruction
+    terms of each member (3 K arrays)'''
+    ensemble.eval()
+    global_VAE_iter, kl_loss_iter, recon_loss_iter = [], [], []
+    with torch.no_grad():
+        for data, _ in test_loader:
+            if train_on_gpu:
+                data = data.cuda()
+            loss_VAE, loss_recon, loss_kl = ensemble_loss(ensemble, data)
+            global_VAE_iter.append(loss_VAE.cpu().numpy())
+            recon_loss_iter.append(loss_recon.cpu().numpy())
+            kl_loss_iter.append(loss_kl.cpu().numpy())
+    return np.mean(global_VAE_iter,axis=0), np.mean(kl_loss_iter,axis=0), np.mean(recon_loss_iter,axis=0)
+
+
+def train_ensemble(epochs, ensemble, optimizer, train_loader, valid_loader, train_on_gpu=False):
+    '''
+    Main function to train all the members of a VAE_Ensemble for a given number of epochs
+    (standard ELBO objective function, with the beta of each member). The learning rates
+    decay as in train_VAE_model (StepLR, step_size=40, gamma=0.6)
+
+    Params :
+        epochs (int) : Number of epochs
+        ensemble (VAE_Ensemble) : the members to train
+        optimizer (Ensemble_Optimizer) : Optimizer used for training
+        train_loader (DataLoader) : Dataloader used for training
+        valid_loader (DataLoader) : Dataloader used for evaluation
+
+    Return the K trained models (c.f VAE_Ensemble.members, each with its optimizer attached), and
+    a pandas DataFrame containing the training history (one row per epoch and member)
+    '''
+    overall_start = timer()
+    history = []
+    lr_schedul = torch.optim.lr_scheduler.StepLR(optimizer=optimizer.optimizer, step_size=40, gamma=0.6)
+
+    for epoch in range(ensemble.epochs+1, ensemble.epochs+epochs+1):
+        start = timer()
+        global_VAE_loss, kl_loss, recon_loss = train_ensemble_epoch(epoch, ensemble, optimizer, train_loader, train_on_gpu)
+        global_VAE_loss_val, kl_loss_val, recon_loss_val = test_ensemble_epoch(epoch, ensemble, valid_loader, train_on_gpu)
+        lr_schedul.step()
+        ensemble.epochs += 1
+        for k in range(ensemble.K):
+            history.append([epoch, k, global_VAE_loss[k], kl_loss[k], recon_loss[k], global_VAE_loss_val[k], kl_loss_val[k], recon_loss_val[k]])
+
+        if (epoch%10==0) or (epoch == 1):
+            print('==========> Epoch: {} ==========> Average loss per member: {}'.format(epoch, np.round(global_VAE_loss,2)))
+            print(f'{timer() - start:.2f} seconds elapsed in epoch ({ensemble.K} members).')
+
+    history = pd.DataFrame(
+        history,
+        columns=['epoch', 'member', 'global_VAE_loss', 'kl_loss', 'recon_loss',
+        'global_VAE_loss_val','kl_loss_val','recon_loss_val'])
+
+    total_time = timer() - overall_start
+    print(f'{total_time:.2f} total seconds elapsed. {total_time / max(epochs,1):.2f} seconds per epoch for {ensemble.K} models.')
+    print('######### TRAINING FINISHED ##########')
+
+    return ensemble.members(optimizer), history
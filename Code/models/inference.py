@@ -0,0 +1,197 @@
+# @Author: Sacha Haidinger <sachahai>
+# @Date:   2026-10-18T10:00:00+10:00
+# @Email:  sacha.haidinger@epfl.ch
+# @Project: Learning methods for Cell Profiling
+# @Last modified by:   sachahai
+# @Last modified time: 2026-10-18T10:00:00+10:00
+
+'''
+Inference-only encoders, to produce latent codes of large datasets as fast as possible.
+
+From a trained VAE (VAE, Skip_VAE, CNN_VAE, CNN_128_VAE...), build an encoder-only module :
+- The decoder and the reparameterization trick are dropped
+- Every BatchNorm is folded in the weights of the preceding Conv2d / Linear layer, with
+  the running statistics learnt during training (equivalent to the model in eval mode)
+
+The Inference_Encoder has the same 'encode()' and 'zdim' as the VAE models, it can be
+given directly to metadata_latent_space() (c.f util/helpers.py) :
+    metadata_latent_space(Inference_Encoder(model), infer_dataloader, ...)
+
+The encoder can also be exported to TorchScript or ONNX with export_encoder(), to be run
+without the training code by Embedding_runner.py (standalone batch inference).
+'''
+
+import copy
+import json
+import torch
+from torch import nn
+
+from models.nn_modules import Skip_Conv_down
+
+
+###############################
+#### BatchNorm Folding ########
+###############################
+
+def fuse_BN(layer, BN):
+    '''Return a copy of 'layer' (nn.Conv2d or nn.Linear) with the BatchNorm 'BN' (in eval mode)
+    folded in its weights and bias : BN(layer(x)) == fused_layer(x)'''
+    fused = copy.deepcopy(layer)
+    std = torch.sqrt(BN.running_var + BN.eps)
+    gamma = BN.weight if BN.affine else torch.ones_like(std)
+    beta = BN.bias if BN.affine else torch.zeros_like(std)
+    scale = gamma / std
+
+    bias = layer.bias if layer.bias is not None else torch.zeros_like(BN.running_mean)
+    shape = [-1] + [1] * (layer.weight.dim() - 1) #Scale each output channel / neuron
+    with torch.no_grad():
+        fused.weight.copy_(layer.weight * scale.view(shape))
+        fused.bias = nn.Parameter((bias - BN.running_mean) * scale + beta)
+    return fused
+
+
+def fold_BN(module):
+    '''Fold in place every BatchNorm of 'module' that directly follows a Conv2d or Linear layer.
+    The folded BatchNorm is replaced by an identity. Handles the nn.Sequential blocks of
+    nn_modules.Conv and of the linear layers, as well as the Skip_Conv_down blocks.
+    Return the module'''
+    if isinstance(module, Skip_Conv_down):
+        if not module.LastLayer: #BN is not used in the last layer
+            module.conv = fuse_BN(module.conv, module.BN)
+            module.BN = nn.Identity()
+        return module
+
+    if isinstance(module, nn.Sequential):
+        layers = list(module.children())
+        for i in range(len(layers)-1):
+            if isinstance(layers[i], (nn.Conv2d, nn.Linear)) and isinstance(layers[i+1], (nn.BatchNorm1d, nn.BatchNorm2d)):
+                module[i] = fuse_BN(layers[i], layers[i+1])
+                module[i+1] = nn.Identity()
+
+    for child in module.children():
+        fold_BN(child)
+    return module
+
+
+###############################
+#### Inference Encoder ########
+###############################
+
+class Inference_Encoder(nn.Module):
+    '''Encoder-only version of a trained VAE, with BatchNorm folded in the weights.
+    encode(x) returns (mu_z, logvar_z), identical (up to floating-point tolerance)
+    to model.encode(x) with the model in eval mode.
+
+    Params :
+        model (nn.Module) : trained VAE. Either with a 'conv_enc', 'linear_enc' and 'mu_logvar_gen'
+            (VAE, Simple_VAE, CNN_VAE, CNN_128_VAE) or an 'encoder' of Skip_Conv_down blocks (Skip_VAE)
+    '''
+    def __init__(self, model):
+        super(Inference_Encoder, self).__init__()
+        model_was_training = model.training
+        model.eval()
+
+        self.zdim = model.zdim
+        self.skip = hasattr(model, 'encoder')
+
+        if self.skip:
+            self.encoder = fold_BN(copy.deepcopy(model.encoder))
+        else:
+            self.conv_enc = fold_BN(copy.deepcopy(model.conv_enc))
+            self.linear_enc = fold_BN(copy.deepcopy(model.linear_enc))
+            self.mu_logvar_gen = copy.deepcopy(model.mu_logvar_gen)
+        self.stabilize_exp = copy.deepcopy(model.stabilize_exp)
+
+        for param in self.parameters():
+            param.requires_grad = False
+        self.eval()
+        model.train(model_was_training)
+
+    def encode(self, x):
+        if self.skip:
+            learnt_stats = self.encoder(x) #Mu encode in the second half channels
+            mu_z = learnt_stats[:,self.zdim:]
+            logvar_z = self.stabilize_exp(learnt_stats[:, :self.zdim])
+        else:
+            batch_size = x.size(0)
+            x = self.conv_enc(x)
+            x = x.view((batch_size, -1))
+            x = self.linear_enc(x)
+            mu_logvar = self.mu_logvar_gen(x)
+            mu_z, logvar_z = mu_logvar.view(-1,self.zdim,2).unbind(-1)
+            logvar_z = self.stabilize_exp(logvar_z)
+
+        return mu_z, logvar_z
+
+    def forward(self, x):
+        return self.encode(x)
+
+
+def check_inference_encoder(model, encoder, data, atol=1e-4):
+    '''Verify that the Inference_Encoder gives the same latent codes as the original model
+    (in eval mode) on a batch of data. Return the maximal absolute difference on mu_z'''
+    model_was_training = model.training
+    with torch.no_grad():
+        model.eval()
+        mu_ref, logvar_ref = model.encode(data)
+        mu_z, logvar_z = encoder.encode(data)
+    model.train(model_was_training)
+
+    max_diff = (mu_ref - mu_z).abs().max().item()
+    assert torch.allclose(mu_ref, mu_z, atol=atol), f"Folded encoder doesn't match the model (max diff on mu_z : {max_diff})"
+    assert torch.allclose(logvar_ref, logvar_z, atol=atol), "Folded encoder doesn't match the model on logvar_z"
+    return max_diff
+
+
+###############################
+#### Export ###################
+###############################
+
+def export_encoder(model, path, input_size, input_channels=None, export_format='torchscript'):
+    '''Export the encoder of a trained VAE (BatchNorm folded, c.f Inference_Encoder) to a file
+    that can be loaded without the training code (c.f Embedding_runner.py).
+    The exported graph takes a B x C x input_size x input_size float tensor (0-1) and
+    returns (mu_z, logvar_z). The batch dimension is dynamic.
+
+    A json file (path + '.json') is saved alongside, with the information needed to preprocess
+    the images and name the outputs (input_size, input_channels, zdim, format).
+
+    Params :
+        model (nn.Module) : trained VAE (VAE, Skip_VAE, CNN_VAE, CNN_128_VAE...)
+        path (string) : where to save the exported encoder ('.pt' for TorchScript, '.onnx' for ONNX)
+        input_size (int) : Size of the images the model was trained on (input_size x input_size)
+        input_channels (int) : Number of channels of the images. Taken from the model if None
+        export_format (string) : 'torchscript' or 'onnx'
+
+    Return the path of the json metadata file
+    '''
+    if input_channels is None:
+        input_channels = model.input_channels
+
+    encoder = Inference_Encoder(model).cpu()
+    example = torch.rand(2, input_channels, input_size, input_size)
+
+    if export_format == 'torchscript':
+        with torch.no_grad():
+            traced = torch.jit.trace(encoder, example)
+        torch.jit.save(traced, path)
+    elif export_format == 'onnx':
+        torch.onnx.export(encoder, (example,), path,
+            input_names=['x'], output_names=['mu_z','logvar_z'],
+            dynamic_axes={'x':{0:'batch'},'mu_z':{0:'batch'},'logvar_z':{0:'batch'}})
+    else:
+        assert False, "Please give a valid export_format, 'torchscript' or 'onnx'"
+
+    meta = {
+        'format' : export_format,
+        'input_size' : input_size,
+        'input_channels' : input_channels,
+        'zdim' : encoder.zdim,
+        'model_type' : type(model).__name__
+    }
+    meta_path = path + '.json'
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f, indent=2)
+    print(f'Encoder exported to : {path}')
+
+    return meta_path
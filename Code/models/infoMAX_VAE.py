@@ -15,7 +15,7 @@ import math
 from torch import nn
 from torch.nn import functional as F
 from torch.nn.init import xavier_normal_
-from models.nn_modules import Conv, ConvUpsampling
+from models.nn_modules import Conv, ConvUpsampling, Patch_Conv_stem
 import numpy as np
 
 
@@ -51,16 +51,78 @@ class MLP_MI_estimator(nn.Module):
             nn.Linear(256, 32),
         )
 
-    def forward(self, x, z):
+    def embed(self, x, z):
+        '''Separate embeddings of the images (MLP_g) and of the latent codes (MLP_h)'''
         x = x.view(-1,self.input_dim)
         z = z.view(-1,self.zdim)
         x_g = self.MLP_g(x) #Batchsize x 32
         y_h = self.MLP_h(z) #Batchsize x 32
+        return x_g, y_h
+
+    def forward(self, x, z):
+        x_g, y_h = self.embed(x, z)
+        scores = torch.matmul(y_h,torch.transpose(x_g,0,1))
+
+        return scores #Each element i,j is a scalar in R. f(xi,proj_j)
+
+
+class Conv_MI_estimator(nn.Module):
+    '''Same separable critic as MLP_MI_estimator, but MLP_g is replaced by a small strided
+    conv stem working on the C x H x W image (c.f nn_modules.Patch_Conv_stem), instead of
+    a MLP on the flattened pixels. Roughly an order of magnitude less FLOPs and parameters
+    for 64x64 and 128x128 inputs. Can be used in place of MLP_MI_estimator and MLP_MI_128_estimator
+    '''
+    def __init__(self,input_channels,input_size,zdim=3,base=16):
+        super(Conv_MI_estimator, self).__init__()
+
+        self.input_channels = input_channels
+        self.input_size = input_size
+        self.zdim = zdim
+        self.base = base
+
+        self.MLP_g = Patch_Conv_stem(input_channels,input_size,base=base,out_dim=32)
+        self.MLP_h = nn.Sequential(
+            nn.Linear(zdim, 256),
+            nn.ReLU(),
+            nn.Linear(256, 256),
+            nn.ReLU(),
+            nn.Linear(256, 32),
+        )
+
+    def embed(self, x, z):
+        '''Separate embeddings of the images (MLP_g) and of the latent codes (MLP_h)'''
+        x = x.view(-1,self.input_channels,self.input_size,self.input_size)
+        z = z.view(-1,self.zdim)
+        x_g = self.MLP_g(x) #Batchsize x 32
+        y_h = self.MLP_h(z) #Batchsize x 32
+        return x_g, y_h
+
+    def forward(self, x, z):
+        x_g, y_h = self.embed(x, z)
         scores = torch.matmul(y_h,torch.transpose(x_g,0,1))
 
         return scores #Each element i,j is a scalar in R. f(xi,proj_j)
 
 
+#Identity in the forward pass, multiply the incoming gradient by 'scale' in the backward pass
+class GradScale(torch.autograd.Function):
+    '''Enables to optimize VAE and MLP with a single backward pass.
+    The MLP maximizes MI, while the VAE maximizes alpha * MI : passing the latent codes
+    through this function before the MLP scales by alpha only the gradient that reaches the VAE.
+    '''
+    @staticmethod
+    def forward(ctx, x, scale):
+        ctx.scale = scale
+        return x.view_as(x)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        return grad_output * ctx.scale, None
+
+def scale_grad(x, scale):
+    return GradScale.apply(x, scale)
+
+
 #Compute the Noise Constrastive Estimation (NCE) loss
 def infoNCE_bound(scores):
     '''Bound from Van Den Oord and al. (2018)'''
@@ -71,6 +133,63 @@ def infoNCE_bound(scores):
     return mi
 
 
+#InfoNCE with more negatives than the batch size
+class Embedding_Queue(object):
+    '''FIFO queue of the MLP_g embeddings of the last 'size' images seen in training (detached),
+    used as additional negatives in the InfoNCE bound (c.f infoNCE_queue_bound), as in MoCo (He and al. 2019).
+    The number of negatives is no longer limited by the batch size, and the queue costs no
+    activation memory (no gradient flows through past embeddings).
+    '''
+    def __init__(self, size):
+        self.size = size
+        self.embeddings = None
+        self.ptr = 0
+        self.count = 0
+
+    def get(self):
+        '''The embeddings in the queue (count x dim), None if empty'''
+        if self.count == 0:
+            return None
+        return self.embeddings[:self.count].clone() #push() modifies the queue before the backward pass
+
+    def push(self, x_g):
+        x_g = x_g.detach()
+        if self.embeddings is None:
+            self.embeddings = x_g.new_zeros((self.size, x_g.size(1)))
+        n = min(x_g.size(0), self.size)
+        idx = (self.ptr + torch.arange(n, device=x_g.device)) % self.size
+        self.embeddings[idx] = x_g[-n:]
+        self.ptr = (self.ptr + n) % self.size
+        self.count = min(self.count + n, self.size)
+
+    def state_dict(self):
+        '''Content of the queue (embeddings on CPU), saved in the training checkpoints to resume exactly'''
+        return {'size':self.size, 'ptr':self.ptr, 'count':self.count,
+            'embeddings':self.embeddings.detach().cpu().clone() if self.embeddings is not None else None}
+
+    def load_state_dict(self, state, device='cpu'):
+        assert state['size'] == self.size, f"Queue of size {state['size']} saved, {self.size} expected"
+        self.ptr, self.count = state['ptr'], state['count']
+        self.embeddings = state['embeddings'].to(device) if state['embeddings'] is not None else None
+
+
+def infoNCE_queue_bound(x_g, y_h, negatives=None, positive_offset=0):
+    '''InfoNCE bound where each latent code is compared to its image (positive), to the other
+    images of the batch and to the 'negatives' (K x dim past MLP_g embeddings, c.f Embedding_Queue).
+    Same as infoNCE_bound(MLP(x,z)) if negatives is None. The bound is at most log(batch size + K)
+    x_g can contain more images than y_h latent codes (images of all the processes in distributed
+    training), the image of latent code i is then x_g[positive_offset + i]'''
+    scores = torch.matmul(y_h,torch.transpose(x_g,0,1))
+    positives = torch.diagonal(scores, offset=positive_offset)
+    if negatives is not None:
+        scores = torch.cat((scores, torch.matmul(y_h,torch.transpose(negatives,0,1))),dim=1)
+    nll = torch.mean(positives - torch.logsumexp(scores,dim=1))
+    k = scores.size()[1]
+    mi = np.log(k) + nll
+
+    return mi
+
+
 ################################################
 ### CNN-VAE architecture
 ################################################
@@ -87,7 +206,9 @@ class CNN_VAE(nn.Module):
         self.beta = beta
         self.alpha = alpha
         self.input_channels = input_channels
+        self.base_enc = base_enc
         self.base_dec = base_dec
+        self.depth_factor_dec = depth_factor_dec
 
         self.conv_enc = nn.Sequential(
             Conv(self.input_channels,base_enc,4,stride=2,padding=1), #stride 2, resolution is splitted by half
@@ -201,7 +322,9 @@ class CNN_128_VAE(nn.Module):
         self.beta = beta
         self.alpha = alpha
         self.input_channels = input_channels
+        self.base_enc = base_enc
         self.base_dec = base_dec
+        self.depth_factor_dec = depth_factor_dec
 
         self.conv_enc = nn.Sequential(
             Conv(self.input_channels,base_enc,4,stride=2,padding=1), #stride 2, resolution is splitted by half
@@ -330,11 +453,16 @@ class MLP_MI_128_estimator(nn.Module):
             nn.Linear(256, 32),
         )
 
-    def forward(self, x, z):
+    def embed(self, x, z):
+        '''Separate embeddings of the images (MLP_g) and of the latent codes (MLP_h)'''
         x = x.view(-1,self.input_dim)
         z = z.view(-1,self.zdim)
         x_g = self.MLP_g(x) #Batchsize x 32
         y_h = self.MLP_h(z) #Batchsize x 32
+        return x_g, y_h
+
+    def forward(self, x, z):
+        x_g, y_h = self.embed(x, z)
         scores = torch.matmul(y_h,torch.transpose(x_g,0,1))
 
         return scores
@@ -34,7 +34,9 @@ class VAE(nn.Module):
         self.beta = beta
         self.loss = loss
         self.input_channels = input_channels
+        self.base_enc = base_enc
         self.base_dec = base_dec
+        self.depth_factor_dec = depth_factor_dec
 
 
         ###########################
@@ -142,6 +144,9 @@ class Skip_VAE(nn.Module):
         self.zdim = zdim
         self.beta = beta
         self.input_channels = input_channels
+        self.base_enc = base_enc
+        self.base_dec = base_dec
+        self.depth_factor_dec = depth_factor_dec
 
         self.encoder = nn.Sequential(
             Skip_Conv_down(self.input_channels,base_enc), # resolution is splitted by half
@@ -225,7 +230,9 @@ class Simple_VAE(nn.Module):
         self.beta = beta
         self.loss = loss
         self.input_channels = input_channels
+        self.base_enc = base_enc
         self.base_dec = base_dec
+        self.depth_factor_dec = depth_factor_dec
 
 
         ###########################
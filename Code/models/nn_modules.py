@@ -11,6 +11,9 @@ c.f networks.py for the models.
 '''
 
 
+import math
+import functools
+import numpy as np
 import torch
 from torch import nn
 from torch.nn import functional as F
@@ -69,10 +72,87 @@ class ConvUpsampling(nn.Module):
 
 
 
+class Patch_Conv_stem(nn.Module):
+    '''Lightweight feature extractor for the MI critics (c.f infoMAX_VAE.py and MINE_metric.py)
+    A non-overlapping strided conv cuts the image in patches and brings the resolution to 16x16,
+    two stride 2 convs bring it to 4x4, and a small MLP maps the features to a 'out_dim' vector.
+    Replace the MLP on flattened pixels, at a fraction of the parameters and FLOPs.
+    No BatchNorm : the critic scores a whole batch against itself, batch statistics would leak across samples.
+    input_size needs to be a multiple of 16'''
+    def __init__(self, input_channels, input_size, base=16, out_dim=32):
+        super(Patch_Conv_stem,self).__init__()
+        assert input_size % 16 == 0, "input_size needs to be a multiple of 16"
+        patch = input_size // 16
+
+        self.conv = nn.Sequential(
+            nn.Conv2d(input_channels, base, kernel_size=patch, stride=patch), #16x16
+            nn.ReLU(),
+            nn.Conv2d(base, base*2, kernel_size=2, stride=2), #8x8
+            nn.ReLU(),
+            nn.Conv2d(base*2, base*4, kernel_size=2, stride=2), #4x4
+            nn.ReLU(),
+        )
+        self.linear = nn.Sequential(
+            nn.Linear(4*4*base*4, 256),
+            nn.ReLU(),
+            nn.Linear(256, out_dim),
+        )
+
+    def forward(self, x):
+        x = self.conv(x)
+        x = x.view(x.size(0),-1)
+        return self.linear(x)
+
+
 ###########################
 ###### Conv ResBlock to Keep Mutual Info high
 ###########################
 
+@functools.lru_cache(maxsize=None)
+def channel_resampling(in_channels, out_channels, mode, device, dtype):
+    '''Source indexes and weights to resample the channel axis from in_channels to out_channels.
+    Reproduce exactly what F.interpolate does along one axis of a 5D tensor, with
+    scale_factor=out_channels/in_channels and align_corners=False ('trilinear' or 'nearest'),
+    but as a gather over the channel dimension of the 4D tensor.
+    Cached per (in_channels, out_channels, mode, device, dtype).
+
+    Return (idx0, idx1, lambda0, lambda1) : out[:,c] = lambda0[c] * x[:,idx0[c]] + lambda1[c] * x[:,idx1[c]]
+    '''
+    scale = out_channels / in_channels
+    assert math.floor(in_channels * scale) == out_channels, "Channel resampling doesn't produce out_channels"
+    #Same single precision arithmetic as the interpolate kernels
+    inv_scale = np.float32(1.0 / scale)
+    dst = np.arange(out_channels, dtype=np.float32)
+
+    if mode == 'nearest':
+        idx0 = np.minimum(np.floor(dst * inv_scale).astype(np.int64), in_channels - 1)
+        idx1 = idx0
+        lambda1 = np.zeros(out_channels, dtype=np.float32)
+    else:
+        src = np.maximum(inv_scale * (dst + np.float32(0.5)) - np.float32(0.5), np.float32(0.))
+        idx0 = src.astype(np.int64)
+        idx1 = idx0 + (idx0 < in_channels - 1)
+        lambda1 = src - idx0.astype(np.float32)
+    lambda0 = np.float32(1.) - lambda1
+
+    idx0 = torch.from_numpy(idx0).to(device)
+    idx1 = torch.from_numpy(idx1).to(device)
+    lambda0 = torch.from_numpy(lambda0).to(device=device, dtype=dtype).view(1,-1,1,1)
+    lambda1 = torch.from_numpy(lambda1).to(device=device, dtype=dtype).view(1,-1,1,1)
+    return idx0, idx1, lambda0, lambda1
+
+def interpolate_channels(x, in_channels, out_channels, mode='trilinear'):
+    '''Resample the channels of a B x in_channels x H x W tensor to out_channels.
+    Equivalent to F.interpolate(x.unsqueeze(0), scale_factor=(out_channels/in_channels,1,1), mode=mode).squeeze(0)
+    without going through a 5D tensor'''
+    if in_channels == out_channels:
+        return x
+    idx0, idx1, lambda0, lambda1 = channel_resampling(in_channels, out_channels, mode, x.device, x.dtype)
+    if mode == 'nearest':
+        return x.index_select(1, idx0)
+    return x.index_select(1, idx0) * lambda0 + x.index_select(1, idx1) * lambda1
+
+
 class Skip_Conv_down(nn.Module):
     '''
     Standard Conv2d to learn best downsampling, but add a short cut skip
@@ -94,14 +174,22 @@ class Skip_Conv_down(nn.Module):
         self.LastLayer = LastLayer
 
     def forward(self, x):
-        #Go to volumetric data (5D) to be able to interpolate over channels
-        x_skip_down = F.interpolate(x.unsqueeze(dim=0), scale_factor=(self.ouc/self.inc,self.down_factor,self.down_factor),mode=self.mode)
+        #Interpolation is separable : downsample over H and W, then interpolate over channels
+        #(same result as a 5D interpolation over channels, H and W at once, but much faster)
+        x_skip_down = x
+        if self.down_factor != 1:
+            if self.down_factor == 0.5 and self.mode == 'trilinear':
+                x_skip_down = F.avg_pool2d(x_skip_down, 2) #Exactly a bilinear downsampling by 2
+            else:
+                mode_2d = 'bilinear' if self.mode == 'trilinear' else self.mode
+                x_skip_down = F.interpolate(x_skip_down, scale_factor=self.down_factor, mode=mode_2d)
+        x_skip_down = interpolate_channels(x_skip_down, self.inc, self.ouc, mode=self.mode)
         x=self.conv(x)
         if not(self.LastLayer) :
             x = self.BN(x)
-            return self.activation(x + x_skip_down.squeeze(dim=0))
+            return self.activation(x + x_skip_down)
         else:
-            return x+x_skip_down.squeeze(dim=0)
+            return x+x_skip_down
 
 
 class Skip_DeConv_up(nn.Module):
@@ -119,14 +207,15 @@ class Skip_DeConv_up(nn.Module):
         self.ouc = out_channels
 
     def forward(self, x):
-        #Go to volumetric data (5D) to be able to interpolate over channels
-        x_skip_up = F.interpolate(x.unsqueeze(dim=0), scale_factor=(self.ouc/self.inc,2,2),mode='trilinear')
+        #Interpolation is separable : interpolate over channels, then upsample H and W
+        #(same result as a 5D trilinear interpolation, but much faster)
+        x_skip_up = F.interpolate(interpolate_channels(x, self.inc, self.ouc), scale_factor=2, mode='bilinear')
         x = self.conv(F.interpolate(x,scale_factor=4,mode='bilinear'))
         if not(self.LastLayer) :
             x = self.BN(x) #Replace a transpose conv
-            return self.activation(x + x_skip_up.squeeze(dim=0))
+            return self.activation(x + x_skip_up)
         else :
-            return x + x_skip_up.squeeze(0)
+            return x + x_skip_up
 
 
 
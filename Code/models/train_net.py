@@ -21,6 +21,7 @@ train_feedback(), train_Simple_VAE() :
 --> Train a VAE with human feedback stored in a CSV file
 '''
 
+import os
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
@@ -35,14 +36,78 @@ from torchvision.utils import save_image, make_grid
 
 from models.networks import VAE
 from util.helpers import plot_latent_space, show, EarlyStopping
-from models.infoMAX_VAE import infoNCE_bound
+from util.checkpoint import Checkpoint_Writer, save_checkpoint, load_checkpoint
+from models.infoMAX_VAE import infoNCE_bound, infoNCE_queue_bound, Embedding_Queue, scale_grad
+from util.distributed import is_distributed, is_main_process, get_rank, broadcast_parameters, average_gradients, average_buffers, all_reduce_mean, all_gather_with_grad
+
+
+###################################################
+##### Gradient accumulation #######################
+###################################################
+
+def accumulation_plan(train_loader, accumulation_steps=1):
+    '''
+    Gradients of 'accumulation_steps' consecutive batches are summed before each optimizer step
+    (effective batch size = batch_size x accumulation_steps, for the same activation memory).
+    The losses are averages over a batch : each batch loss is weighted by its share of the samples of its
+    accumulation group, so that the accumulated gradient is the gradient of the average loss over the group
+    (also when the last group or the last batch of the epoch is smaller).
+    BatchNorm layers normalize with the statistics of each batch, not of the whole group (c.f set_batchnorm_mode).
+
+    Return, for each batch of an epoch, (weight of its loss, True if the optimizer steps after it)
+    '''
+    batch_size = train_loader.batch_size
+    num_samples = len(train_loader.sampler)
+    num_batches = len(train_loader)
+    if train_loader.drop_last:
+        num_samples = num_batches * batch_size
+
+    plan = []
+    for batch_idx in range(num_batches):
+        group_start = batch_idx - batch_idx % accumulation_steps
+        group_end = min(group_start + accumulation_steps, num_batches)
+        group_samples = min(group_end * batch_size, num_samples) - group_start * batch_size
+        batch_samples = min(batch_size, num_samples - batch_idx * batch_size)
+        plan.append((batch_samples / group_samples, batch_idx + 1 == group_end))
+    return plan
+
+BN_MODES = ('batch','momentum','frozen')
+
+def set_batchnorm_mode(models, bn_mode='batch', accumulation_steps=1):
+    '''
+    Behaviour of the BatchNorm layers during a training epoch with gradient accumulation (models in train mode) :
+        - 'batch' : unchanged, each batch is normalized with its own statistics and updates the running
+                statistics, which then average over accumulation_steps times more updates than with a real
+                batch of batch_size x accumulation_steps
+        - 'momentum' : the momentum of the running statistics is divided by accumulation_steps, so that they
+                average over the same number of samples as with a real batch of batch_size x accumulation_steps.
+                The normalization of each batch still uses its own statistics
+        - 'frozen' : the BatchNorm layers are in eval mode, the batches are normalized with the running
+                statistics (e.g of a pretrained model or of the first epochs) which are not updated anymore.
+                Normalization does not depend on the batch at all. The affine weights are still trained
+
+    Return a function that restores the BatchNorm layers, to call at the end of the epoch
+    '''
+    assert bn_mode in BN_MODES, f'bn_mode should be one of {BN_MODES}'
+    layers = [m for model in models for m in model.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+    momenta = [m.momentum for m in layers]
+    for m in layers:
+        if bn_mode == 'momentum' and m.momentum is not None:
+            m.momentum = m.momentum / accumulation_steps
+        elif bn_mode == 'frozen':
+            m.eval()
+
+    def restore():
+        for m, momentum in zip(layers, momenta):
+            m.momentum = momentum
+    return restore
 
 
 ###################################################
 ##### Vanilla VAE and SCVAE training ##############
 ###################################################
 
-def train(epoch, model, optimizer, train_loader, train_on_gpu=True):
+def train(epoch, model, optimizer, train_loader, train_on_gpu=True, accumulation_steps=1, bn_mode='batch'):
     '''
     Train a VAE model with standard ELBO objective function for one single epoch
 
@@ -51,11 +116,15 @@ def train(epoch, model, optimizer, train_loader, train_on_gpu=True):
         model (nn.Module) : VAE model to train
         optimizer (optim.Optimizer) : Optimizer used for training
         train_loader (DataLoader) : Dataloader used for training
+        accumulation_steps (int) : Number of batches whose gradients are accumulated before each
+                optimizer step (c.f accumulation_plan)
+        bn_mode (string) : 'batch', 'momentum' or 'frozen', BatchNorm layers with accumulation (c.f set_batchnorm_mode)
 
     Return the average loss, as well as average of the two main terms (reconstruction and KL)
     '''
     # toggle model to train mode
     model.train()
+    restore_batchnorm = set_batchnorm_mode([model], bn_mode, accumulation_steps)
 
     #Store the different loss per iteration (=batch)
     global_VAE_iter = []
@@ -64,10 +133,13 @@ def train(epoch, model, optimizer, train_loader, train_on_gpu=True):
 
     start = timer()
 
-    criterion_recon = nn.BCEWithLogitsLoss().cuda() #more stable than handmade sigmoid as last layer and BCELoss
+    criterion_recon = nn.BCEWithLogitsLoss() #more stable than handmade sigmoid as last layer and BCELoss
+    plan = accumulation_plan(train_loader, accumulation_steps)
+    optimizer.zero_grad()
 
     # each `data` is of BATCH_SIZE samples and has shape [batch_size, 4, 128, 128]
     for batch_idx, (data, _) in enumerate(train_loader):
+        weight, do_step = plan[batch_idx]
         data = Variable(data)
         if train_on_gpu:
             data = data.cuda()
@@ -83,9 +155,12 @@ def train(epoch, model, optimizer, train_loader, train_on_gpu=True):
         loss_kl = model.kl_divergence(mu_z,logvar_z)
         loss_VAE = loss_recon + model.beta * loss_kl
 
-        optimizer.zero_grad()
-        loss_VAE.backward()
-        optimizer.step()
+        (weight * loss_VAE).backward()
+        if do_step:
+            if is_distributed():
+                average_gradients(model)
+            optimizer.step()
+            optimizer.zero_grad()
 
         global_VAE_iter.append(loss_VAE.item())
         recon_loss_iter.append(loss_recon.item())
@@ -102,7 +177,10 @@ def train(epoch, model, optimizer, train_loader, train_on_gpu=True):
         print(f'{timer() - start:.2f} seconds elapsed in epoch.')
         print(f'Reconstruction loss : {np.mean(recon_loss_iter):.2f}, KL loss : {np.mean(kl_loss_iter):.2f}')
 
-    return np.mean(global_VAE_iter), np.mean(kl_loss_iter), np.mean(recon_loss_iter)
+    restore_batchnorm()
+    if is_distributed():
+        average_buffers(model)
+    return all_reduce_mean(np.mean(global_VAE_iter)), all_reduce_mean(np.mean(kl_loss_iter)), all_reduce_mean(np.mean(recon_loss_iter))
 
 
 def test(epoch, model, optimizer, test_loader, train_on_gpu=True):
@@ -124,7 +202,7 @@ def test(epoch, model, optimizer, test_loader, train_on_gpu=True):
         kl_loss_iter = []
         recon_loss_iter = []
 
-        criterion_recon = nn.BCEWithLogitsLoss().cuda() #more stable than handmade sigmoid as last layer and BCELoss
+        criterion_recon = nn.BCEWithLogitsLoss() #more stable than handmade sigmoid as last layer and BCELoss
 
         # each data is of BATCH_SIZE (default 128) samples
         for i, (data, _) in enumerate(test_loader):
@@ -148,10 +226,10 @@ def test(epoch, model, optimizer, test_loader, train_on_gpu=True):
 
     if (epoch%10==0) or (epoch == 1):
         print('Test Errors for Epoch: {} ----> Average loss: {:.4f}'.format(epoch, np.mean(global_VAE_iter)))
-    return np.mean(global_VAE_iter), np.mean(kl_loss_iter), np.mean(recon_loss_iter)
+    return all_reduce_mean(np.mean(global_VAE_iter)), all_reduce_mean(np.mean(kl_loss_iter)), all_reduce_mean(np.mean(recon_loss_iter))
 
 
-def train_VAE_model(epochs, model, optimizer, train_loader, valid_loader, saving_path='best_model.pth', train_on_gpu=True):
+def train_VAE_model(epochs, model, optimizer, train_loader, valid_loader, saving_path='best_model.pth', train_on_gpu=True, checkpoint_path=None, accumulation_steps=1, bn_mode='batch'):
     '''
     Main function to train a VAE model with standard ELBO objective function for a given number of epochs
     Possible to train from scratch or resume a training (simply pass a trained VAE as input)
@@ -167,6 +245,14 @@ def train_VAE_model(epochs, model, optimizer, train_loader, valid_loader, saving
         train_loader (DataLoader) : Dataloader used for training
         test_loader (DataLoader) : Dataloader used for evaluation
         saving_path (string) : path to the folder to store the best model
+        checkpoint_path (string) : If given, the whole training state (models, optimizers, lr schedulers,
+                early stopping, RNG, history) is saved at the end of each epoch to this file, in the
+                background (c.f util/checkpoint.py). If the file already exists, the training is resumed from it
+        accumulation_steps (int) : Number of batches whose gradients are accumulated before each optimizer
+                step. Effective batch size is batch_size x accumulation_steps (c.f accumulation_plan)
+        bn_mode (string) : BatchNorm layers during accumulation, 'batch' (statistics of each batch, default),
+                'momentum' (running statistics averaged as with the effective batch size) or 'frozen'
+                (running statistics, not updated). c.f set_batchnorm_mode
 
     Return a pandas DataFrame containing the training history, as well as the trained model and the best epoch
     '''
@@ -184,8 +270,25 @@ def train_VAE_model(epochs, model, optimizer, train_loader, valid_loader, saving
     early_stopping = EarlyStopping(patience=30,verbose=True,path=saving_path)
     lr_schedul_VAE = torch.optim.lr_scheduler.StepLR(optimizer=optimizer, step_size=40, gamma=0.6)
 
-    for epoch in range(model.epochs+1,model.epochs+epochs+1):
-        global_VAE_loss, kl_loss, recon_loss = train(epoch, model,optimizer, train_loader, train_on_gpu)
+    end_epoch = model.epochs + epochs
+    writer = None
+    if checkpoint_path is not None:
+        writer = Checkpoint_Writer() if is_main_process() else None
+        if os.path.exists(checkpoint_path):
+            state = load_checkpoint(checkpoint_path, models={'VAE':model}, optimizers={'VAE':optimizer}, schedulers={'VAE':lr_schedul_VAE}, early_stopping=early_stopping, restore_rng=not is_distributed())
+            model.epochs, history, end_epoch = state['epoch'], state['history'], state['extra']['end_epoch']
+            print(f'Resuming training from {checkpoint_path} (epoch {model.epochs})')
+
+    if is_distributed(): #Same initial weights in all the processes
+        broadcast_parameters(model)
+
+    epoch = model.epochs
+    for epoch in range(model.epochs+1,end_epoch+1):
+        if early_stopping.early_stop: #Resumed from a training already early stopped
+            break
+        if hasattr(train_loader.sampler, 'set_epoch'): #Distributed_Subset_Sampler, new shuffling
+            train_loader.sampler.set_epoch(epoch)
+        global_VAE_loss, kl_loss, recon_loss = train(epoch, model,optimizer, train_loader, train_on_gpu, accumulation_steps, bn_mode)
         global_VAE_loss_val, kl_loss_val, recon_loss_val = test(epoch, model,optimizer,valid_loader, train_on_gpu)
 
         #early stopping takes the validation loss to check if it has decereased,
@@ -196,6 +299,8 @@ def train_VAE_model(epochs, model, optimizer, train_loader, valid_loader, saving
         history.append([global_VAE_loss, kl_loss, recon_loss,global_VAE_loss_val, kl_loss_val, recon_loss_val])
         model.epochs += 1
         lr_schedul_VAE.step()
+        if writer is not None:
+            save_checkpoint(checkpoint_path, model.epochs, {'VAE':model}, {'VAE':optimizer}, {'VAE':lr_schedul_VAE}, early_stopping, history, extra={'end_epoch':end_epoch}, writer=writer)
 
         if early_stopping.early_stop:
             print(f'#### Early stopping occured. Best model saved is from epoch {early_stopping.stop_epoch}')
@@ -206,6 +311,10 @@ def train_VAE_model(epochs, model, optimizer, train_loader, valid_loader, saving
         columns=['global_VAE_loss', 'kl_loss', 'recon_loss',
         'global_VAE_loss_val','kl_loss_val','recon_loss_val'])
 
+    if writer is not None:
+        writer.close() #Wait for the last checkpoint to be written
+    early_stopping.close() #Wait for the best model to be written
+
     total_time = timer() - overall_start
     print(
         f'{total_time:.2f} total seconds elapsed. {total_time / (epoch):.2f} seconds per epoch.'
@@ -223,7 +332,7 @@ def train_VAE_model(epochs, model, optimizer, train_loader, valid_loader, saving
 ##### InfoMax VAE training ##############
 ###################################################
 
-def train_infoM_epoch(epoch, VAE, MLP, opti_VAE, opti_MLP, train_loader, train_on_gpu=False):
+def train_infoM_epoch(epoch, VAE, MLP, opti_VAE, opti_MLP, train_loader, train_on_gpu=False, accumulation_steps=1, queue=None, bn_mode='batch'):
     '''
     Train a VAE model with InfoMAX VAE objective function for one single epoch
     A VAE and a MLP that estimate mutual information are jointly optimized
@@ -235,11 +344,17 @@ def train_infoM_epoch(epoch, VAE, MLP, opti_VAE, opti_MLP, train_loader, train_o
         opti_VAE (optim.Optimizer) : Optimizer used for VAE training
         opti_MLP (optim.Optimizer) : Optimizer used for MLP training
         train_loader (DataLoader) : Dataloader used for training
+        accumulation_steps (int) : Number of batches whose gradients are accumulated before each
+                optimizer step (c.f accumulation_plan)
+        queue (Embedding_Queue) : If given, the MLP_g embeddings of past batches are used as additional
+                negatives in the InfoNCE bound (c.f infoNCE_queue_bound)
+        bn_mode (string) : 'batch', 'momentum' or 'frozen', BatchNorm layers with accumulation (c.f set_batchnorm_mode)
 
     Return the average global loss, as well as average of the different terms
     '''
     # toggle model to train mode
     VAE.train()
+    restore_batchnorm = set_batchnorm_mode([VAE, MLP], bn_mode, accumulation_steps)
 
     global_VAE_iter = []
     MI_estimation_iter = []
@@ -249,38 +364,57 @@ def train_infoM_epoch(epoch, VAE, MLP, opti_VAE, opti_MLP, train_loader, train_o
 
     start = timer()
 
-    criterion_recon = nn.BCEWithLogitsLoss().cuda() #more stable than handmade sigmoid as last layer and BCELoss
+    criterion_recon = nn.BCEWithLogitsLoss() #more stable than handmade sigmoid as last layer and BCELoss
+    plan = accumulation_plan(train_loader, accumulation_steps)
+    opti_VAE.zero_grad()
+    opti_MLP.zero_grad()
 
     # each `data` is of BATCH_SIZE samples and has shape [batch_size, 4, H, W]
     for batch_idx, (data, _) in enumerate(train_loader):
+        weight, do_step = plan[batch_idx]
         data = Variable(data)
         if train_on_gpu:
             data = data.cuda()
 
         #data feed to CNN-VAE
         x_recon, mu_z, logvar_z, z = VAE(data)
-        scores = MLP(data,z)
-
-        #Estimation of the Mutual Info between X and Z
-        MI_xz = infoNCE_bound(scores)
+        #Gradient of MI wrt latent codes is scaled by alpha on its way back to the VAE
+        if queue is None and not is_distributed():
+            scores = MLP(data,scale_grad(z,VAE.alpha))
+            #Estimation of the Mutual Info between X and Z
+            MI_xz = infoNCE_bound(scores)
+        else:
+            x_g, y_h = MLP.embed(data,scale_grad(z,VAE.alpha))
+            negatives = queue.get() if queue is not None else None
+            if is_distributed(): #Images of all the processes are negatives
+                MI_xz = infoNCE_queue_bound(all_gather_with_grad(x_g), y_h, negatives, positive_offset=get_rank()*x_g.size(0))
+            else:
+                MI_xz = infoNCE_queue_bound(x_g, y_h, negatives)
+            if queue is not None:
+                queue.push(x_g)
 
         loss_recon = criterion_recon(x_recon,data)
         loss_recon *= data.size(1)*data.size(2)*data.size(3)
         loss_recon.div(data.size(0))
         loss_kl = VAE.kl_divergence(mu_z,logvar_z)
 
-        loss_VAE = loss_recon + VAE.beta * loss_kl - VAE.alpha * MI_xz
-
-        # Step 1 : Optimization of VAE based on the current MI estimation
-        opti_VAE.zero_grad()
-        loss_VAE.backward(retain_graph=True) #Important argument, we backpropagated two times over MI_xz
-        opti_VAE.step()
-
         MI_loss = -MI_xz
-        # Step 2 : Optimization of the MLP to improve the MI estimation
-        opti_MLP.zero_grad()
-        MI_loss.backward()
-        opti_MLP.step()
+
+        # Single backward pass for both networks :
+        # VAE params receive the gradient of (recon + beta * KL - alpha * MI)
+        # MLP params receive the gradient of -MI (they do not appear in recon and KL)
+        (weight * (loss_recon + VAE.beta * loss_kl + MI_loss)).backward()
+        if do_step:
+            if is_distributed():
+                average_gradients(VAE, MLP)
+            # Step 1 : Optimization of VAE based on the current MI estimation
+            opti_VAE.step()
+            # Step 2 : Optimization of the MLP to improve the MI estimation
+            opti_MLP.step()
+            opti_VAE.zero_grad()
+            opti_MLP.zero_grad()
+
+        loss_VAE = loss_recon.detach() + VAE.beta * loss_kl.detach() - VAE.alpha * MI_xz.detach()
 
         global_VAE_iter.append(loss_VAE.item())
         recon_loss_iter.append(loss_recon.item())
@@ -299,7 +433,10 @@ def train_infoM_epoch(epoch, VAE, MLP, opti_VAE, opti_MLP, train_loader, train_o
         print(f'{timer() - start:.2f} seconds elapsed in epoch.')
         print(f'Reconstruction loss : {np.mean(recon_loss_iter):.2f}, KL loss : {np.mean(kl_loss_iter):.2f} \n MI : {np.mean(MI_estimation_iter):.2f} ')
 
-    return np.mean(global_VAE_iter), np.mean(MI_estimation_iter), np.mean(MI_estimator_loss_iter), np.mean(kl_loss_iter), np.mean(recon_loss_iter)
+    restore_batchnorm()
+    if is_distributed():
+        average_buffers(VAE, MLP)
+    return tuple(all_reduce_mean(np.mean(it)) for it in (global_VAE_iter, MI_estimation_iter, MI_estimator_loss_iter, kl_loss_iter, recon_loss_iter))
 
 
 def test_infoM_epoch(epoch, VAE, MLP, opti_VAE, opti_MLP, test_loader, train_on_gpu=False):
@@ -325,7 +462,7 @@ def test_infoM_epoch(epoch, VAE, MLP, opti_VAE, opti_MLP, test_loader, train_on_
         kl_loss_iter = []
         recon_loss_iter = []
 
-        criterion_recon = nn.BCEWithLogitsLoss().cuda() #more stable than handmade sigmoid as last layer and BCELoss
+        criterion_recon = nn.BCEWithLogitsLoss() #more stable than handmade sigmoid as last layer and BCELoss
 
 
         # each data is of BATCH_SIZE (default 128) samples
@@ -339,8 +476,12 @@ def test_infoM_epoch(epoch, VAE, MLP, opti_VAE, opti_MLP, test_loader, train_on_
 
             #data feed to CNN-VAE
             x_recon, mu_z, logvar_z, z = VAE(data)
-            scores = MLP(data,z)
-            MI_xz = infoNCE_bound(scores)
+            if is_distributed(): #Images of all the processes are negatives
+                x_g, y_h = MLP.embed(data,z)
+                MI_xz = infoNCE_queue_bound(all_gather_with_grad(x_g), y_h, positive_offset=get_rank()*x_g.size(0))
+            else:
+                scores = MLP(data,z)
+                MI_xz = infoNCE_bound(scores)
 
             #Estimation of the Mutual Info between X and Z
             MI_loss = -MI_xz
@@ -360,10 +501,10 @@ def test_infoM_epoch(epoch, VAE, MLP, opti_VAE, opti_MLP, test_loader, train_on_
 
     if (epoch%10==0) or (epoch == 1):
         print('Test Errors for Epoch: {} ----> Average loss: {:.4f}'.format(epoch, np.mean(global_VAE_iter)))
-    return np.mean(global_VAE_iter), np.mean(MI_estimation_iter), np.mean(MI_estimator_loss_iter), np.mean(kl_loss_iter), np.mean(recon_loss_iter)
+    return tuple(all_reduce_mean(np.mean(it)) for it in (global_VAE_iter, MI_estimation_iter, MI_estimator_loss_iter, kl_loss_iter, recon_loss_iter))
 
 
-def train_InfoMAX_model(epochs,VAE, MLP, opti_VAE, opti_MLP, train_loader, valid_loader, saving_path='best_model.pth', train_on_gpu=False):
+def train_InfoMAX_model(epochs,VAE, MLP, opti_VAE, opti_MLP, train_loader, valid_loader, saving_path='best_model.pth', train_on_gpu=False, checkpoint_path=None, accumulation_steps=1, queue_size=0, bn_mode='batch'):
     '''
     Main function to train a VAE model with InfoMAX VAE objective function for a given number of epochs
     Standard ELBO objective function with an additional term maximizing mutual information is
@@ -383,6 +524,17 @@ def train_InfoMAX_model(epochs,VAE, MLP, opti_VAE, opti_MLP, train_loader, valid
         train_loader (DataLoader) : Dataloader used for training
         test_loader (DataLoader) : Dataloader used for evaluation
         saving_path (string) : path to the folder to store the best model
+        checkpoint_path (string) : If given, the whole training state (models, optimizers, lr schedulers,
+                early stopping, RNG, history, embedding queue) is saved at the end of each epoch to this file, in the
+                background (c.f util/checkpoint.py). If the file already exists, the training is resumed from it
+        accumulation_steps (int) : Number of batches whose gradients are accumulated before each optimizer
+                step. Effective batch size is batch_size x accumulation_steps (c.f accumulation_plan)
+        bn_mode (string) : BatchNorm layers during accumulation, 'batch' (statistics of each batch, default),
+                'momentum' (running statistics averaged as with the effective batch size) or 'frozen'
+                (running statistics, not updated). c.f set_batchnorm_mode
+        queue_size (int) : If > 0, the MLP_g embeddings of the last 'queue_size' training images are kept and used
+                as additional negatives in the InfoNCE bound (c.f Embedding_Queue). The number of negatives is then
+                batch_size - 1 + queue_size, independently of the batch size
 
     Return a pandas DataFrame containing the training history, as well as the trained models and the best epoch
     '''
@@ -401,9 +553,29 @@ def train_InfoMAX_model(epochs,VAE, MLP, opti_VAE, opti_MLP, train_loader, valid
     early_stopping = EarlyStopping(patience=30,verbose=True,path=saving_path)
     lr_schedul_VAE = torch.optim.lr_scheduler.StepLR(optimizer=opti_VAE, step_size=40, gamma=0.6)
     lr_schedul_MLP = torch.optim.lr_scheduler.StepLR(optimizer=opti_MLP, step_size=40, gamma=0.6)
-
-    for epoch in range(VAE.epochs+1,VAE.epochs+epochs+1):
-        global_VAE_loss, MI_estimation, MI_estimator_loss, kl_loss, recon_loss = train_infoM_epoch(epoch, VAE, MLP, opti_VAE, opti_MLP, train_loader, train_on_gpu)
+    queue = Embedding_Queue(queue_size) if queue_size > 0 else None
+
+    end_epoch = VAE.epochs + epochs
+    writer = None
+    if checkpoint_path is not None:
+        writer = Checkpoint_Writer() if is_main_process() else None
+        if os.path.exists(checkpoint_path):
+            state = load_checkpoint(checkpoint_path, models={'VAE':VAE,'MLP':MLP}, optimizers={'VAE':opti_VAE,'MLP':opti_MLP}, schedulers={'VAE':lr_schedul_VAE,'MLP':lr_schedul_MLP}, early_stopping=early_stopping, restore_rng=not is_distributed())
+            VAE.epochs, history, end_epoch = state['epoch'], state['history'], state['extra']['end_epoch']
+            if queue is not None and state['extra'].get('queue') is not None:
+                queue.load_state_dict(state['extra']['queue'], device='cuda' if train_on_gpu else 'cpu')
+            print(f'Resuming training from {checkpoint_path} (epoch {VAE.epochs})')
+
+    if is_distributed(): #Same initial weights in all the processes
+        broadcast_parameters(VAE, MLP)
+
+    epoch = VAE.epochs
+    for epoch in range(VAE.epochs+1,end_epoch+1):
+        if early_stopping.early_stop: #Resumed from a training already early stopped
+            break
+        if hasattr(train_loader.sampler, 'set_epoch'): #Distributed_Subset_Sampler, new shuffling
+            train_loader.sampler.set_epoch(epoch)
+        global_VAE_loss, MI_estimation, MI_estimator_loss, kl_loss, recon_loss = train_infoM_epoch(epoch, VAE, MLP, opti_VAE, opti_MLP, train_loader, train_on_gpu, accumulation_steps, queue, bn_mode)
         global_VAE_loss_val, MI_estimation_val, MI_estimator_loss_val, kl_loss_val, recon_loss_val = test_infoM_epoch(epoch, VAE, MLP, opti_VAE, opti_MLP, valid_loader, train_on_gpu)
 
         #ealy stopping takes the validation loss to check if it has decereased,
@@ -415,6 +587,9 @@ def train_InfoMAX_model(epochs,VAE, MLP, opti_VAE, opti_MLP, train_loader, valid
         VAE.epochs += 1
         lr_schedul_VAE.step()
         lr_schedul_MLP.step()
+        if writer is not None:
+            save_checkpoint(checkpoint_path, VAE.epochs, {'VAE':VAE,'MLP':MLP}, {'VAE':opti_VAE,'MLP':opti_MLP}, {'VAE':lr_schedul_VAE,'MLP':lr_schedul_MLP}, early_stopping, history,
+                extra={'end_epoch':end_epoch, 'queue':queue.state_dict() if queue is not None else None}, writer=writer)
 
         if early_stopping.early_stop:
             print(f'#### Early stopping occured. Best model saved is from epoch {early_stopping.stop_epoch}')
@@ -425,6 +600,10 @@ def train_InfoMAX_model(epochs,VAE, MLP, opti_VAE, opti_MLP, train_loader, valid
         columns=['global_VAE_loss', 'MI_estimation', 'MI_estimator_loss', 'kl_loss', 'recon_loss',
         'global_VAE_loss_val','MI_estimation_val','MI_estimator_loss_val','kl_loss_val','recon_loss_val'])
 
+    if writer is not None:
+        writer.close() #Wait for the last checkpoint to be written
+    early_stopping.close() #Wait for the best model to be written
+
     total_time = timer() - overall_start
     print(
         f'{total_time:.2f} total seconds elapsed. {total_time / (epoch):.2f} seconds per epoch.'
@@ -473,7 +652,7 @@ def train_feedback(epoch, model, optimizer, train_loader, train_on_gpu=True):
 
     start = timer()
 
-    criterion_recon = nn.BCEWithLogitsLoss().cuda() #more stable than handmade sigmoid as last layer and BCELoss
+    criterion_recon = nn.BCEWithLogitsLoss() #more stable than handmade sigmoid as last layer and BCELoss
     MSE = nn.MSELoss(reduce=False)
     def weighted_mse_loss(input, target, weight):
         return torch.sum(weight * torch.sum(MSE(input,target),dim=1))
@@ -526,7 +705,7 @@ def train_feedback(epoch, model, optimizer, train_loader, train_on_gpu=True):
 
 
 
-def train_Simple_VAE(epochs, model, optimizer, train_loader, train_on_gpu=True):
+def train_Simple_VAE(epochs, model, optimizer, train_loader, train_on_gpu=True, checkpoint_path=None):
     '''
     Main function to train a VAE model with standard ELBO objective function for a given number of epochs
     An additional term is present is the objective, to force some points to a defined
@@ -543,6 +722,9 @@ def train_Simple_VAE(epochs, model, optimizer, train_loader, train_on_gpu=True):
         model (nn.Module) : VAE model to train
         optimizer (optim.Optimizer) : Optimizer used for VAE training
         train_loader (DataLoader) : Dataloader used for training
+        checkpoint_path (string) : If given, the whole training state (models, optimizers, lr schedulers,
+                early stopping, RNG, history) is saved at the end of each epoch to this file, in the
+                background (c.f util/checkpoint.py). If the file already exists, the training is resumed from it
 
     Return a pandas DataFrame containing the training history, as well as the trained model
     '''
@@ -559,20 +741,34 @@ def train_Simple_VAE(epochs, model, optimizer, train_loader, train_on_gpu=True):
 
     lr_schedul_VAE = torch.optim.lr_scheduler.StepLR(optimizer=optimizer, step_size=25, gamma=0.5)
 
-
-    for epoch in range(model.epochs+1,model.epochs+epochs+1):
+    end_epoch = model.epochs + epochs
+    writer = None
+    if checkpoint_path is not None:
+        writer = Checkpoint_Writer() if is_main_process() else None
+        if os.path.exists(checkpoint_path):
+            state = load_checkpoint(checkpoint_path, models={'VAE':model}, optimizers={'VAE':optimizer}, schedulers={'VAE':lr_schedul_VAE})
+            model.epochs, history, end_epoch = state['epoch'], state['history'], state['extra']['end_epoch']
+            print(f'Resuming training from {checkpoint_path} (epoch {model.epochs})')
+
+    epoch = model.epochs
+    for epoch in range(model.epochs+1,end_epoch+1):
         global_VAE_loss, kl_loss, recon_loss = train_feedback(epoch, model,optimizer, train_loader, train_on_gpu=True)
 
         history.append([global_VAE_loss, kl_loss, recon_loss])
         model.epochs += 1
 
         lr_schedul_VAE.step()
+        if writer is not None:
+            save_checkpoint(checkpoint_path, model.epochs, {'VAE':model}, {'VAE':optimizer}, {'VAE':lr_schedul_VAE}, None, history, extra={'end_epoch':end_epoch}, writer=writer)
 
     history = pd.DataFrame(
         history,
         columns=['global_VAE_loss', 'kl_loss', 'recon_loss'])
 
 
+    if writer is not None:
+        writer.close() #Wait for the last checkpoint to be written
+
     total_time = timer() - overall_start
     print(
         f'{total_time:.2f} total seconds elapsed. {total_time / (epoch):.2f} seconds per epoch.'
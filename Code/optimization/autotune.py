@@ -0,0 +1,338 @@
+# @Author: Sacha Haidinger <sachahai>
+# @Date:   2026-10-18T10:00:00+10:00
+# @Email:  sacha.haidinger@epfl.ch
+# @Project: Learning methods for Cell Profiling
+# @Last modified by:   sachahai
+# @Last modified time: 2026-10-18T10:00:00+10:00
+
+'''
+Autotuning of the batch size and learning rate of a VAE / InfoMAX VAE before its training
+with models/train_net.py, instead of manual trial-and-error on each new dataset.
+
+- probe_batch_sizes : a few training steps at increasing batch sizes (powers of 2), measuring
+  the samples / second and the training memory (on GPU the peak allocated memory, on CPU the
+  parameters + gradients + optimizer states + the activations saved for the backward pass).
+  The recommended batch size is the smallest one within the memory budget that reaches
+  (1 - tolerance) of the peak throughput : more optimizer steps per epoch for the same speed.
+- lr_range_test : LR range test (Smith 2017) on the training objective of train_net (ELBO,
+  or the InfoMAX objective recon + beta * KL - alpha * MI, the MI estimator lr following the
+  VAE lr with a fixed ratio). The lr grows exponentially at each step, the smoothed loss is
+  recorded until it diverges. The recommended lr is the lr of the minimum loss / 10.
+
+The models given are never modified (the probes train deep copies).
+
+    config, batch_table, lr_curve = autotune(VAE, train_loader, MLP=MLP, memory_budget_mb=4000)
+    train_loader, valid_loader = get_train_val_dataloader(dataset_path,input_size,config['batch_size'])
+    opti_VAE = optim.Adam(VAE.parameters(), lr=config['lr'], betas=(0.9, 0.999))
+
+Usage (from the Code folder) :
+    python -m optimization.autotune --data ../DataSets/Synthetic_Data_1 --infomax --memory_budget_mb 4000
+'''
+
+import copy
+import json
+import argparse
+from timeit import default_timer as timer
+
+import numpy as np
+import pandas as pd
+import torch
+from torch import nn, cuda
+import torch.optim as optim
+
+from models.infoMAX_VAE import infoNCE_bound, scale_grad
+
+
+###############################
+#### Training step ############
+###############################
+
+def _is_out_of_memory(e):
+    '''CUDA out of memory, or failed allocation of the CPU allocator of torch / of python'''
+    message = str(e)
+    return isinstance(e, MemoryError) or 'out of memory' in message or 'DefaultCPUAllocator' in message \
+        or 'not enough memory' in message
+
+
+def collect_samples(train_loader, n_samples):
+    '''Stack images from the training DataLoader (with its data augmentation) until n_samples'''
+    samples, count = [], 0
+    while count < n_samples:
+        previous = count
+        for data, _ in train_loader:
+            samples.append(data)
+            count += data.size(0)
+            if count >= n_samples:
+                break
+        assert count > previous, f'The training DataLoader yields no batch, cannot collect {n_samples} samples ' \
+            '(dataset smaller than one batch with drop_last=True ?)'
+    return torch.cat(samples, dim=0)[:n_samples]
+
+
+def training_loss(VAE, MLP, data):
+    '''Objective optimized by train_net.train (MLP=None) or train_net.train_infoM_epoch,
+    on one batch. Return (loss to backward, value of the VAE objective)'''
+    criterion_recon = nn.BCEWithLogitsLoss()
+    x_recon, mu_z, logvar_z, z = VAE(data)
+    loss_recon = criterion_recon(x_recon,data) * data.size(1)*data.size(2)*data.size(3)
+    loss_kl = VAE.kl_divergence(mu_z,logvar_z)
+    if MLP is None:
+        loss = loss_recon + VAE.beta * loss_kl
+        return loss, loss.item()
+    MI_xz = infoNCE_bound(MLP(data,scale_grad(z,VAE.alpha)))
+    loss = loss_recon + VAE.beta * loss_kl - MI_xz
+    return loss, (loss_recon + VAE.beta * loss_kl - VAE.alpha * MI_xz).item()
+
+
+def _copies(VAE, MLP, lr, lr_ratio, optimizer_class, optimizer_kwargs):
+    VAE = copy.deepcopy(VAE).train()
+    optimizers = [optimizer_class(VAE.parameters(), lr=lr, **optimizer_kwargs)]
+    if MLP is not None:
+        MLP = copy.deepcopy(MLP).train()
+        optimizers.append(optimizer_class(MLP.parameters(), lr=lr*lr_ratio, **optimizer_kwargs))
+    return VAE, MLP, optimizers
+
+
+def _step(VAE, MLP, optimizers, data):
+    for optimizer in optimizers:
+        optimizer.zero_grad()
+    loss, value = training_loss(VAE, MLP, data)
+    loss.backward()
+    for optimizer in optimizers:
+        optimizer.step()
+    return value
+
+
+###############################
+#### Batch size ###############
+###############################
+
+def _training_memory_mb(VAE, MLP, optimizers, data):
+    '''Memory of one training step on CPU : parameters, gradients, optimizer states,
+    inputs and the activations saved by autograd for the backward pass'''
+    saved = {}
+    def pack(tensor):
+        saved[(tensor.data_ptr(), tensor.dtype)] = tensor.numel() * tensor.element_size()
+        return tensor
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        _step(VAE, MLP, optimizers, data)
+    models = [VAE] + ([MLP] if MLP is not None else [])
+    static = sum(2 * p.numel() * p.element_size() for m in models for p in m.parameters()) #weights + gradients
+    static += sum(t.numel() * t.element_size() for o in optimizers for s in o.state.values() for t in s.values() if torch.is_tensor(t))
+    return (static + sum(saved.values()) + data.numel() * data.element_size()) / 1e6
+
+
+def probe_batch_sizes(VAE, samples, MLP=None, batch_sizes=None, memory_budget_mb=None, n_steps=3, lr=0.0001, lr_ratio=5.,
+                      optimizer_class=optim.Adam, optimizer_kwargs=None, train_on_gpu=False):
+    '''
+    Throughput (samples / second) and training memory for increasing batch sizes
+
+    Params :
+        VAE (nn.Module) : VAE to train (not modified)
+        samples (Tensor) : N x C x H x W training images (c.f collect_samples), N >= largest batch size
+        MLP (nn.Module) : MI estimator for InfoMAX VAE, None for a standard VAE
+        batch_sizes (list of int) : batch sizes to try, in increasing order (default : 8, 16, ... up to N)
+        memory_budget_mb (float) : the probe stops at the first batch size exceeding this memory
+        n_steps (int) : timed training steps per batch size (after 1 warm-up step)
+        lr, lr_ratio, optimizer_class, optimizer_kwargs : optimizer(s) of the probe (MLP lr = lr x lr_ratio)
+
+    Return a pandas DataFrame : batch_size, samples_per_s, seconds_per_step, memory_mb, within_budget
+    '''
+    optimizer_kwargs = optimizer_kwargs if optimizer_kwargs is not None else {'betas':(0.9, 0.999)}
+    if batch_sizes is None:
+        batch_sizes = [2**k for k in range(3, int(np.log2(len(samples)))+1)]
+    rows = []
+    for batch_size in batch_sizes:
+        assert batch_size <= len(samples), f'Not enough samples ({len(samples)}) for a batch of {batch_size}'
+        model, critic, optimizers = _copies(VAE, MLP, lr, lr_ratio, optimizer_class, optimizer_kwargs)
+        batches = [samples[torch.randperm(len(samples))[:batch_size]] for _ in range(n_steps+1)]
+        try:
+            if train_on_gpu:
+                batches = [b.cuda() for b in batches]
+                cuda.synchronize()
+                cuda.reset_peak_memory_stats()
+                _step(model, critic, optimizers, batches[0])
+                memory = cuda.max_memory_allocated() / 1e6
+            else:
+                memory = _training_memory_mb(model, critic, optimizers, batches[0])
+            start = timer()
+            for data in batches[1:]:
+                _step(model, critic, optimizers, data)
+            if train_on_gpu:
+                cuda.synchronize()
+            seconds = (timer() - start) / n_steps
+        except (RuntimeError, MemoryError) as e:
+            if not _is_out_of_memory(e):
+                raise
+            rows.append({'batch_size':batch_size, 'samples_per_s':np.nan, 'seconds_per_step':np.nan, 'memory_mb':np.inf, 'within_budget':False})
+            break
+        finally:
+            del model, critic, optimizers, batches
+            if train_on_gpu:
+                cuda.empty_cache()
+
+        within_budget = memory_budget_mb is None or memory <= memory_budget_mb
+        rows.append({'batch_size':batch_size, 'samples_per_s':batch_size/seconds, 'seconds_per_step':seconds,
+            'memory_mb':memory, 'within_budget':within_budget})
+        print(f'Batch size {batch_size} : {batch_size/seconds:.1f} samples/s, {memory:.0f} MB')
+        if not within_budget:
+            break
+    return pd.DataFrame(rows)
+
+
+def recommend_batch_size(batch_table, tolerance=0.1):
+    '''Smallest batch size within the memory budget reaching (1 - tolerance) x the peak throughput.
+    Raise a ValueError if no batch size was probed or none fits in the memory budget'''
+    if not len(batch_table):
+        raise ValueError('No batch size was probed (batch_sizes is empty, or fewer than 8 samples for the default ones)')
+    candidates = batch_table[batch_table['within_budget']]
+    if not len(candidates):
+        smallest = batch_table.iloc[0]
+        need = 'ran out of memory' if not np.isfinite(smallest['memory_mb']) else f"needs {smallest['memory_mb']:.0f} MB"
+        raise ValueError(f"No batch size fits in the memory budget : the smallest one probed ({int(smallest['batch_size'])}) {need}. "
+            'Probe smaller batch sizes (batch_sizes), use a smaller model or input_size, or increase memory_budget_mb')
+    peak = candidates['samples_per_s'].max()
+    return int(candidates[candidates['samples_per_s'] >= (1-tolerance)*peak]['batch_size'].min())
+
+
+###############################
+#### Learning rate ############
+###############################
+
+def lr_range_test(VAE, samples, batch_size, MLP=None, start_lr=1e-7, end_lr=1., num_iter=100, lr_ratio=5., smoothing=0.98,
+                  diverge_factor=4., optimizer_class=optim.Adam, optimizer_kwargs=None, train_on_gpu=False):
+    '''
+    LR range test : train a copy of the model(s) with a learning rate growing exponentially from start_lr
+    to end_lr in num_iter steps, and record the smoothed training objective. Stops when the loss diverges
+    (smoothed loss > diverge_factor x its minimum, or not finite)
+
+    Params :
+        VAE (nn.Module) : VAE to train (not modified)
+        samples (Tensor) : N x C x H x W training images (c.f collect_samples)
+        batch_size (int) : batch size of the test (the one used for training)
+        MLP (nn.Module) : MI estimator for InfoMAX VAE, its lr is lr x lr_ratio
+        smoothing (float) : exponential moving average of the loss (with bias correction)
+
+    Return a pandas DataFrame : lr, loss, smoothed_loss
+    '''
+    optimizer_kwargs = optimizer_kwargs if optimizer_kwargs is not None else {'betas':(0.9, 0.999)}
+    model, critic, optimizers = _copies(VAE, MLP, start_lr, lr_ratio, optimizer_class, optimizer_kwargs)
+    if train_on_gpu:
+        samples = samples.cuda()
+    gamma = (end_lr / start_lr) ** (1. / max(num_iter-1, 1))
+
+    rows, average, best = [], 0., np.inf
+    for i in range(num_iter):
+        lr = start_lr * gamma**i
+        optimizers[0].param_groups[0]['lr'] = lr
+        if critic is not None:
+            optimizers[1].param_groups[0]['lr'] = lr * lr_ratio
+        data = samples[torch.randperm(len(samples), device=samples.device)[:batch_size]]
+        loss = _step(model, critic, optimizers, data)
+
+        average = smoothing * average + (1-smoothing) * loss
+        smoothed = average / (1 - smoothing**(i+1))
+        rows.append({'lr':lr, 'loss':loss, 'smoothed_loss':smoothed})
+        if not np.isfinite(smoothed) or (i > 0 and smoothed > diverge_factor * best):
+            break
+        best = min(best, smoothed)
+    return pd.DataFrame(rows)
+
+
+def recommend_lr(lr_curve):
+    '''lr of the minimum smoothed loss / 10, and the lr of the steepest decrease of the smoothed loss'''
+    curve = lr_curve[np.isfinite(lr_curve['smoothed_loss'])]
+    lr_min_loss = curve['lr'].iloc[int(np.argmin(curve['smoothed_loss'].values))]
+    slopes = np.gradient(curve['smoothed_loss'].values, np.log10(curve['lr'].values))
+    lr_steepest = curve['lr'].iloc[int(np.argmin(slopes))]
+    return lr_min_loss / 10., lr_steepest
+
+
+###############################
+#### Autotune #################
+###############################
+
+def autotune(VAE, train_loader, MLP=None, memory_budget_mb=None, batch_sizes=None, tolerance=0.1, lr_ratio=5.,
+             num_iter=100, n_samples=1024, train_on_gpu=False, save_path=None):
+    '''
+    Recommended batch size and learning rate(s) for the training of VAE (and MLP for InfoMAX VAE)
+
+    Params :
+        VAE (nn.Module) : VAE to train (not modified)
+        train_loader (DataLoader) : training DataLoader, only used to draw n_samples images
+        MLP (nn.Module) : MI estimator for InfoMAX VAE, None for a standard VAE
+        memory_budget_mb (float) : maximum training memory (None : no limit)
+        batch_sizes (list of int) : batch sizes to probe (default : powers of 2 from 8 to n_samples)
+        tolerance (float) : c.f recommend_batch_size
+        lr_ratio (float) : lr of the MI estimator / lr of the VAE (0.0005 / 0.0001 in InfoMAX_VAE_framework.py)
+        num_iter (int) : steps of the LR range test
+        n_samples (int) : number of training images used by the probes
+        save_path (string) : If given, the recommended configuration is written to this json file
+
+    Return the recommended configuration (dict), the batch size probe (DataFrame) and the lr curve (DataFrame)
+    '''
+    start = timer()
+    samples = collect_samples(train_loader, max(n_samples, max(batch_sizes) if batch_sizes else 0))
+    batch_table = probe_batch_sizes(VAE, samples, MLP, batch_sizes, memory_budget_mb, lr_ratio=lr_ratio, train_on_gpu=train_on_gpu)
+    try:
+        batch_size = recommend_batch_size(batch_table, tolerance)
+    except ValueError as e:
+        print(f'Autotune failed : {e}')
+        if len(batch_table):
+            print(batch_table.to_string(index=False))
+        raise
+    lr_curve = lr_range_test(VAE, samples, batch_size, MLP, num_iter=num_iter, lr_ratio=lr_ratio, train_on_gpu=train_on_gpu)
+    lr, lr_steepest = recommend_lr(lr_curve)
+    if lr_curve['smoothed_loss'].iloc[-1] <= lr_curve['smoothed_loss'].min():
+        print('Warning : the loss did not diverge during the LR range test, the recommended lr may be too low (increase num_iter)')
+
+    chosen = batch_table[batch_table['batch_size'] == batch_size].iloc[0]
+    config = {
+        'batch_size' : batch_size,
+        'samples_per_s' : float(chosen['samples_per_s']),
+        'memory_mb' : float(chosen['memory_mb']),
+        'lr' : float(lr),
+        'lr_steepest' : float(lr_steepest),
+    }
+    if MLP is not None:
+        config['lr_MLP'] = float(lr * lr_ratio)
+    print(f'Recommended configuration ({timer() - start:.1f} seconds of probing) : {config}')
+    if save_path is not None:
+        with open(save_path, 'w') as f:
+            json.dump(config, f, indent=2)
+    return config, batch_table, lr_curve
+
+
+if __name__ == '__main__':
+    from models.networks import VAE as Vanilla_VAE
+    from models.infoMAX_VAE import CNN_VAE, MLP_MI_estimator, Conv_MI_estimator
+    from util.data_processing import get_train_val_dataloader
+
+    parser = argparse.ArgumentParser(description='Recommended batch size and learning rate for a VAE / InfoMAX VAE training')
+    parser.add_argument('--data', required=True, help='Folder containing the dataset (one subfolder per class)')
+    parser.add_argument('--infomax', action='store_true', help='Tune an InfoMAX VAE (CNN_VAE + MI estimator) instead of a VAE')
+    parser.add_argument('--conv_critic', action='store_true', help='Use Conv_MI_estimator instead of MLP_MI_estimator')
+    parser.add_argument('--input_size', type=int, default=64)
+    parser.add_argument('--input_channels', type=int, default=3)
+    parser.add_argument('--memory_budget_mb', type=float, default=None)
+    parser.add_argument('--n_samples', type=int, default=1024)
+    parser.add_argument('--out', default=None, help='json file for the recommended configuration')
+    args = parser.parse_args()
+
+    train_on_gpu = cuda.is_available()
+    train_loader, _ = get_train_val_dataloader(args.data,args.input_size,64,test_split=0.15)
+    MLP = None
+    if args.infomax:
+        model = CNN_VAE(zdim=3,input_channels=args.input_channels, alpha=20, beta=1, base_enc=64, base_dec=64)
+        if args.conv_critic:
+            MLP = Conv_MI_estimator(args.input_channels,args.input_size,zdim=3)
+        else:
+            MLP = MLP_MI_estimator(args.input_size*args.input_size*args.input_channels,zdim=3)
+    else:
+        model = Vanilla_VAE(zdim=3,input_channels=args.input_channels, beta=1, base_enc=32, base_dec=32, depth_factor_dec=2)
+    if train_on_gpu:
+        model = model.cuda()
+        MLP = MLP.cuda() if MLP is not None else None
+
+    autotune(model, train_loader, MLP=MLP, memory_budget_mb=args.memory_budget_mb, n_samples=args.n_samples,
+        train_on_gpu=train_on_gpu, save_path=args.out)
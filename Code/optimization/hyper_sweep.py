@@ -0,0 +1,354 @@
+# @Author: Sacha Haidinger <sachahai>
+# @Date:   2026-10-18T10:00:00+10:00
+# @Email:  sacha.haidinger@epfl.ch
+# @Project: Learning methods for Cell Profiling
+# @Last modified by:   sachahai
+# @Last modified time: 2026-10-18T10:00:00+10:00
+
+'''
+Hyperparameter sweep of InfoMAX VAE (e.g a grid over alpha and beta), with many configurations
+trained concurrently in a pool of processes.
+
+- The dataset is loaded and preprocessed (zero padding / rescaling) ONCE, stored as a float16
+  tensor in shared memory, and read by all the processes of the pool (no copy, no image decoding
+  per trial). Data augmentation (random 90 degrees rotations and flips) is done on the tensors.
+- Trials are early terminated with successive halving : ASHA (asynchronous, default) or
+  synchronous successive halving, ranked on the validation ELBO (recon + KL, without the beta and
+  alpha weighting, so that configurations with different alpha / beta can be compared).
+- The state of each trial is saved between two rungs (util/checkpoint.py) : a promoted trial is
+  resumed exactly where it stopped, by any process of the pool.
+- A consolidated table (one row per trial : config, rung reached, validation ELBO, timings) is
+  written to 'sweep_results.csv', and all the training histories to 'sweep_history.csv'.
+
+Usage (from the Code folder) :
+    python -m optimization.hyper_sweep --data ../DataSets/Synthetic_Data_1 --alpha 1 10 20 50 --beta 1 5 10 --workers 8
+'''
+
+import os
+import argparse
+import itertools
+import contextlib
+from timeit import default_timer as timer
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.multiprocessing as mp
+import torch.optim as optim
+from torch.utils.data import Dataset, DataLoader
+from torch.utils.data.sampler import SubsetRandomSampler
+from torchvision import datasets, transforms
+from sklearn.model_selection import train_test_split
+
+from models.infoMAX_VAE import CNN_VAE, MLP_MI_estimator, Conv_MI_estimator
+from models.train_net import train_infoM_epoch, test_infoM_epoch
+from util.checkpoint import save_checkpoint, load_checkpoint
+from util.data_processing import load_from_path, zPad_or_Rescale, Double_to_Float
+from util.packed_store import Packed_Dataset, is_packed_store
+
+#Values of the hyperparameters that are not swept
+DEFAULT_CONFIG = {
+    'zdim' : 3,
+    'alpha' : 20,
+    'beta' : 1,
+    'base_enc' : 64,
+    'base_dec' : 64,
+    'critic' : 'mlp', #'mlp' (MLP_MI_estimator) or 'conv' (Conv_MI_estimator)
+    'lr' : 0.0001,
+    'lr_MLP' : 0.0005,
+    'batch_size' : 32,
+}
+
+
+def make_grid(**grid):
+    '''Cartesian product of hyperparameter values, e.g make_grid(alpha=[1,20], beta=[1,10])
+    returns 4 configs. Hyperparameters not given take their value in DEFAULT_CONFIG'''
+    names = list(grid.keys())
+    return [dict(DEFAULT_CONFIG, **dict(zip(names, values))) for values in itertools.product(*grid.values())]
+
+
+###############################
+#### Shared dataset ###########
+###############################
+
+def load_shared_dataset(root_dir, input_size, test_split=0.2, seed=0, batchsize=256):
+    '''
+    Load and preprocess the whole dataset once, in shared memory
+
+    Params :
+        root_dir (string) : path to the folder containing the dataset (one subfolder per class), or a packed store
+        input_size (int) : imgs will all be input_size x input_size (rescale or pad)
+        test_split (float) : Proportion of sample (0-1) that will be part of validation set
+        seed (int) : random state of the stratified split
+
+    Return images (N x C x input_size x input_size float16 tensor, values 0-1), labels (N int64 tensor),
+    train_idx and valid_idx (index arrays)
+    '''
+    trsfm = transforms.Compose([zPad_or_Rescale(input_size), transforms.ToTensor(), Double_to_Float()])
+    if is_packed_store(root_dir):
+        dataset = Packed_Dataset(root_dir, transform=trsfm)
+    else:
+        dataset = datasets.DatasetFolder(root=root_dir,loader=load_from_path(),extensions=('.png','.jpg','.tif','.tiff'), transform=trsfm)
+    loader = DataLoader(dataset, batch_size=batchsize, shuffle=False)
+    #float16 halves the memory, and keeps 8 bits images exact (step 2^-11 < 1/255 in 0-1)
+    images = torch.cat([data.half() for data, _ in loader], dim=0)
+    labels = torch.as_tensor(dataset.targets, dtype=torch.int64)
+
+    train_idx, valid_idx = train_test_split(np.arange(len(labels)), test_size=test_split, shuffle=True,
+        stratify=dataset.targets, random_state=seed)
+
+    images.share_memory_()
+    labels.share_memory_()
+    return images, labels, train_idx, valid_idx
+
+
+class Shared_Image_Dataset(Dataset):
+    '''Dataset on the preprocessed images tensor (c.f load_shared_dataset).
+    If augment, images are randomly rotated by 90 degrees and flipped, as in image_tranforms()
+    (the small random rotations are not applied, they need an interpolation per image)'''
+    def __init__(self, images, labels, augment=False):
+        self.images = images
+        self.labels = labels
+        self.augment = augment
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, idx):
+        image = self.images[idx].float()
+        if self.augment:
+            if torch.rand(1).item() < 0.5:
+                image = torch.rot90(image, 1, dims=(1,2))
+            if torch.rand(1).item() < 0.5:
+                image = torch.flip(image, dims=(1,))
+            if torch.rand(1).item() < 0.5:
+                image = torch.flip(image, dims=(2,))
+        return image, self.labels[idx]
+
+
+###############################
+#### Successive Halving #######
+###############################
+
+class ASHA_Scheduler(object):
+    '''
+    Successive halving on a fixed list of trials. Trials are trained up to the first rung
+    (min_epochs), and only the best 1/eta of the trials of a rung are promoted to the next one,
+    which trains them eta times longer : rungs at min_epochs x eta^k epochs, and max_epochs.
+
+    Asynchronous (ASHA, Li et al. 2018) : a trial is promoted as soon as it is in the top 1/eta
+    of the trials that reached its rung so far, so that workers never wait for the slowest trial.
+    Synchronous : a rung is only promoted when all the trials sent to it have been evaluated.
+
+    Params :
+        n_trials (int) : number of configurations
+        min_epochs (int) : epochs of the first rung
+        max_epochs (int) : epochs of the last rung
+        eta (int) : reduction factor
+        synchronous (boolean) : synchronous successive halving instead of ASHA
+    '''
+    def __init__(self, n_trials, min_epochs=2, max_epochs=40, eta=3, synchronous=False):
+        self.n_trials = n_trials
+        self.eta = eta
+        self.synchronous = synchronous
+        self.rungs = []
+        epochs = min_epochs
+        while epochs < max_epochs:
+            self.rungs.append(epochs)
+            epochs *= eta
+        self.rungs.append(max_epochs)
+
+        self.scores = [{} for _ in self.rungs] #rung -> {trial : validation ELBO}
+        self.promoted = [set() for _ in self.rungs]
+        self.next_trial = 0
+
+    def next_job(self):
+        '''Return (trial, rung) : train 'trial' up to self.rungs[rung] epochs,
+        or None if nothing can be started until a running job reports'''
+        for k in reversed(range(len(self.rungs)-1)):
+            if self.synchronous and len(self.scores[k]) < self.n_trials // self.eta**k: #Rung not complete
+                continue
+            ranking = sorted(self.scores[k], key=lambda t: self._key(self.scores[k][t]))
+            for trial in ranking[:len(ranking)//self.eta]:
+                if trial not in self.promoted[k]:
+                    self.promoted[k].add(trial)
+                    return trial, k+1
+        if self.next_trial < self.n_trials:
+            self.next_trial += 1
+            return self.next_trial-1, 0
+        return None
+
+    def report(self, trial, rung, score):
+        self.scores[rung][trial] = score
+
+    @staticmethod
+    def _key(score):
+        return score if np.isfinite(score) else np.inf #Diverged trials are ranked last
+
+
+###############################
+#### Trials ###################
+###############################
+
+_shared = {} #Set in each process of the pool by _init_worker
+
+def _init_worker(images, labels, train_idx, valid_idx, input_size, input_channels, threads):
+    torch.set_num_threads(threads)
+    _shared.update(images=images, labels=labels, train_idx=train_idx, valid_idx=valid_idx,
+        input_size=input_size, input_channels=input_channels)
+
+
+def build_trial(config, input_size, input_channels):
+    '''InfoMAX VAE, MI estimator, their optimizers and lr schedulers for a config'''
+    VAE = CNN_VAE(zdim=config['zdim'], input_channels=input_channels, alpha=config['alpha'], beta=config['beta'],
+        base_enc=config['base_enc'], base_dec=config['base_dec'])
+    if config['critic'] == 'conv':
+        MLP = Conv_MI_estimator(input_channels,input_size,zdim=config['zdim'])
+    else:
+        MLP = MLP_MI_estimator(input_size*input_size*input_channels,zdim=config['zdim'])
+    opti_VAE = optim.Adam(VAE.parameters(), lr=config['lr'], betas=(0.9, 0.999))
+    opti_MLP = optim.Adam(MLP.parameters(), lr=config['lr_MLP'], betas=(0.9, 0.999))
+    lr_schedul_VAE = torch.optim.lr_scheduler.StepLR(optimizer=opti_VAE, step_size=40, gamma=0.6)
+    lr_schedul_MLP = torch.optim.lr_scheduler.StepLR(optimizer=opti_MLP, step_size=40, gamma=0.6)
+    return {'VAE':VAE,'MLP':MLP}, {'VAE':opti_VAE,'MLP':opti_MLP}, {'VAE':lr_schedul_VAE,'MLP':lr_schedul_MLP}
+
+
+def _train_trial(trial, config, end_epoch, sweep_dir, seed):
+    '''Run in a process of the pool : train a trial up to 'end_epoch', resuming from its
+    checkpoint if it was already trained up to a previous rung'''
+    start = timer()
+    path = os.path.join(sweep_dir, f'trial_{trial}.pth')
+    input_size, input_channels = _shared['input_size'], _shared['input_channels']
+    torch.manual_seed(seed + trial)
+    np.random.seed(seed + trial)
+    models, optimizers, schedulers = build_trial(config, input_size, input_channels)
+    epoch, history = 0, []
+    if os.path.exists(path):
+        state = load_checkpoint(path, models=models, optimizers=optimizers, schedulers=schedulers)
+        epoch, history = state['epoch'], state['history']
+
+    train_loader = DataLoader(Shared_Image_Dataset(_shared['images'],_shared['labels'],augment=True),
+        batch_size=config['batch_size'], sampler=SubsetRandomSampler(_shared['train_idx']), drop_last=True)
+    valid_loader = DataLoader(Shared_Image_Dataset(_shared['images'],_shared['labels']),
+        batch_size=config['batch_size'], sampler=SubsetRandomSampler(_shared['valid_idx']), drop_last=True)
+
+    VAE, MLP = models['VAE'], models['MLP']
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull): #Progress prints of all the trials would mix
+        for epoch in range(epoch+1, end_epoch+1):
+            global_VAE_loss, MI_estimation, _, kl_loss, recon_loss = train_infoM_epoch(epoch, VAE, MLP, optimizers['VAE'], optimizers['MLP'], train_loader)
+            global_VAE_loss_val, MI_estimation_val, _, kl_loss_val, recon_loss_val = test_infoM_epoch(epoch, VAE, MLP, optimizers['VAE'], optimizers['MLP'], valid_loader)
+            for scheduler in schedulers.values():
+                scheduler.step()
+            history.append({'trial':trial, 'epoch':epoch, 'global_VAE_loss':global_VAE_loss, 'MI_estimation':MI_estimation,
+                'kl_loss':kl_loss, 'recon_loss':recon_loss, 'global_VAE_loss_val':global_VAE_loss_val,
+                'MI_estimation_val':MI_estimation_val, 'kl_loss_val':kl_loss_val, 'recon_loss_val':recon_loss_val,
+                'ELBO_val':recon_loss_val + kl_loss_val})
+    save_checkpoint(path, end_epoch, models, optimizers, schedulers, history=history, extra={'config':config})
+
+    return {'trial':trial, 'epoch':end_epoch, 'ELBO_val':history[-1]['ELBO_val'], 'seconds':timer() - start,
+        'history':history}
+
+
+###############################
+#### Sweep ####################
+###############################
+
+def run_sweep(root_dir, configs, sweep_dir, input_size=64, input_channels=3, min_epochs=2, max_epochs=40, eta=3,
+              synchronous=False, n_workers=4, threads_per_worker=1, test_split=0.2, seed=0):
+    '''
+    Train InfoMAX VAE configurations concurrently with successive halving early termination
+
+    Params :
+        root_dir (string) : path to the folder containing the dataset
+        configs (list of dict) : configurations to try (c.f make_grid and DEFAULT_CONFIG)
+        sweep_dir (string) : folder where trial checkpoints and results tables are written
+        input_size, input_channels (int) : image size and number of channels
+        min_epochs, max_epochs, eta, synchronous : successive halving schedule (c.f ASHA_Scheduler)
+        n_workers (int) : number of trials trained at the same time (processes)
+        threads_per_worker (int) : torch threads of each process
+        test_split (float) : Proportion of the dataset used for validation
+        seed (int) : random state of the split and of the trials initialization
+
+    Return the results table (pandas DataFrame, one row per trial, best validation ELBO first)
+    '''
+    os.makedirs(sweep_dir, exist_ok=True)
+    sweep_start = timer()
+    images, labels, train_idx, valid_idx = load_shared_dataset(root_dir, input_size, test_split, seed)
+    assert images.size(1) == input_channels, f'Images have {images.size(1)} channels, not {input_channels}'
+    print(f'{len(labels)} images loaded in shared memory ({images.element_size()*images.nelement()/1e6:.1f} MB) in {timer()-sweep_start:.2f} seconds')
+
+    scheduler = ASHA_Scheduler(len(configs), min_epochs, max_epochs, eta, synchronous)
+    print(f'{len(configs)} trials, rungs at {scheduler.rungs} epochs, {n_workers} workers')
+    results = [{'trial':i, **config, 'rung':None, 'epochs':0, 'ELBO_val':np.nan, 'train_seconds':0., 'jobs':0,
+        'start_s':None, 'end_s':None} for i, config in enumerate(configs)]
+    histories = {}
+
+    #spawn : no fork of a process running torch threads. Shared tensors are passed once per process
+    executor = ProcessPoolExecutor(max_workers=n_workers, mp_context=mp.get_context('spawn'), initializer=_init_worker,
+        initargs=(images, labels, train_idx, valid_idx, input_size, input_channels, threads_per_worker))
+    running = {}
+    try:
+        while True:
+            while len(running) < n_workers:
+                job = scheduler.next_job()
+                if job is None:
+                    break
+                trial, rung = job
+                if results[trial]['start_s'] is None:
+                    results[trial]['start_s'] = timer() - sweep_start
+                future = executor.submit(_train_trial, trial, configs[trial], scheduler.rungs[rung], sweep_dir, seed)
+                running[future] = (trial, rung)
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                trial, rung = running.pop(future)
+                output = future.result()
+                scheduler.report(trial, rung, output['ELBO_val'])
+                histories[trial] = output['history']
+                results[trial].update(rung=rung, epochs=output['epoch'], ELBO_val=output['ELBO_val'],
+                    end_s=timer() - sweep_start)
+                results[trial]['train_seconds'] += output['seconds']
+                results[trial]['jobs'] += 1
+                print(f"Trial {trial} : rung {rung} ({output['epoch']} epochs), validation ELBO {output['ELBO_val']:.2f}, {output['seconds']:.1f} s")
+    finally:
+        for future in running:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+    results = pd.DataFrame(results)
+    results['completed'] = results['epochs'] == max_epochs
+    results['seconds_per_epoch'] = results['train_seconds'] / results['epochs'].clip(lower=1)
+    results = results.sort_values(['epochs','ELBO_val'], ascending=[False,True]).reset_index(drop=True)
+    results.to_csv(os.path.join(sweep_dir,'sweep_results.csv'), index=False)
+    pd.DataFrame([row for trial in sorted(histories) for row in histories[trial]]).to_csv(os.path.join(sweep_dir,'sweep_history.csv'), index=False)
+
+    total_time = timer() - sweep_start
+    print(f'{total_time:.2f} total seconds elapsed, {results["train_seconds"].sum():.2f} seconds of training, {int(results["epochs"].sum())} epochs trained (vs {len(configs)*max_epochs} without early termination)')
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Concurrent InfoMAX VAE hyperparameter sweep with successive halving')
+    parser.add_argument('--data', required=True, help='Folder containing the dataset (one subfolder per class)')
+    parser.add_argument('--alpha', type=float, nargs='+', default=[DEFAULT_CONFIG['alpha']])
+    parser.add_argument('--beta', type=float, nargs='+', default=[DEFAULT_CONFIG['beta']])
+    parser.add_argument('--critic', choices=['mlp','conv'], default=DEFAULT_CONFIG['critic'])
+    parser.add_argument('--input_size', type=int, default=64)
+    parser.add_argument('--input_channels', type=int, default=3)
+    parser.add_argument('--batch_size', type=int, default=DEFAULT_CONFIG['batch_size'])
+    parser.add_argument('--min_epochs', type=int, default=2)
+    parser.add_argument('--max_epochs', type=int, default=40)
+    parser.add_argument('--eta', type=int, default=3)
+    parser.add_argument('--synchronous', action='store_true', help='Synchronous successive halving instead of ASHA')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=1, help='Torch threads per worker')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default='sweep')
+    args = parser.parse_args()
+
+    configs = make_grid(alpha=args.alpha, beta=args.beta, critic=[args.critic], batch_size=[args.batch_size])
+    run_sweep(args.data, configs, args.out, input_size=args.input_size, input_channels=args.input_channels,
+        min_epochs=args.min_epochs, max_epochs=args.max_epochs, eta=args.eta, synchronous=args.synchronous,
+        n_workers=args.workers, threads_per_worker=args.threads, seed=args.seed)
@@ -19,6 +19,7 @@ from torch import nn
 from torch.nn import functional as F
 from torch.nn.init import xavier_normal_
 from util.data_processing import get_inference_dataset
+from models.nn_modules import Patch_Conv_stem
 import torch.optim as optim
 import pandas as pd
 import numpy as np
@@ -69,6 +70,35 @@ class MINE(nn.Module):
         return scores #Each element i,j is a scalar in R. f(xi,proj_j)
 
 
+#Same critic, with a light strided conv stem on the images instead of a MLP on flattened pixels
+class Conv_MINE(nn.Module):
+    def __init__(self,input_channels,input_size,zdim=3,base=16):
+        super(Conv_MINE, self).__init__()
+
+        self.input_channels = input_channels
+        self.input_size = input_size
+        self.zdim = zdim
+        self.moving_average = None
+
+        self.MLP_g = Patch_Conv_stem(input_channels,input_size,base=base,out_dim=32)
+        self.MLP_h = nn.Sequential(
+            nn.Linear(zdim, 256),
+            nn.ReLU(),
+            nn.Linear(256, 256),
+            nn.ReLU(),
+            nn.Linear(256, 32),
+        )
+
+    def forward(self, x, z):
+        x = x.view(-1,self.input_channels,self.input_size,self.input_size)
+        z = z.view(-1,self.zdim)
+        x_g = self.MLP_g(x) #Batchsize x 32
+        y_h = self.MLP_h(z) #Batchsize x 32
+        scores = torch.matmul(y_h,torch.transpose(x_g,0,1))
+
+        return scores #Each element i,j is a scalar in R. f(xi,proj_j)
+
+
 #Small MLP to compute the baseline
 class baseline_MLP(nn.Module):
     def __init__(self,input_dim):
@@ -111,8 +141,7 @@ def infoNCE_bound(scores):
 
 def tuba_lower_bound(scores, log_baseline=None):
     if log_baseline is not None:
-        scores -= log_baseline[:,None]
-    batch_size = torch.tensor(scores.size()[0],dtype=torch.float32)
+        scores = scores - log_baseline[:,None]
     joint_term= torch.mean(torch.diag(scores))
     marg_term=torch.exp(reduce_logmeanexp_nodiag(scores))
     return 1. + joint_term - marg_term
@@ -139,7 +168,7 @@ def interp_bound(scores, baseline, alpha_logit):
     nce_baseline = compute_log_loomean(scores)
 
     interpolated_baseline = log_interpolate(nce_baseline,
-        baseline[:,None].repeat(1,batch_size), alpha_logit) #Interpolate NCE baseline with a learnt baseline
+        baseline[:,None].expand(-1,batch_size), alpha_logit) #Interpolate NCE baseline with a learnt baseline
 
     #Marginal distribution term
     critic_marg = scores - torch.diag(interpolated_baseline)[:,None]  #None is equivalent to newaxis
@@ -155,19 +184,23 @@ def log_interpolate(log_a, log_b, alpha_logit):
     '''Numerically stable implmentation of log(alpha * a + (1-alpha) *b)
     Compute the log baseline for the interpolated bound
     baseline is a(y)'''
-    log_alpha = -F.softplus(torch.tensor(-alpha_logit).cuda())
-    log_1_minus_alpha = -F.softplus(torch.tensor(alpha_logit).cuda())
-    y = torch.logsumexp( torch.stack((log_alpha + log_a, log_1_minus_alpha + log_b)), dim=0)
-    return y
+    log_alpha, log_1_minus_alpha = log_alpha_weights(alpha_logit)
+    return torch.logaddexp(log_alpha + log_a, log_1_minus_alpha + log_b)
+
+def log_alpha_weights(alpha_logit):
+    '''log(sigmoid(alpha_logit)) and log(1-sigmoid(alpha_logit)), as python floats
+    Stable implementation of -softplus(-alpha_logit) and -softplus(alpha_logit)'''
+    alpha_logit = float(alpha_logit)
+    log_alpha = -(max(-alpha_logit,0.) + math.log1p(math.exp(-abs(alpha_logit))))
+    log_1_minus_alpha = -(max(alpha_logit,0.) + math.log1p(math.exp(-abs(alpha_logit))))
+    return log_alpha, log_1_minus_alpha
 
 def compute_log_loomean(scores):
     '''Compute the log leave one out mean of the exponentiated scores'''
     max_scores, _ = torch.max(scores, dim=1,keepdim=True)
     lse_minus_max = torch.logsumexp(scores-max_scores,dim=1,keepdim=True)
     d = lse_minus_max + (max_scores - scores)
-    d_not_ok = torch.eq(d, 0.)
-    d_ok = ~d_not_ok
-    safe_d = torch.where(d_ok, d, torch.ones_like(d).cuda()) #Replace zeros by 1 in d
+    safe_d = d.masked_fill(d == 0., 1.) #Replace zeros by 1 in d
 
     loo_lse = scores + (safe_d + torch.log(-torch.expm1(-safe_d))) #Stable implementation of sotfplus_inverse
     loo_lme = loo_lse - np.log(scores.size()[1] - 1.)
@@ -175,9 +208,92 @@ def compute_log_loomean(scores):
 
 def reduce_logmeanexp_nodiag(x, axis=None):
     batch_size = x.size()[0]
-    logsumexp = torch.logsumexp(x - torch.diag(np.inf * torch.ones(batch_size).cuda()),dim=[0,1])
+    inf_diag = torch.diag(x.new_full((batch_size,),np.inf))
+    logsumexp = torch.logsumexp(x - inf_diag,dim=[0,1])
     num_elem = batch_size * (batch_size - 1.)
-    return logsumexp - torch.log(torch.tensor(num_elem).cuda())
+    return logsumexp - np.log(num_elem)
+
+
+#####################################
+##### Bounds as nn.Module ###########
+#####################################
+
+### Same bounds as above, for the training loop of MINE. Constant tensors (inf diagonal
+### mask, normalization constants) are built once per (batch_size, device, dtype) and
+### reused, instead of being allocated and sent to the device for every batch.
+class MI_Bound(nn.Module):
+    '''Parent class of the bounds. Cache the diagonal mask and normalization constants'''
+    def __init__(self):
+        super(MI_Bound, self).__init__()
+        self._constants = {}
+
+    def constants(self, scores):
+        batch_size = scores.size(0)
+        key = (batch_size, scores.device, scores.dtype)
+        if key not in self._constants:
+            inf_diag = torch.diag(torch.full((batch_size,),np.inf,device=scores.device,dtype=scores.dtype))
+            self._constants[key] = {
+                'inf_diag' : inf_diag,
+                'log_k' : math.log(batch_size),
+                'log_num_elem' : math.log(batch_size * (batch_size - 1.)),
+                'log_k_minus_1' : math.log(batch_size - 1.)
+            }
+        return self._constants[key]
+
+    def logmeanexp_nodiag(self, x):
+        cst = self.constants(x)
+        return torch.logsumexp(x - cst['inf_diag'],dim=[0,1]) - cst['log_num_elem']
+
+
+class InfoNCE_Bound(MI_Bound):
+    '''Bound from Van Den Oord and al. (2018)'''
+    def forward(self, scores):
+        nll = torch.mean( torch.diag(scores) - torch.logsumexp(scores,dim=1))
+        return self.constants(scores)['log_k'] + nll
+
+
+class NWJ_Bound(MI_Bound):
+    '''NWJ (Mine-f) bound, i.e TUBA bound with a constant baseline of e'''
+    def forward(self, scores, log_baseline=None):
+        scores = scores - 1.
+        if log_baseline is not None:
+            scores = scores - log_baseline[:,None]
+        joint_term = torch.mean(torch.diag(scores))
+        marg_term = torch.exp(self.logmeanexp_nodiag(scores))
+        return 1. + joint_term - marg_term
+
+
+class Interpolated_Bound(MI_Bound):
+    '''Interpolated bound of Ben Poole and al. (c.f interp_bound())
+    alpha_logit is fixed at construction, log(alpha) and log(1-alpha) are computed once'''
+    def __init__(self, alpha_logit=0.):
+        super(Interpolated_Bound, self).__init__()
+        self.alpha_logit = alpha_logit
+        self.log_alpha, self.log_1_minus_alpha = log_alpha_weights(alpha_logit)
+
+    def forward(self, scores, baseline):
+        cst = self.constants(scores)
+        batch_size = scores.size(0)
+
+        #Log leave one out mean of the exponentiated scores (NCE baseline)
+        max_scores, _ = torch.max(scores, dim=1,keepdim=True)
+        lse_minus_max = torch.logsumexp(scores-max_scores,dim=1,keepdim=True)
+        d = lse_minus_max + (max_scores - scores)
+        safe_d = d.masked_fill(d == 0., 1.)
+        nce_baseline = scores + (safe_d + torch.log(-torch.expm1(-safe_d))) - cst['log_k_minus_1']
+
+        #Interpolate NCE baseline with a learnt baseline
+        interpolated_baseline = torch.logaddexp(self.log_alpha + nce_baseline,
+            self.log_1_minus_alpha + baseline[:,None].expand(-1,batch_size))
+
+        #Marginal distribution term
+        critic_marg = scores - torch.diag(interpolated_baseline)[:,None]
+        marg_term = torch.exp(self.logmeanexp_nodiag(critic_marg))
+
+        #Joint distribution term
+        critic_joint = torch.diag(scores)[:,None] - interpolated_baseline
+        joint_term = (torch.sum(critic_joint) - torch.trace(critic_joint)) / (batch_size * (batch_size - 1.))
+        return 1 + joint_term - marg_term
 
 
 #####################################
@@ -219,6 +335,15 @@ def train_MINE(MINE,path_to_csv,low_dim_names,epochs,infer_dataloader,bound_type
         assert baseline!=None, "please provide a valid NN to represent the baseline a(y)"
         optimizer = optim.Adam(list(MINE.parameters())+list(baseline.parameters()),lr=0.0005)
 
+    if bound_type=='infoNCE': #Constant Baseline
+        bound = InfoNCE_Bound()
+    elif bound_type=='NWJ': #Constant Baseline
+        bound = NWJ_Bound()
+    elif bound_type=='interpolated': #Learnt Baseline
+        bound = Interpolated_Bound(alpha_logit) # sigmoid(-5) = 0.01, that correspond to an alpha of 0.01
+    else:
+        assert False, "Please give a valid bound_type, 'infoNCE', 'NWJ' or 'interpolated'"
+
     decayRate = 0.2
     #lr_scheduler = torch.optim.lr_scheduler.StepLR(optimizer=optimizer, step_size=80, gamma=decayRate)
 
@@ -250,29 +375,19 @@ def train_MINE(MINE,path_to_csv,low_dim_names,epochs,infer_dataloader,bound_type
             batch_latentCode = [list(code) for code in zip(batch_info[low_dim_names[0]],batch_info[low_dim_names[1]],batch_info[low_dim_names[2]])]
             batch_latentCode = torch.from_numpy(np.array(batch_latentCode)).float().cuda()
 
-            MI_loss = None
-            if bound_type=='infoNCE': #Constant Baseline
-                scores = MINE(data,batch_latentCode)
-                MI_xz = infoNCE_bound(scores)
-                MI_loss = -MI_xz
-            elif bound_type=='NWJ': #Constant Baseline
-                scores=MINE(data,batch_latentCode)
-                MI_xz = nwj_bound(scores)
-                MI_loss= -MI_xz
-            elif bound_type=='interpolated': #Learnt Baseline
-                scores = MINE(data,batch_latentCode)
+            scores = MINE(data,batch_latentCode)
+            if bound_type=='interpolated':
                 log_baseline = torch.squeeze(baseline(batch_latentCode))
-                alpha_logit = alpha_logit # sigmoid(-5) = 0.01, that correspond to an alpha of 0.01
-                MI_xz = interp_bound(scores, log_baseline, alpha_logit)
-                MI_loss = -MI_xz
+                MI_xz = bound(scores, log_baseline)
             else:
-                assert False, "Please give a valid bound_type, 'infoNCE', 'NWJ' or 'interpolated'"
+                MI_xz = bound(scores)
+            MI_loss = -MI_xz
 
             optimizer.zero_grad()
             MI_loss.backward()
             optimizer.step()
 
-            MI_epoch += MI_xz
+            MI_epoch += MI_xz.detach()
 
             if i % 2 == 0:
                 print('Train Epoch: {} [{}/{} ({:.0f}%)]\tMI: {:.6f}'.format(
@@ -296,7 +411,7 @@ def train_MINE(MINE,path_to_csv,low_dim_names,epochs,infer_dataloader,bound_type
 
 
 
-def compute_MI(data_csv,low_dim_names=['x_coord','y_coord','z_coord'],path_to_raw_data='DataSets/Synthetic_Data_1',save_path=None,batch_size=512,alpha_logit=-5.,bound_type='infoNCE',epochs=300):
+def compute_MI(data_csv,low_dim_names=['x_coord','y_coord','z_coord'],path_to_raw_data='DataSets/Synthetic_Data_1',save_path=None,batch_size=512,alpha_logit=-5.,bound_type='infoNCE',epochs=300,conv_critic=False):
     '''Compute MI (MINE framework) between input data and latent representation.
     Projection coordinates need to be store in the csv file under the columns 'low_dim_names'
     Raw data (image) are loaded by batch from 'path_to_raw_data'
@@ -310,6 +425,9 @@ def compute_MI(data_csv,low_dim_names=['x_coord','y_coord','z_coord'],path_to_ra
         -'NWJ' = Mine-f bound
         -'interpolated' Ben Poole implementation, with alpha = 0.01
         Guideline : Use NCE for representation learning, interpolated for MI estimation
+
+    conv_critic = If True, the critic uses a light strided conv stem (Conv_MINE) instead
+        of a MLP on the flattened pixels (MINE). Much faster, especially for large inputs
     '''
 
     batch_size = batch_size
@@ -317,7 +435,10 @@ def compute_MI(data_csv,low_dim_names=['x_coord','y_coord','z_coord'],path_to_ra
     epochs = epochs
     _, infer_dataloader = get_inference_dataset(path_to_raw_data,batch_size,input_size,shuffle=True,droplast=True)
 
-    MINEnet = MINE(input_size*input_size*3,zdim=3) #CHANGE DEPENDING ON DATASET ###########
+    if conv_critic:
+        MINEnet = Conv_MINE(3,input_size,zdim=3) #CHANGE DEPENDING ON DATASET ###########
+    else:
+        MINEnet = MINE(input_size*input_size*3,zdim=3) #CHANGE DEPENDING ON DATASET ###########
     MINEnet.cuda()
 
     baseline=None
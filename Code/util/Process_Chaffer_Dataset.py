@@ -29,94 +29,23 @@ import os
 import matplotlib.pyplot as plt
 import shutil
 
+from util.dataset_builder import Chaffer_Adapter, build_dataset
+
 #single cell png files
 single_cell_image_folder = 'DataSets/real_world_chaffer/per_channel_subset_sCells/'
 
 #CSV file with ground truth (GT_label, Unique_ID and CP info)
 GT_csv_read = 'DataSets/real_world_chaffer/200809_Chaffer ground truth clusters_SUBSET_Only_Embedding_Calculations.csv'
 GT_csv_save = 'DataSets/real_world_chaffer/MetaData3_Chaffer_GT_link_CP.csv'
-#SAVE ONLY COLUMN OF INTEREST
-GT_csv = pd.read_csv(GT_csv_read)
-umap_df = GT_csv.filter(regex='^UMAP',axis=1).filter(regex='[XYZ]$',axis=1)
-umap_cols = list(umap_df.columns)
-tsne_df = GT_csv.filter(regex='^RTSNE',axis=1).filter(regex='[XYZ]$',axis=1)
-tsne_cols = list(tsne_df.columns)
-misc_cols = ['Manual_Clusters','Cell_Condition_status','Unique_Cell_ID','PCA_X','PCA_Y','PCA_Z','row ID','Label','Source Labeling','Well_categ','Cell_Type_categ','CD44_Level_categ','CD104_Level_categ','Treatment_categ','Designation_categ','Cell_Number_categ']
-
 
+### Merge the 4 channels of each single cell in a tiff file, saved in the subfolder of its class,
+# and save the GT csv file (only columns of interest) with the Unique_ID and GT_label of the cells.
+# Cells whose channels are not in the same shape are ignored. c.f util/dataset_builder.py
+adapter = Chaffer_Adapter(single_cell_image_folder, GT_csv_read)
 
-GT_csv = pd.read_csv(GT_csv_read,usecols=umap_cols+tsne_cols+misc_cols)
-
-#Create DataFolder architecture
+#Cells already processed (manifest.csv in the folder) are skipped if run again
 save_folder = 'DataSets/Chaffer_Data/'
-list_folder = ['Class_'+str(i) for i in range(1,13)]
-for folder in list_folder:
-    saving_folder = f'{save_folder}{folder}'
-    if os.path.exists(saving_folder):
-        shutil.rmtree(saving_folder)
-    os.makedirs(saving_folder)
-
-
-### Add new needed column in GT csv file
-# Unique_ID : cell file name   ,  GT_label : # link to the class
-GT_csv['Unique_ID'] = np.nan
-GT_csv['GT_label'] = np.nan
-
-### Map class to a label number
-switcher_class_to_label = {
-    'HCC38HI_Not Specified_Not Specified_DHT_Not Specified': 1,
-    'HCC38LO_Not Specified_Not Specified_DMSO_Not Specified': 2,
-    'HMLER_Primed_Not Specified_DMSO_C2': 3,
-    'HMLER_HIGH_Positive_DMSO_E3': 4,
-    'HCC38LO_Not Specified_Not Specified_DHT_Not Specified': 5,
-    'HMLER_Primed_Not Specified_DHT_C2': 6,
-    'HMLER_HIGH_Positive_DHT_E3': 7,
-    'HCC38HI_Not Specified_Not Specified_DMSO_Not Specified': 8,
-    'HMLER_Primed_Not Specified_DMSO_C4': 9,
-    'HMLER_HIGH_Positive_DMSO_F11': 10,
-    'HMLER_Primed_Not Specified_DHT_C4': 11,
-    'HMLER_HIGH_Positive_DHT_F11': 12
-}
-
-GT_csv['Unique_Cell_ID'] = GT_csv['Unique_Cell_ID'].astype(str)
-GT_csv['Cell_Condition_status'] = GT_csv['Cell_Condition_status'].astype(str)
-
-#list all the single cell file name (from folder of one channel)
-all_single_cells = [f for f in os.listdir(single_cell_image_folder+'Phalloidin_images_mateched_to_subset_data/') if not f.startswith('.')]
-counter =0
-for cell_file_name in all_single_cells:
-
-    file_wo_ext = cell_file_name.split('.')[0]
-    file_name_save = file_wo_ext+'.tiff'
-
-    img_c1 = io.imread(single_cell_image_folder+'Phalloidin_images_mateched_to_subset_data/'+cell_file_name)
-    img_c2 = io.imread(single_cell_image_folder+'DAPI_images_mateched_to_subset_data/'+cell_file_name)
-    img_c3 = io.imread(single_cell_image_folder+'AR_images_mateched_to_subset_data/'+cell_file_name)
-    img_c4 = io.imread(single_cell_image_folder+'Zeb1_images_mateched_to_subset_data/'+cell_file_name)
-
-
-    if not(img_c1.shape==img_c2.shape==img_c3.shape==img_c4.shape):
-        counter+= 1
-        continue
-
-    final_img = np.stack([img_c1,img_c2,img_c3,img_c4],axis=-1)
-
-    row = GT_csv['Unique_Cell_ID']==file_wo_ext
-    idx = GT_csv.index[row]
-
-    manual_class = GT_csv[row].Cell_Condition_status.item()
-    class_num = switcher_class_to_label.get(manual_class)
-    GT_csv.loc[idx,'GT_label'] = class_num
-    GT_csv.loc[idx,'Unique_ID'] = file_name_save
-
-    save_to = save_folder+f'Class_{class_num}/'+file_name_save
-    io.imsave(save_to,final_img,plugin='tifffile')
-
-### more or less 50 GT single cells are not present in the png files folder.
-print(f'{counter} cells were NOT in the right shape format')
-GT_csv.dropna(subset=['GT_label'],inplace=True)
-GT_csv.to_csv(GT_csv_save,index=False)
-
+GT_csv = build_dataset(adapter, save_folder, GT_csv_save)
 
 #64 cells were not in the right format !!!
 
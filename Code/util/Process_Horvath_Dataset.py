@@ -30,6 +30,8 @@ import matplotlib.pyplot as plt
 
 from skimage import io
 
+from util.dataset_builder import Horvath_Adapter, build_dataset
+
 ### Path to CellProfiler Outputs
 path_to_CP = '../Data_Horvath/Horvath_Synth_Complex_Dataset/CellProfiler_Outputs/'
 CP_Quantitative_CSV = path_to_CP+'Quantitative_Outputs/200602_Horvath_Complex_AnalysisSplitCellBodies.csv'
@@ -59,122 +61,18 @@ ax.scatter(x.values,y.values,s=60,c='red',marker='X')
 ### Path to Peter Horvath Ground truth File
 GT_path = '../Data_Horvath/db11 - synthetic_peter_2 - Copy/'
 
-def closest_point(point,points):
-    points = np.asarray(points)
-    dist_2 = np.sum((points-point)**2, axis=1)
-    return np.argmin(dist_2), dist_2[np.argmin(dist_2)]
-
-# %%
-### Path to SAVING folder. Will contains 8 subfolders corresponding to the 8
-# discrete class of the dataset.
-
-save_folder = 'DataSets/Peter_Horvath_Data/'
-list_folder = ['Class_'+str(i) for i in range(1,7)] #Will consider ONLY Cluster 1 to 6
-for folder in list_folder:
-    saving_folder = f'{save_folder}{folder}'
-    if os.path.exists(saving_folder):
-        shutil.rmtree(saving_folder)
-    os.makedirs(saving_folder)
-
-#Future CSV file in which all metadata will be stored
-MetaData_GT_link_CP = pd.DataFrame(columns=['Plate','Well','GT_label','Unique_ID','GT_x','GT_y','CP_ImagerNumber','CP_ObjectNumber','CP_x','CP_y'])
-
 # %%
-all_plates_folder = [f for f in os.listdir(GT_path) if not f.startswith('.')]
-all_plates_folder.sort()
-
-#How many subfolder to process (Choose between 1 to 32) 32 lead to full datasize (300'000 cells)
+### Link each GT cell to the closest CellProfiler centroid, and save one RGB tiff file per
+# single cell in the SAVING folder, that contains a subfolder per discrete class of the dataset
+# (only cluster 1 to 6 are considered). c.f util/dataset_builder.py
+#How many plates to process (Choose between 1 to 32) 32 lead to full datasize (300'000 cells)
 n_plates = 32
 
-missed_cells = 0
-class_miss = np.zeros(8)
-for plate in all_plates_folder:
-
-    path_to_plate = plate+'/anal2/'
-    synth_plate = plate[-3:]
-    print(f'--------Considering Plate {synth_plate} -----------------')
-
-    #For a given synthetic plate, there is one .class ground truth file per well image
-    #Loop over each class file
-    list_well_images = os.listdir(GT_path+path_to_plate)
-
-    for well_image in list_well_images:
-        if (well_image.endswith('.class') or well_image.endswith('.csv')):
-
-            #GT comes weirdly in non-formated .class file. Simply rename them and treat them as csv
-            if (well_image.endswith('.class')):
-                pre, ext = os.path.splitext(GT_path+path_to_plate+well_image)
-                os.rename(GT_path+path_to_plate+well_image, pre+'.csv')
-
-            pre, ext = os.path.splitext(GT_path+path_to_plate+well_image)
-
-            #Consider only CP metada for the given plate and well
-            plate_i = synth_plate.lstrip('0')
-            no_ext = well_image.split('.')
-            well_name = no_ext[0].split('_')
-            well_i = well_name[-1][1:]
-
-            Platei_CP = CP_df['Metadata_Plate']==int(plate_i)
-            Welli_CP = CP_df['Metadata_Well']==well_i
-            CP_Pi_Wi = CP_df[Platei_CP & Welli_CP].reset_index()
-            CP_centroids_array = CP_Pi_Wi[['AreaShape_Center_X','AreaShape_Center_Y']].values
+adapter = Horvath_Adapter(path_to_CP, CP_Quantitative_CSV, GT_path, n_plates=n_plates)
 
-
-            #GT dataframe associate with this plate - well
-            GT_df = pd.read_csv(pre+'.csv',header=None, names=['GT_pos_y', 'GT_pos_x', 'GT_label'])
-
-            #iterate over each SINGLE CELL (row of the GT file of a given well image)
-            for index, row in GT_df.iterrows():
-                GT_centroid = np.array([row['GT_pos_x'],row['GT_pos_y']])
-
-                #Find the closest cell profiler centroid
-                if (len(CP_centroids_array) > 0):
-                    CP_row_min, dist_2 = closest_point(GT_centroid,CP_centroids_array)
-                    CP_centroid = CP_centroids_array[CP_row_min]
-                else:
-                    print(f'Cell Profiler didnt find any cell in plate {plate_i} well {well_i}')
-                    missed_cells += 1
-                    continue
-
-                if np.sqrt(dist_2) > 35: #CellProfiler probably failed to find that cell, ignore
-                    print(f'One GT cell has been ignored of class {row["GT_label"]}')
-                    class_miss[row['GT_label']-1]+=1
-                    missed_cells += 1
-                    continue
-
-                label = row['GT_label']
-                ### IGNORE CELL OF CLUSTER 7 AND 8 (Cell segmentation failed and too poorly represented)
-                if (label==7 or label==8):
-                    continue
-                unique_id = "CellClass_{}_{}_{}_id{}.tiff".format(label,plate_i,well_i,index)
-                #Store all useful info about that cell to link its GT and cellprofiler metadata
-                new_row=pd.Series([plate_i,well_i,row['GT_label'],unique_id,row['GT_pos_x'],row['GT_pos_y'],CP_Pi_Wi.loc[CP_row_min,'ImageNumber'],CP_Pi_Wi.loc[CP_row_min,'ObjectNumber'],CP_Pi_Wi.loc[CP_row_min,'AreaShape_Center_X'],CP_Pi_Wi.loc[CP_row_min,'AreaShape_Center_Y']], index=MetaData_GT_link_CP.columns)
-                MetaData_GT_link_CP = MetaData_GT_link_CP.append(new_row, ignore_index=True)
-
-
-                #save a 3 Channel tiff file per single cell, in a folder corresponding to GT class
-                blue_path = path_to_CP+'SingleWholeCellCroppedImages/CroppedImages_Blue/'
-                green_path = path_to_CP+'SingleWholeCellCroppedImages/CroppedImages_Green/'
-                red_path = path_to_CP+'SingleWholeCellCroppedImages/CroppedImages_Red/'
-
-                well_site_folder = f'{synth_plate}_{well_i}/'
-                object_num = CP_Pi_Wi.loc[CP_row_min,'ObjectNumber']
-                single_cell_file = f'SplitCellBodies_{object_num}.png'
-
-                img_blue = io.imread(blue_path+well_site_folder+single_cell_file)
-                img_green = io.imread(green_path+well_site_folder+single_cell_file)
-                img_red = io.imread(red_path+well_site_folder+single_cell_file)
-
-                #new stacked RGB img
-                img_rgb = np.stack([img_red,img_green,img_blue],axis=-1)
-
-                folder_name = list_folder[row['GT_label']-1]
-                io.imsave(save_folder+f'{folder_name}/'+unique_id,img_rgb,plugin='tifffile')
-
-MetaData_GT_link_CP.to_csv('DataSets/MetaData2_PeterHorvath_GT_link_CP.csv')
-
-print('All files processed')
-print(f'{missed_cells} GT cells were not detected by cell profiler')
+#Cells already processed (manifest.csv in the folder) are skipped if run again
+save_folder = 'DataSets/Peter_Horvath_Data/'
+MetaData_GT_link_CP = build_dataset(adapter, save_folder, 'DataSets/MetaData2_PeterHorvath_GT_link_CP.csv')
 print(f'A subsample of {len(MetaData_GT_link_CP)} cells was created')
 
 #184 cell were missed by cell profiler
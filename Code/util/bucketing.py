@@ -0,0 +1,144 @@
+# @Author: Sacha Haidinger <sachahai>
+# @Date:   2026-10-18T10:00:00+10:00
+# @Email:  sacha.haidinger@epfl.ch
+# @Project: Learning methods for Cell Profiling
+# @Last modified by:   sachahai
+# @Last modified time: 2026-10-18T10:00:00+10:00
+
+'''
+Data loading of the single cell images at native size, and loading throughput per size bucket.
+
+zPad_or_Rescale brings each crop to input_size x input_size before the augmentation : the cells larger
+than input_size go through an anti-aliased skimage resize, the most expensive step of the data loading
+of a large crop. With get_train_val_dataloader(..., native_size=True), the large cells are augmented at
+native size, and Native_Size_Collator resizes them to input_size with an anti-aliased F.interpolate.
+The geometry is the one of zPad_or_Rescale (and of zPad_or_Rescale_inference, used to extract the
+latent codes), so that the cells are seen at the same scale in training and inference :
+    - cells <= input_size : zero padded at native scale (centered), before the augmentation (zPad_if_Smaller)
+    - cells > input_size : resized to input_size x input_size (anti-aliased bilinear)
+The samplers, and so the composition of the batches, are the ones of the default loader (cells of all the
+sizes and classes mixed in each batch, same drop_last, distributed training supported).
+
+Batches of cells of one size (a size-bucket sampler, the whole batch resized at once) were tried and dropped :
+on CPU, resizing a batch (separable resampling matrices, or one F.interpolate per shape) is not faster
+than one F.interpolate per cell (about 5-10k cells / s per bucket on one core, against 0.5-1k cells / s
+for the skimage resize), and single-size batches skew the BatchNorm statistics when size depends on class.
+
+bucket_throughput() times the data loading of the cells of each size bucket (size_buckets : buckets of
+the longest side of the cells, c.f image_sizes.py), to spot the sizes (long tail of large
+crops) that cost the most, with or without native_size.
+
+    train_loader, valid_loader = get_train_val_dataloader(dataset_path, 64, 128, native_size=True)
+    print(bucket_throughput(train_loader))
+'''
+
+from timeit import default_timer as timer
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader, Subset
+
+from util.packed_store import Packed_Dataset
+from util.image_sizes import image_shape
+
+DEFAULT_BUCKETS = (32,48,64,96,128,192,256)
+
+
+###############################
+#### Buckets ##################
+###############################
+
+def dataset_image_sizes(dataset, n_workers=16):
+    '''(heights, widths) arrays of the images of a DatasetFolder (file headers, c.f
+    image_sizes.py) or of a Packed_Dataset (from its index)'''
+    if isinstance(dataset, Packed_Dataset):
+        return dataset.index['height'].to_numpy(), dataset.index['width'].to_numpy()
+    with ThreadPoolExecutor(n_workers) as executor:
+        shapes = np.array(list(executor.map(image_shape, [path for path, _ in dataset.samples]))).reshape(-1,3)
+    return shapes[:,0], shapes[:,1]
+
+
+def size_buckets(heights, widths, edges=DEFAULT_BUCKETS):
+    '''Bucket of each image : index of the smallest edge >= its longest side. Images larger than the
+    last edge get an extra bucket, whose size is the longest side of the largest image
+    Return (bucket of each image, size of each bucket)'''
+    longest = np.maximum(np.asarray(heights), np.asarray(widths))
+    edges = sorted(edges)
+    if len(longest) and longest.max() > edges[-1]:
+        edges = edges + [int(longest.max())]
+    return np.searchsorted(edges, longest, side='left'), np.array(edges)
+
+
+###############################
+#### Collate ##################
+###############################
+
+def _pad_offsets(h, w, size):
+    '''Top / left zero padding to center a h x w image in size x size, as zPad_or_Rescale'''
+    return int(np.round((size - h)/2.)), int(np.round((size - w)/2.))
+
+class Native_Size_Collator(object):
+    '''
+    collate_fn of get_train_val_dataloader(..., native_size=True). Samples are (C x H x W float tensor
+    at native size, label). Each cell is brought to input_size as by zPad_or_Rescale : zero padded if it
+    fits in input_size x input_size, resized to input_size x input_size (anti-aliased bilinear) otherwise.
+    Returns (data, target) as the default collate
+
+    Params :
+        input_size (int) : size of the images given to the network
+    '''
+    def __init__(self, input_size):
+        self.input_size = input_size
+
+    def __call__(self, batch):
+        size = self.input_size
+        target = torch.LongTensor([item[1] for item in batch])
+        data = batch[0][0].new_zeros((len(batch), batch[0][0].shape[0], size, size))
+        for i, (img, _) in enumerate(batch):
+            h, w = img.shape[1], img.shape[2]
+            if h > size or w > size:
+                data[i] = F.interpolate(img[None], size=(size, size), mode='bilinear', align_corners=False, antialias=True)[0]
+            else:
+                top, left = _pad_offsets(h, w, size)
+                data[i, :, top:top+h, left:left+w] = img
+        return data, target
+
+
+###############################
+#### Throughput ###############
+###############################
+
+def bucket_throughput(loader, edges=DEFAULT_BUCKETS, max_per_bucket=None):
+    '''
+    Time the data loading (decoding, augmentation, padding / resizing) of the cells of each size
+    bucket, by iterating the dataset of a DataLoader once per bucket without any model
+
+    Params :
+        loader (DataLoader) : e.g train_loader of get_train_val_dataloader (its dataset, transforms,
+                collate_fn and batch_size are used, on the cells of its sampler)
+        edges (tuple) : bucket edges, c.f size_buckets
+        max_per_bucket (int) : number of cells timed per bucket (all if None)
+
+    Return a DataFrame, one row per bucket : bucket size, number of images,
+    loading time (seconds) and throughput (images / second)
+    '''
+    dataset = loader.dataset
+    indices = np.asarray(getattr(loader.sampler, 'indices', np.arange(len(dataset))))
+    heights, widths = dataset_image_sizes(dataset)
+    buckets, bucket_sizes = size_buckets(heights[indices], widths[indices], edges)
+
+    rows = []
+    for b in np.unique(buckets):
+        idx = indices[buckets == b][:max_per_bucket]
+        bucket_loader = DataLoader(Subset(dataset, idx), batch_size=loader.batch_size or 1,
+                                    collate_fn=loader.collate_fn, num_workers=loader.num_workers)
+        start = timer()
+        for _ in bucket_loader:
+            pass
+        seconds = timer() - start
+        rows.append({'bucket_size':int(bucket_sizes[b]), 'images':len(idx), 'seconds':seconds,
+            'images_per_s':len(idx) / seconds if seconds > 0 else np.nan})
+    return pd.DataFrame(rows)
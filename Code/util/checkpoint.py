@@ -0,0 +1,269 @@
+# @Author: Sacha Haidinger <sachahai>
+# @Date:   2026-10-18T10:00:00+10:00
+# @Email:  sacha.haidinger@epfl.ch
+# @Project: Learning methods for Cell Profiling
+# @Last modified by:   sachahai
+# @Last modified time: 2026-10-18T10:00:00+10:00
+
+'''
+Versioned checkpoint format, shared by all the trainers, to save and resume a training exactly.
+
+A checkpoint is a single file (torch.save of a dict) containing :
+    - 'version' : CHECKPOINT_VERSION
+    - 'epoch' : last epoch completed
+    - 'models' : for each model (e.g 'VAE', 'MLP'), its config (class and constructor arguments,
+            to rebuild it without the training script) and its state_dict
+    - 'optimizers', 'schedulers' : config and state_dict of each optimizer / lr scheduler
+    - 'early_stopping' : state of the EarlyStopping (counter, best score...)
+    - 'rng' : states of the python, numpy, torch (and cuda) random generators
+    - 'history' : training history up to 'epoch'
+    - 'extra' : anything else (dict)
+
+Writes are atomic (temporary file + os.replace), an interrupted write never corrupts the last
+valid checkpoint. With a Checkpoint_Writer, the state is copied to CPU in the training loop and
+written by a background thread : checkpointing does not block the training.
+To resume exactly, the train / validation split must be the same as in the first run (fixed seed).
+'''
+
+import os
+import copy
+import atexit
+import random
+import inspect
+import importlib
+import threading
+
+import numpy as np
+import torch
+from torch import cuda
+
+CHECKPOINT_VERSION = 1
+
+
+###############################
+#### Configs ##################
+###############################
+
+def model_config(model):
+    '''Class and constructor arguments of a model, read from the attributes of the same name.
+    build_model(model_config(model)) returns a new model with the same architecture'''
+    signature = inspect.signature(type(model).__init__)
+    kwargs = {}
+    for name, param in list(signature.parameters.items())[1:]:
+        if param.kind in (param.VAR_POSITIONAL, param.VAR_KEYWORD):
+            continue
+        if hasattr(model, name):
+            kwargs[name] = getattr(model, name)
+        else:
+            assert param.default is not param.empty, f"{type(model).__name__} doesn't store its argument '{name}', it can't be rebuilt from a checkpoint"
+    return {'module':type(model).__module__, 'class':type(model).__name__, 'kwargs':kwargs}
+
+def build_model(config):
+    '''Instantiate a model from its config (c.f model_config)'''
+    model_class = getattr(importlib.import_module(config['module']), config['class'])
+    return model_class(**config['kwargs'])
+
+def optimizer_config(optimizer):
+    return {'class':type(optimizer).__name__, 'defaults':copy.deepcopy(optimizer.defaults)}
+
+def build_optimizer(config, params):
+    return getattr(torch.optim, config['class'])(params, **config['defaults'])
+
+
+###############################
+#### RNG states ###############
+###############################
+
+def get_rng_state():
+    state = {
+        'python' : random.getstate(),
+        'numpy' : np.random.get_state(),
+        'torch' : torch.get_rng_state()
+    }
+    if cuda.is_available():
+        state['cuda'] = cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'].cpu())
+    if 'cuda' in state and cuda.is_available():
+        cuda.set_rng_state_all([s.cpu() for s in state['cuda']])
+
+
+###############################
+#### Save / Load ##############
+###############################
+
+def to_cpu(obj):
+    '''Copy of a (nested) state with every tensor cloned on CPU. The copy can be written
+    in the background while the training modifies the original tensors'''
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return copy.deepcopy(obj)
+
+def make_checkpoint(epoch, models, optimizers=None, schedulers=None, early_stopping=None, history=None, extra=None):
+    '''
+    Snapshot (on CPU) of the whole training state
+
+    Params :
+        epoch (int) : last epoch completed
+        models (dict) : {name : nn.Module}
+        optimizers (dict) : {name : optim.Optimizer}
+        schedulers (dict) : {name : lr_scheduler}
+        early_stopping (EarlyStopping) : its state_dict() is saved
+        history (list) : training history
+        extra (dict) : any additional information
+    '''
+    optimizers = optimizers or {}
+    schedulers = schedulers or {}
+    return {
+        'version' : CHECKPOINT_VERSION,
+        'epoch' : epoch,
+        'models' : {name: {'config':model_config(m), 'state_dict':to_cpu(m.state_dict())} for name, m in models.items()},
+        'optimizers' : {name: {'config':optimizer_config(o), 'state_dict':to_cpu(o.state_dict())} for name, o in optimizers.items()},
+        'schedulers' : {name: {'class':type(s).__name__, 'state_dict':to_cpu(s.state_dict())} for name, s in schedulers.items()},
+        'early_stopping' : early_stopping.state_dict() if early_stopping is not None else None,
+        'rng' : get_rng_state(),
+        'history' : copy.deepcopy(history),
+        'extra' : copy.deepcopy(extra) if extra is not None else {}
+    }
+
+def write_checkpoint(checkpoint, path):
+    '''Atomic write : the file at 'path' is either the previous checkpoint or the new one'''
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        torch.save(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def read_checkpoint(path, map_location='cpu'):
+    try:
+        checkpoint = torch.load(path, map_location=map_location, weights_only=False) #RNG states are not only tensors
+    except TypeError: #Older pytorch, no 'weights_only'
+        checkpoint = torch.load(path, map_location=map_location)
+    version = checkpoint.get('version', 0) if isinstance(checkpoint, dict) else 0
+    assert version == CHECKPOINT_VERSION, f'Unsupported checkpoint version {version} (expected {CHECKPOINT_VERSION}) : {path}'
+    return checkpoint
+
+
+def save_checkpoint(path, epoch, models, optimizers=None, schedulers=None, early_stopping=None, history=None, extra=None, writer=None):
+    '''Save the whole training state (c.f make_checkpoint) to 'path'.
+    If a Checkpoint_Writer is given, the file is written in the background'''
+    checkpoint = make_checkpoint(epoch, models, optimizers, schedulers, early_stopping, history, extra)
+    if writer is not None:
+        writer.submit(checkpoint, path)
+    else:
+        write_checkpoint(checkpoint, path)
+
+def load_checkpoint(path, models=None, optimizers=None, schedulers=None, early_stopping=None, restore_rng=True):
+    '''
+    Restore a training state saved with save_checkpoint()
+
+    Params :
+        path (string) : checkpoint file
+        models (dict) : {name : nn.Module} to load the weights in. Models missing from the dict are
+            rebuilt from their saved config (on GPU if available)
+        optimizers, schedulers (dict) : {name : object} to load the states in. Optimizers missing from the
+            dict are rebuilt (on the parameters of the model of the same name)
+        early_stopping (EarlyStopping) : to load its state in
+        restore_rng (boolean) : If True, the random generators are set back to their saved states
+
+    Return the checkpoint dict, with 'models' and 'optimizers' replaced by the restored objects
+    '''
+    checkpoint = read_checkpoint(path)
+    models = dict(models or {})
+    optimizers = dict(optimizers or {})
+
+    for name, saved in checkpoint['models'].items():
+        if name not in models:
+            models[name] = build_model(saved['config'])
+            if cuda.is_available():
+                models[name] = models[name].cuda()
+        models[name].load_state_dict(saved['state_dict'])
+    for name, saved in checkpoint['optimizers'].items():
+        if name not in optimizers:
+            if name not in models:
+                continue
+            optimizers[name] = build_optimizer(saved['config'], models[name].parameters())
+        optimizers[name].load_state_dict(saved['state_dict'])
+    for name, saved in checkpoint['schedulers'].items():
+        if schedulers is not None and name in schedulers:
+            schedulers[name].load_state_dict(saved['state_dict'])
+    if early_stopping is not None and checkpoint['early_stopping'] is not None:
+        early_stopping.load_state_dict(checkpoint['early_stopping'])
+    if restore_rng:
+        set_rng_state(checkpoint['rng'])
+
+    checkpoint['models'] = models
+    checkpoint['optimizers'] = optimizers
+    return checkpoint
+
+
+###############################
+#### Background Writer ########
+###############################
+
+class Checkpoint_Writer(object):
+    '''Write checkpoints in a background thread.
+    At most one checkpoint per file waits to be written : if a new one is submitted before the
+    previous one is written, the older one is dropped (only the latest state matters).
+    flush() waits until everything submitted is on disk, it is also called when python exits.'''
+    def __init__(self):
+        self.pending = {} #path -> latest checkpoint not written yet
+        self.busy = False
+        self.closed = False
+        self.error = None
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
+
+    def submit(self, checkpoint, path):
+        self._raise_error()
+        with self.condition:
+            self.pending[path] = checkpoint
+            self.condition.notify_all()
+
+    def _loop(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                path, checkpoint = self.pending.popitem()
+                self.busy = True
+            try:
+                write_checkpoint(checkpoint, path)
+            except Exception as e:
+                self.error = e
+            with self.condition:
+                self.busy = False
+                self.condition.notify_all()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def flush(self):
+        '''Block until all submitted checkpoints are written'''
+        with self.condition:
+            while self.pending or self.busy:
+                self.condition.wait()
+        self._raise_error()
+
+    def close(self):
+        self.flush()
+        atexit.unregister(self.flush)
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
@@ -31,13 +31,17 @@ import numpy as np
 import random
 from copy import copy
 
+from util.distributed import Distributed_Subset_Sampler
+from util.packed_store import Packed_Dataset, is_packed_store
+from util.bucketing import Native_Size_Collator
+
 
 ###############################
 #### DataLoader ###############
 ###############################
 
 #Training dataloader
-def get_train_val_dataloader(root_dir,input_size,batchsize,test_split=0.2):
+def get_train_val_dataloader(root_dir,input_size,batchsize,test_split=0.2,seed=None,world_size=1,rank=0,native_size=False):
     """
     From a unique folder that contains the whole dataset, divided in different subfolders
     related to class identity, return a train and validation dataloader that can be used
@@ -46,22 +50,38 @@ def get_train_val_dataloader(root_dir,input_size,batchsize,test_split=0.2):
     is both sets.
 
     Params :
-        - root_dir : path to the folder containing the dataset
+        - root_dir : path to the folder containing the dataset (or to a packed store, c.f util/packed_store.py)
         - input_size : imgs will all be input_size x input_size (rescale or pad)
         - test_split : Proportion of sample (0-1) that will be part of validation set
+        - seed : random state of the split (random split if None)
+        - world_size, rank : for distributed training (c.f util/distributed.py), the same stratified
+                split is done in all the processes (seed needed), and each process gets its own
+                shard of the training and validation sets. 'batchsize' is then per process
+        - native_size : If True, the large cells are augmented at native size, and resized to input_size
+                with F.interpolate in the collate_fn instead of skimage (c.f util/bucketing.py). Same geometry as
+                zPad_or_Rescale, same samplers
     """
     trsfm = image_tranforms(input_size)
-    dataset = datasets.DatasetFolder(root=root_dir,loader=load_from_path(),extensions=('.png','.jpg','.tif','.tiff'), transform=trsfm)
+    if is_packed_store(root_dir):
+        dataset = Packed_Dataset(root_dir, transform=trsfm)
+    else:
+        dataset = datasets.DatasetFolder(root=root_dir,loader=load_from_path(),extensions=('.png','.jpg','.tif','.tiff'), transform=trsfm)
     targets = dataset.targets
 
     #Stratify splitting
     train_idx, valid_idx=train_test_split(np.arange(len(targets)),
                                             test_size=test_split,
                                             shuffle=True,
-                                            stratify=targets)
+                                            stratify=targets,
+                                            random_state=seed)
 
-    train_sampler = SubsetRandomSampler(train_idx)
-    valid_sampler = SubsetRandomSampler(valid_idx)
+    if world_size > 1:
+        assert seed is not None, "All the processes need the same train / validation split, please give a seed"
+        train_sampler = Distributed_Subset_Sampler(train_idx, world_size, rank, shuffle=True, seed=seed)
+        valid_sampler = Distributed_Subset_Sampler(valid_idx, world_size, rank, shuffle=False)
+    else:
+        train_sampler = SubsetRandomSampler(train_idx)
+        valid_sampler = SubsetRandomSampler(valid_idx)
 
     dataset_train = dataset
     dataset_valid = copy(dataset) #To enable different transforms
@@ -77,20 +97,25 @@ def get_train_val_dataloader(root_dir,input_size,batchsize,test_split=0.2):
     #     Double_to_Float()])
     #Create DataIterator, yield batch of img and label easily and in time, to not load full heavy set
     #Dataloader iterators
-    train_loader = DataLoader(dataset_train, batch_size=batchsize,sampler=train_sampler,drop_last=True)
-    valid_loader = DataLoader(dataset_valid, batch_size=batchsize,sampler=valid_sampler,drop_last=True)
+    collate_fn = None
+    if native_size:
+        dataset_train.transform, dataset_valid.transform = native_size_tranforms(input_size)
+        collate_fn = Native_Size_Collator(input_size)
+    train_loader = DataLoader(dataset_train, batch_size=batchsize,sampler=train_sampler,drop_last=True,collate_fn=collate_fn)
+    valid_loader = DataLoader(dataset_valid, batch_size=batchsize,sampler=valid_sampler,drop_last=True,collate_fn=collate_fn)
 
     return train_loader, valid_loader
 
 #Inference dataloader (no data augmentation and no train/test split)
-def get_inference_dataset(dataset_dir,batchsize,input_size,shuffle=False,droplast=False):
+def get_inference_dataset(dataset_dir,batchsize,input_size,shuffle=False,droplast=False,num_workers=0):
     '''DataLoader for inference. No data augmentation and no train/test split
     From a unique folder that contains the whole dataset, divided in different subfolders
     related to class identity
 
     Params :
-        - root_dir : path to the folder containing the dataset
+        - root_dir : path to the folder containing the dataset (or to a packed store, c.f util/packed_store.py)
         - input_size : imgs will all be input_size x input_size (rescale or pad)
+        - num_workers : number of processes of the DataLoader (0 : images are loaded in the main process)
     '''
     inference_trfm = transforms.Compose([
         #Data arrive as HxWxC float64 0 - 1.0 ndarray
@@ -98,8 +123,11 @@ def get_inference_dataset(dataset_dir,batchsize,input_size,shuffle=False,droplas
         ToTensor_inference(), #Will rescale to 0-1 Float32
         Double_to_Float_inference()])
 
-    data = datasets.DatasetFolder(root=dataset_dir,loader=keep_Metadata_from_path(),extensions=('.png','.jpg','.tif','.tiff'), transform=inference_trfm)
-    dataloaders = DataLoader(data, batch_size=batchsize, collate_fn=My_ID_Collator(), shuffle=shuffle,drop_last=droplast)
+    if is_packed_store(dataset_dir):
+        data = Packed_Dataset(dataset_dir, transform=inference_trfm, keep_id=True)
+    else:
+        data = datasets.DatasetFolder(root=dataset_dir,loader=keep_Metadata_from_path(),extensions=('.png','.jpg','.tif','.tiff'), transform=inference_trfm)
+    dataloaders = DataLoader(data, batch_size=batchsize, collate_fn=My_ID_Collator(), shuffle=shuffle,drop_last=droplast,num_workers=num_workers)
 
     return data, dataloaders
 
@@ -194,6 +222,27 @@ def image_tranforms(input_size):
     return img_transforms
 
 
+def native_size_tranforms(input_size):
+    """
+    Train / validation transforms of get_train_val_dataloader(..., native_size=True) : augmentation of
+    image_tranforms(), but the cells larger than input_size stay at native size (resized by Native_Size_Collator).
+    The small cells are zero padded before the rotation as in image_tranforms() (no clipped corners). The large
+    ones are rotated at native size, where they fill their frame as after zPad_or_Rescale (corners clipped as before)
+    """
+    train_transforms = transforms.Compose([
+            RandomRot90(),
+            zPad_if_Smaller(input_size),
+            RandomSmallRotation(),
+            RandomVFlip(),
+            RandomHFlip(),
+            transforms.ToTensor(),
+            Double_to_Float()])
+    valid_transforms = transforms.Compose([
+            transforms.ToTensor(),
+            Double_to_Float()])
+    return train_transforms, valid_transforms
+
+
 #Create callable class to have custom tranform of our data
 class zPad_or_Rescale(object):
     """Resize all data to fixed size of input_size
@@ -225,6 +274,22 @@ class zPad_or_Rescale(object):
 
         return img_resized
 
+class zPad_if_Smaller(object):
+    """Zero pad to input_size x input_size the images that fit in it (as zPad_or_Rescale),
+    the larger ones are returned as they are (resized later, c.f Native_Size_Collator)
+
+    Image is returned as an ndarray float64 0-1"""
+    def __init__(self, input_size):
+        self.input_size = input_size
+
+    def __call__(self, sample):
+        h, w = sample.shape[0], sample.shape[1]
+        if h > self.input_size or w > self.input_size:
+            return sample
+        diff_h = self.input_size - h
+        diff_w = self.input_size - w
+        return pad(sample,((int(np.round(diff_h/2.)),diff_h-int(np.round(diff_h/2.))),(int(np.round(diff_w/2.)),diff_w-int(np.round(diff_w/2.))),(0,0)))
+
 class zPad_or_Rescale_inference(object):
     """Resize all data to fixed size of 256x256
     if any dimension is bigger than 256 -> RESCALE
@@ -0,0 +1,522 @@
+# @Author: Sacha Haidinger <sachahai>
+# @Date:   2026-10-18T10:00:00+10:00
+# @Email:  sacha.haidinger@epfl.ch
+# @Project: Learning methods for Cell Profiling
+# @Last modified by:   sachahai
+# @Last modified time: 2026-10-18T10:00:00+10:00
+
+'''
+Build a single cell dataset in the folder architecture of the DataLoaders (one subfolder per
+class, one H x W x C tiff file per cell), from the per-channel single cell images output by
+a CellProfiler pipeline, and save the metadata linking each cell to its ground truth.
+
+The dataset-specific part (where the ground truth and the channel images are, how cells are
+matched and labelled) is a Dataset_Adapter. The adapters of the 3 datasets of the project
+(BBBC031, Horvath, Chaffer) replace the loops of the Process_*.py scripts.
+
+build_dataset() reads the channels, stacks them and writes the tiff files in a pool of
+processes. It is restartable : each processed cell is recorded in a manifest file in the
+output folder, with the outputs written for it (tiff file, packed store), and the cells already
+in the manifest with all the requested outputs are skipped when the build is run again.
+In the same pass, the cells can also (or only) be written to a packed store (c.f packed_store.py) :
+a few large shard files instead of one tiff file per cell, that the DataLoaders read directly.
+
+    adapter = Horvath_Adapter(path_to_CP, CP_csv, GT_path)
+    metadata = build_dataset(adapter, 'DataSets/Peter_Horvath_Data/', 'DataSets/MetaData2_PeterHorvath_GT_link_CP.csv')
+'''
+
+import os
+from collections import namedtuple
+from multiprocessing import Pool
+from timeit import default_timer as timer
+
+import numpy as np
+import pandas as pd
+from scipy.optimize import linear_sum_assignment
+from scipy.spatial import cKDTree
+from skimage import io
+
+from util.packed_store import Packed_Store_Writer
+
+#A cell to build : file name (Unique_ID), class subfolder, paths of its channel images
+#(in the order of the channels of the tiff file), and its metadata row (dict)
+Cell = namedtuple('Cell', ['unique_id', 'folder', 'channel_paths', 'metadata'])
+
+MANIFEST_FILE = 'manifest.csv'
+#Outputs of a written cell, recorded in the manifest ('+' separated)
+OUTPUTS = ('tiff','packed')
+
+
+###############################
+#### Matching #################
+###############################
+
+def match_centroids(GT_centroids, CP_centroids, max_dist=35, assignment='greedy'):
+    '''
+    Match the ground truth cells of an image to the CellProfiler objects of the same image, by the
+    distance between their centroids. A KD-tree of the CellProfiler centroids gives all the pairs closer
+    than max_dist pixels in one query, GT cells without any such pair were probably missed by CellProfiler.
+
+    Params :
+        GT_centroids (array N x 2) : ground truth centroids
+        CP_centroids (array M x 2) : CellProfiler centroids
+        max_dist (float) : maximal distance (pixels) between a GT cell and its CellProfiler object
+        assignment (string) : 'nearest' -> each GT cell takes its closest object, an object can be taken twice
+                              'greedy' -> one-to-one, pairs are assigned by increasing distance
+                              'hungarian' -> one-to-one, minimal total distance (scipy linear_sum_assignment)
+
+    Return for each GT cell the index of its CellProfiler object (row of CP_centroids), or -1 if unmatched
+    '''
+    GT_centroids = np.asarray(GT_centroids, dtype=np.float64).reshape(-1,2)
+    CP_centroids = np.asarray(CP_centroids, dtype=np.float64).reshape(-1,2)
+    matches = np.full(len(GT_centroids), -1, dtype=np.int64)
+    if len(GT_centroids) == 0 or len(CP_centroids) == 0:
+        return matches
+
+    tree = cKDTree(CP_centroids)
+    if assignment == 'nearest':
+        #distance_upper_bound is exclusive, query_ball_tree below (and the 35 px rule) are inclusive
+        dist, ind = tree.query(GT_centroids, k=1, distance_upper_bound=np.nextafter(max_dist, np.inf))
+        found = np.isfinite(dist)
+        matches[found] = ind[found]
+        return matches
+
+    #All the (GT, CP) pairs closer than max_dist, and their distances
+    neighbours = cKDTree(GT_centroids).query_ball_tree(tree, max_dist)
+    GT_ind = np.repeat(np.arange(len(GT_centroids)), [len(n) for n in neighbours])
+    CP_ind = np.fromiter((j for n in neighbours for j in n), dtype=np.int64, count=len(GT_ind))
+    if len(GT_ind) == 0:
+        return matches
+    dist = np.linalg.norm(GT_centroids[GT_ind] - CP_centroids[CP_ind], axis=1)
+
+    if assignment == 'greedy':
+        GT_taken = np.zeros(len(GT_centroids), dtype=bool)
+        CP_taken = np.zeros(len(CP_centroids), dtype=bool)
+        for k in np.argsort(dist, kind='stable'):
+            i, j = GT_ind[k], CP_ind[k]
+            if not (GT_taken[i] or CP_taken[j]):
+                matches[i] = j
+                GT_taken[i] = CP_taken[j] = True
+    elif assignment == 'hungarian':
+        #Only the rows / columns with at least one candidate pair, pairs farther than max_dist are forbidden
+        GT_u, GT_pos = np.unique(GT_ind, return_inverse=True)
+        CP_u, CP_pos = np.unique(CP_ind, return_inverse=True)
+        forbidden = max_dist * (len(GT_u) + len(CP_u)) + 1.
+        cost = np.full((len(GT_u), len(CP_u)), forbidden)
+        cost[GT_pos, CP_pos] = dist
+        rows, cols = linear_sum_assignment(cost)
+        valid = cost[rows, cols] < forbidden
+        matches[GT_u[rows[valid]]] = CP_u[cols[valid]]
+    else:
+        raise ValueError(f"Unknown assignment '{assignment}', expected 'nearest', 'greedy' or 'hungarian'")
+    return matches
+
+
+###############################
+#### Adapters #################
+###############################
+
+class Dataset_Adapter(object):
+    '''
+    Interface of a dataset for build_dataset()
+
+    cells() yields a Cell for each single cell to build. It runs in the main process and should
+    only read metadata (csv files, folder listings), the images are read by the workers.
+    Cells whose channel images don't have the same shape are not written.
+    join_metadata() completes the metadata of the written cells (one DataFrame), e.g by a join with
+    a ground truth table, instead of copying the same columns in the metadata of each Cell.
+    summary() returns statistics to print at the end of the build (e.g cells not matched)
+    '''
+    def cells(self):
+        raise NotImplementedError
+
+    def join_metadata(self, metadata):
+        return metadata
+
+    def summary(self):
+        return {}
+
+
+class BBBC_Adapter(Dataset_Adapter):
+    '''
+    Dataset 1 -> BBBC031 synthetic dataset (c.f Process_DataSet_1.py)
+    Each ground truth cell is matched with a CellProfiler object of its well / site (c.f match_centroids).
+    RGB tiff files, one subfolder 'Process_k' per ground truth process
+
+    Params :
+        CP_csv (string) : CellProfiler quantitative output (one row per object)
+        GT_csv (string) : BBBC ground truth (';' separated)
+        single_cell_folder (string) : CellProfiler single cell crops, with a subfolder CroppedImages_{Red,Green,Blue}
+            per channel, and inside a subfolder per well_site
+        max_dist (float) : ground truth cells farther than this from any CellProfiler object are ignored
+        assignment (string) : 'greedy', 'hungarian' (one-to-one) or 'nearest', c.f match_centroids()
+    '''
+    def __init__(self, CP_csv, GT_csv, single_cell_folder, max_dist=35, assignment='greedy'):
+        fields = ['ImageNumber','ObjectNumber','Metadata_Site','Metadata_Well','AreaShape_Center_X','AreaShape_Center_Y']
+        self.CP_df = pd.read_csv(CP_csv,usecols=fields)
+        fields = ['ImageName','CellIdx','LocationX','LocationY','ProcessID','ColorParamsR','ColorParamsG','ColorParamsB','ShapeParams','PositionOnRegressionPlaneX','PositionOnRegressionPlaneY']
+        self.GT_df = self._prepare_GT(pd.read_csv(GT_csv,sep=';',usecols=fields))
+        self.single_cell_folder = single_cell_folder
+        self.max_dist = max_dist
+        self.assignment = assignment
+        self.missed = 0
+
+    @staticmethod
+    def _prepare_GT(GT_df):
+        '''Add well, site, distance to the closest extreme phenotype (normalized in 0-1 per process)
+        and closest initial state. Red cells are close to [1,1] in the phenotypic plane'''
+        subparts = GT_df['ImageName'].str.split('_')
+        GT_df['Well'] = subparts.str[1].str[1:]
+        GT_df['Site'] = subparts.str[2].str[-1].astype(int)
+
+        positions = GT_df[['PositionOnRegressionPlaneX','PositionOnRegressionPlaneY']].values
+        Extremes = np.array([[0.,0.],[1.,1.]])
+        distances = np.sqrt(((positions[:,None,:] - Extremes[None,:,:])**2).sum(-1).min(1))
+        GT_df['dist_toInit_state'] = distances / GT_df.assign(d=distances).groupby('ProcessID')['d'].transform('max').values
+        above_diagonal = positions[:,1] > -positions[:,0] + 1
+        GT_df['closest_init_state'] = np.where(above_diagonal,'red','green')
+        return GT_df
+
+    def cells(self):
+        #Split the tables once per (well, site) instead of masking them for each image
+        CP_groups = dict(tuple(self.CP_df.groupby(['Metadata_Well','Metadata_Site'])))
+        GT_groups = dict(tuple(self.GT_df.groupby(['Well','Site'])))
+        for combination in sorted(os.listdir(os.path.join(self.single_cell_folder,'CroppedImages_Blue'))):
+            if combination.startswith('.'):
+                continue
+            strings = combination.split('_')
+            well_i = strings[0]
+            site_i = int(strings[1][-1])
+
+            CP_Wi_Si = CP_groups.get((well_i,site_i), self.CP_df.iloc[:0]).reset_index()
+            GT_Wi_Si = GT_groups.get((well_i,site_i), self.GT_df.iloc[:0])
+            matches = match_centroids(GT_Wi_Si[['LocationX','LocationY']].values,
+                CP_Wi_Si[['AreaShape_Center_X','AreaShape_Center_Y']].values, self.max_dist, self.assignment)
+
+            #Metadata of the matched cells of the image, built column-wise
+            found = matches >= 0
+            self.missed += int((~found).sum())
+            GT_m = GT_Wi_Si[found]
+            CP_m = CP_Wi_Si.iloc[matches[found]]
+            batch = pd.DataFrame({'Well':GT_m['Well'].values,'Site':GT_m['Site'].values,'GT_label':GT_m['ProcessID'].values,
+                'GT_Cell_id':GT_m['CellIdx'].values,
+                'Unique_ID':[f'CellProcess_{p}_{combination}_id{c}.tiff' for p, c in zip(GT_m['ProcessID'],GT_m['CellIdx'])],
+                'GT_x':GT_m['LocationX'].values,'GT_y':GT_m['LocationY'].values,'GT_colorR':GT_m['ColorParamsR'].values,
+                'GT_colorG':GT_m['ColorParamsG'].values,'GT_colorB':GT_m['ColorParamsB'].values,'GT_Shape':GT_m['ShapeParams'].values,
+                'GT_dist_toInit_state':GT_m['dist_toInit_state'].values,'GT_initial_state':GT_m['closest_init_state'].values,
+                'PositionOnRegressionPlaneX':GT_m['PositionOnRegressionPlaneX'].values,'PositionOnRegressionPlaneY':GT_m['PositionOnRegressionPlaneY'].values,
+                'CP_ImagerNumber':CP_m['ImageNumber'].values,'CP_ObjectNumber':CP_m['ObjectNumber'].values,
+                'CP_x':CP_m['AreaShape_Center_X'].values,'CP_y':CP_m['AreaShape_Center_Y'].values})
+
+            for metadata in batch.to_dict('records'):
+                single_cell_file = f"SplitCellBodies_{int(metadata['CP_ObjectNumber'])}.png"
+                channel_paths = [os.path.join(self.single_cell_folder,f'CroppedImages_{channel}',combination,single_cell_file)
+                    for channel in ('Red','Green','Blue')]
+                yield Cell(metadata['Unique_ID'], f"Process_{metadata['GT_label']}", channel_paths, metadata)
+
+    def summary(self):
+        return {'GT cells not detected by CellProfiler':self.missed}
+
+
+class Horvath_Adapter(Dataset_Adapter):
+    '''
+    Dataset 2 -> Horvath synthetic dataset (c.f Process_Horvath_Dataset.py)
+    Each ground truth cell (one .class / .csv file per well image, in synthPlateXXX/anal2/) is matched with
+    a CellProfiler object of its plate / well. Cells of class 7 and 8 are ignored (segmentation failed
+    and too poorly represented). RGB tiff files, one subfolder 'Class_k' per class
+
+    Params :
+        path_to_CP (string) : CellProfiler outputs, with SingleWholeCellCroppedImages/CroppedImages_{Red,Green,Blue}
+        CP_csv (string) : CellProfiler quantitative output (one row per object)
+        GT_path (string) : folder of the synthetic plates (ground truth)
+        n_plates (int) : number of plates to process (all if None, 32 plates lead to ~300'000 cells)
+        max_dist (float) : ground truth cells farther than this from any CellProfiler object are ignored
+        assignment (string) : 'greedy', 'hungarian' (one-to-one) or 'nearest', c.f match_centroids()
+    '''
+    def __init__(self, path_to_CP, CP_csv, GT_path, n_plates=None, max_dist=35, assignment='greedy'):
+        fields = ['ImageNumber','ObjectNumber','Metadata_Plate','Metadata_Well','AreaShape_Center_X','AreaShape_Center_Y']
+        self.CP_df = pd.read_csv(CP_csv,usecols=fields)
+        self.path_to_CP = path_to_CP
+        self.GT_path = GT_path
+        self.n_plates = n_plates
+        self.max_dist = max_dist
+        self.assignment = assignment
+        self.missed = 0
+        self.class_miss = np.zeros(8)
+
+    def cells(self):
+        CP_groups = dict(tuple(self.CP_df.groupby(['Metadata_Plate','Metadata_Well'])))
+        all_plates_folder = sorted([f for f in os.listdir(self.GT_path) if not f.startswith('.')])
+        for plate in all_plates_folder[:self.n_plates]:
+            synth_plate = plate[-3:]
+            plate_i = synth_plate.lstrip('0')
+            path_to_plate = os.path.join(self.GT_path,plate,'anal2')
+
+            #One ground truth file per well image (.class files are csv files)
+            for well_image in sorted(os.listdir(path_to_plate)):
+                if not (well_image.endswith('.class') or well_image.endswith('.csv')):
+                    continue
+                well_i = well_image.split('.')[0].split('_')[-1][1:]
+
+                CP_Pi_Wi = CP_groups.get((int(plate_i),well_i), self.CP_df.iloc[:0]).reset_index()
+                GT_df = pd.read_csv(os.path.join(path_to_plate,well_image),header=None, names=['GT_pos_y', 'GT_pos_x', 'GT_label'])
+                matches = match_centroids(GT_df[['GT_pos_x','GT_pos_y']].values,
+                    CP_Pi_Wi[['AreaShape_Center_X','AreaShape_Center_Y']].values, self.max_dist, self.assignment)
+
+                found = matches >= 0
+                labels = GT_df['GT_label'].values.astype(int)
+                self.missed += int((~found).sum())
+                if len(CP_Pi_Wi) > 0:
+                    np.add.at(self.class_miss, labels[~found]-1, 1)
+                keep = found & (labels != 7) & (labels != 8)
+
+                #Metadata of the kept cells of the well, built column-wise
+                GT_m = GT_df[keep]
+                CP_m = CP_Pi_Wi.iloc[matches[keep]]
+                batch = pd.DataFrame({'Plate':plate_i,'Well':well_i,'GT_label':labels[keep],
+                    'Unique_ID':[f'CellClass_{l}_{plate_i}_{well_i}_id{i}.tiff' for l, i in zip(labels[keep],GT_m.index)],
+                    'GT_x':GT_m['GT_pos_x'].values,'GT_y':GT_m['GT_pos_y'].values,
+                    'CP_ImagerNumber':CP_m['ImageNumber'].values,'CP_ObjectNumber':CP_m['ObjectNumber'].values,
+                    'CP_x':CP_m['AreaShape_Center_X'].values,'CP_y':CP_m['AreaShape_Center_Y'].values})
+
+                for metadata in batch.to_dict('records'):
+                    single_cell_file = f"SplitCellBodies_{int(metadata['CP_ObjectNumber'])}.png"
+                    channel_paths = [os.path.join(self.path_to_CP,'SingleWholeCellCroppedImages',f'CroppedImages_{channel}',f'{synth_plate}_{well_i}',single_cell_file)
+                        for channel in ('Red','Green','Blue')]
+                    yield Cell(metadata['Unique_ID'], f"Class_{metadata['GT_label']}", channel_paths, metadata)
+
+    def summary(self):
+        return {'GT cells not detected by CellProfiler':self.missed, 'Missed per class':self.class_miss.tolist()}
+
+
+class Chaffer_Adapter(Dataset_Adapter):
+    '''
+    Dataset 3 -> Chaffer dataset (c.f Process_Chaffer_Dataset.py)
+    The single cell png files are named after their Unique_Cell_ID in the ground truth csv. The class is
+    given by the Cell_Condition_status. 4 channels tiff files, one subfolder 'Class_k' per class
+
+    Params :
+        single_cell_image_folder (string) : folder with one subfolder per channel
+        GT_csv (string) : ground truth csv file
+    '''
+    channel_folders = ['Phalloidin_images_mateched_to_subset_data','DAPI_images_mateched_to_subset_data',
+        'AR_images_mateched_to_subset_data','Zeb1_images_mateched_to_subset_data']
+
+    switcher_class_to_label = {
+        'HCC38HI_Not Specified_Not Specified_DHT_Not Specified': 1,
+        'HCC38LO_Not Specified_Not Specified_DMSO_Not Specified': 2,
+        'HMLER_Primed_Not Specified_DMSO_C2': 3,
+        'HMLER_HIGH_Positive_DMSO_E3': 4,
+        'HCC38LO_Not Specified_Not Specified_DHT_Not Specified': 5,
+        'HMLER_Primed_Not Specified_DHT_C2': 6,
+        'HMLER_HIGH_Positive_DHT_E3': 7,
+        'HCC38HI_Not Specified_Not Specified_DMSO_Not Specified': 8,
+        'HMLER_Primed_Not Specified_DMSO_C4': 9,
+        'HMLER_HIGH_Positive_DMSO_F11': 10,
+        'HMLER_Primed_Not Specified_DHT_C4': 11,
+        'HMLER_HIGH_Positive_DHT_F11': 12
+    }
+
+    def __init__(self, single_cell_image_folder, GT_csv):
+        header = pd.read_csv(GT_csv, nrows=0)
+        umap_cols = list(header.filter(regex='^UMAP',axis=1).filter(regex='[XYZ]$',axis=1).columns)
+        tsne_cols = list(header.filter(regex='^RTSNE',axis=1).filter(regex='[XYZ]$',axis=1).columns)
+        misc_cols = ['Manual_Clusters','Cell_Condition_status','Unique_Cell_ID','PCA_X','PCA_Y','PCA_Z','row ID','Label','Source Labeling','Well_categ','Cell_Type_categ','CD44_Level_categ','CD104_Level_categ','Treatment_categ','Designation_categ','Cell_Number_categ']
+        self.GT_csv = pd.read_csv(GT_csv,usecols=umap_cols+tsne_cols+misc_cols)
+        self.GT_csv['Unique_Cell_ID'] = self.GT_csv['Unique_Cell_ID'].astype(str)
+        self.GT_csv['Cell_Condition_status'] = self.GT_csv['Cell_Condition_status'].astype(str)
+        self.single_cell_image_folder = single_cell_image_folder
+        self.not_in_GT = 0
+
+    def cells(self):
+        labels = dict(zip(self.GT_csv['Unique_Cell_ID'], self.GT_csv['Cell_Condition_status'].map(self.switcher_class_to_label)))
+        all_single_cells = sorted([f for f in os.listdir(os.path.join(self.single_cell_image_folder,self.channel_folders[0])) if not f.startswith('.')])
+        for cell_file_name in all_single_cells:
+            file_wo_ext = cell_file_name.split('.')[0]
+            if file_wo_ext not in labels:
+                self.not_in_GT += 1
+                continue
+            class_num = labels[file_wo_ext]
+            #The ground truth columns are added by join_metadata()
+            metadata = {'Unique_Cell_ID':file_wo_ext, 'Unique_ID':file_wo_ext+'.tiff', 'GT_label':class_num}
+            channel_paths = [os.path.join(self.single_cell_image_folder,folder,cell_file_name) for folder in self.channel_folders]
+            yield Cell(metadata['Unique_ID'], f'Class_{class_num}', channel_paths, metadata)
+
+    def join_metadata(self, metadata):
+        '''Ground truth rows of the written cells, with their Unique_ID and GT_label'''
+        if len(metadata) == 0:
+            return self.GT_csv.iloc[:0].assign(Unique_ID=[], GT_label=[])
+        return metadata.merge(self.GT_csv, on='Unique_Cell_ID', how='left', validate='one_to_one')[
+            list(self.GT_csv.columns)+['Unique_ID','GT_label']]
+
+    def summary(self):
+        return {'Single cell files not in the ground truth':self.not_in_GT}
+
+
+###############################
+#### Metadata #################
+###############################
+
+class Metadata_Accumulator(object):
+    '''
+    Metadata table filled one row (dict) at a time and kept as one list per column. The DataFrame is
+    only built at the end (to_frame), in a time linear in the number of rows (appending rows to a
+    DataFrame copies it at each row). A column missing in a row is None (NaN in the DataFrame).
+    '''
+    def __init__(self):
+        self.columns = {}
+        self.n_rows = 0
+
+    def __len__(self):
+        return self.n_rows
+
+    def _add_columns(self, keys):
+        for key in keys:
+            if key not in self.columns:
+                self.columns[key] = [None] * self.n_rows
+
+    def append(self, row):
+        self._add_columns(row)
+        for key, column in self.columns.items():
+            column.append(row.get(key))
+        self.n_rows += 1
+
+    def to_frame(self, mask=None):
+        '''DataFrame of the rows (only the rows where mask is True if given)'''
+        if mask is None:
+            return pd.DataFrame(self.columns)
+        return pd.DataFrame({key: [v for v, m in zip(column, mask) if m] for key, column in self.columns.items()})
+
+
+###############################
+#### Builder ##################
+###############################
+
+def _build_cell(job):
+    '''Run in a worker : read the channels of a cell, stack them (H x W x C) and write the tiff file
+    (if save_to is not None). The file is written under a temporary name and renamed, a cell in the
+    manifest is always complete. The stacked image is returned if return_img (packed store)'''
+    unique_id, save_to, channel_paths, return_img = job
+    try:
+        channels = [io.imread(path) for path in channel_paths]
+        if len(set(img.shape for img in channels)) > 1:
+            return unique_id, 'shape_mismatch', None, None
+        img = np.stack(channels,axis=-1)
+        if save_to is not None:
+            tmp_path = save_to + '.part'
+            io.imsave(tmp_path,img,plugin='tifffile',check_contrast=False)
+            os.replace(tmp_path, save_to)
+        return unique_id, 'written', None, img if return_img else None
+    except Exception as e:
+        return unique_id, 'error', f'{type(e).__name__}: {e}', None
+
+
+def read_manifest(save_folder):
+    '''{Unique_ID : (status, set of the outputs written)} of the cells already processed in save_folder.
+    The manifests written before the outputs were recorded only had tiff files'''
+    path = os.path.join(save_folder, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return {}
+    manifest = pd.read_csv(path, dtype=str, keep_default_na=False)
+    if 'outputs' not in manifest.columns:
+        manifest['outputs'] = np.where(manifest['status'] == 'written', 'tiff', '')
+    return {uid : (status, set(filter(None, outputs.split('+'))))
+            for uid, status, outputs in zip(manifest['Unique_ID'], manifest['status'], manifest['outputs'])}
+
+
+def write_manifest(save_folder, manifest):
+    '''(Re)write the whole manifest of save_folder from a read_manifest() dict'''
+    with open(os.path.join(save_folder, MANIFEST_FILE), 'w') as manifest_file:
+        manifest_file.write('Unique_ID,status,outputs\n')
+        for uid, (status, outputs) in manifest.items():
+            manifest_file.write(f"{uid},{status},{'+'.join(sorted(outputs))}\n")
+
+
+def build_dataset(adapter, save_folder, metadata_csv=None, n_workers=None, chunksize=32,
+        packed_folder=None, write_tiff=True, shard_size=256*2**20):
+    '''
+    Build the dataset of an adapter in save_folder (one subfolder per class, one tiff file per cell)
+
+    Params :
+        adapter (Dataset_Adapter) : the dataset to build
+        save_folder (string) : output folder. It is NOT emptied : cells recorded in its manifest with all the
+            requested outputs are skipped, so that an interrupted build can be resumed by running it again.
+            The missing outputs of a cell (e.g tiff files after a write_tiff=False run) are written
+        metadata_csv (string) : If given, the metadata of all the cells of the dataset (written in this run or
+            in a previous one) are saved to this csv file
+        n_workers (int) : number of processes reading / writing the images (all the cores if None)
+        chunksize (int) : number of cells sent to a worker at once
+        packed_folder (string) : If given, the cells and their metadata are also written to a packed store in
+            this folder (c.f packed_store.py). Should not be inside save_folder (it would be read as a class)
+        write_tiff (bool) : If False, only the packed store is written (save_folder then only holds the manifest)
+        shard_size (int) : maximal size of the shards of the packed store, in bytes
+
+    Return the metadata (pandas DataFrame, one row per cell of the dataset)
+    '''
+    start = timer()
+    os.makedirs(save_folder, exist_ok=True)
+    assert write_tiff or packed_folder is not None, "Nothing to write, give a packed_folder or set write_tiff"
+    manifest = read_manifest(save_folder)
+    manifest_path = os.path.join(save_folder, MANIFEST_FILE)
+    if not os.path.exists(manifest_path) or 'outputs' not in pd.read_csv(manifest_path, nrows=0).columns:
+        write_manifest(save_folder, manifest) #New manifest, or written before the outputs were recorded
+    packer = Packed_Store_Writer(packed_folder, shard_size) if packed_folder is not None else None
+    requested = {output for output, wanted in zip(OUTPUTS, (write_tiff, packer is not None)) if wanted}
+
+    metadata = Metadata_Accumulator()
+    unique_ids = []
+    classes = {}
+    done = {} #Outputs already written for the cells that are redone
+    def jobs():
+        for cell in adapter.cells():
+            metadata.append(cell.metadata)
+            unique_ids.append(cell.unique_id)
+            classes[cell.unique_id] = cell.folder
+            status, outputs = manifest.get(cell.unique_id, (None, set()))
+            if packer is not None and cell.unique_id not in packer: #e.g store interrupted before its flush
+                outputs = outputs - {'packed'}
+            #Only the requested outputs that are missing are written (e.g store added to an existing build)
+            missing = requested - outputs
+            if status == 'shape_mismatch' or (status == 'written' and not missing):
+                continue
+            done[cell.unique_id] = outputs
+            save_to = None
+            if 'tiff' in missing:
+                os.makedirs(os.path.join(save_folder,cell.folder), exist_ok=True)
+                save_to = os.path.join(save_folder,cell.folder,cell.unique_id)
+            yield cell.unique_id, save_to, cell.channel_paths, 'packed' in missing
+
+    counts = {'written':0, 'shape_mismatch':0, 'error':0}
+    with open(manifest_path, 'a') as manifest_file, Pool(n_workers) as pool:
+        for i, (unique_id, status, error, img) in enumerate(pool.imap_unordered(_build_cell, jobs(), chunksize=chunksize)):
+            counts[status] += 1
+            if status == 'error': #Not in the manifest, retried at the next run
+                print(f'{unique_id} failed : {error}')
+                continue
+            outputs = done.pop(unique_id)
+            if status == 'written':
+                outputs = outputs | requested
+            if img is not None:
+                packer.write(unique_id, classes[unique_id], img)
+            manifest_file.write(f"{unique_id},{status},{'+'.join(sorted(outputs))}\n")
+            manifest[unique_id] = (status, outputs)
+            if (i+1) % 1000 == 0:
+                if packer is not None:
+                    packer.flush()
+                manifest_file.flush()
+                print(f'{i+1} cells processed ({timer() - start:.1f} seconds)',end='\r')
+        if packer is not None:
+            packer.flush()
+
+    already_done = len(metadata) - sum(counts.values())
+    written = [manifest.get(uid, (None,))[0] == 'written' for uid in unique_ids]
+    metadata = adapter.join_metadata(metadata.to_frame(written))
+    if metadata_csv is not None:
+        metadata.to_csv(metadata_csv, index=False)
+    if packer is not None:
+        packer.close(metadata)
+
+    print(f"{counts['written']} cells written, {already_done} already done, {counts['shape_mismatch']} with channels of different shapes, {counts['error']} errors, in {timer() - start:.1f} seconds")
+    for key, value in adapter.summary().items():
+        print(f'{key} : {value}')
+    return metadata
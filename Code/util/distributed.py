@@ -0,0 +1,164 @@
+# @Author: Sacha Haidinger <sachahai>
+# @Date:   2026-10-18T10:00:00+10:00
+# @Email:  sacha.haidinger@epfl.ch
+# @Project: Learning methods for Cell Profiling
+# @Last modified by:   sachahai
+# @Last modified time: 2026-10-18T10:00:00+10:00
+
+'''
+Data-parallel training on several processes with torch.distributed (gloo backend : multi-core CPU
+machines, and several machines).
+
+Each process trains a replica of the models on its own shard of the training set
+(Distributed_Subset_Sampler, c.f get_train_val_dataloader). After each backward pass, the
+gradients are averaged over all the processes (average_gradients), so that all replicas do the
+same optimizer step, as with DistributedDataParallel. For InfoMAX VAE, the MLP_g embeddings of
+all processes are gathered (all_gather_with_grad) so that the InfoNCE bound keeps the negatives
+of the whole global batch.
+
+The trainers of models/train_net.py switch to this mode automatically when torch.distributed is
+initialized (init_distributed()). Processes are launched with torchrun, c.f Distributed_training.py
+'''
+
+import os
+import math
+
+import torch
+import torch.distributed as dist
+from torch.utils.data import Sampler
+
+
+###############################
+#### Process group ############
+###############################
+
+def init_distributed(backend='gloo'):
+    '''Initialize the process group from the environment variables set by torchrun
+    (RANK, WORLD_SIZE, MASTER_ADDR, MASTER_PORT). Return (rank, world_size)'''
+    if int(os.environ.get('WORLD_SIZE', 1)) > 1 and not dist.is_initialized():
+        dist.init_process_group(backend=backend)
+    return get_rank(), get_world_size()
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+def is_main_process():
+    '''Only the main process saves models, checkpoints and figures'''
+    return get_rank() == 0
+
+
+###############################
+#### Sampler ##################
+###############################
+
+class Distributed_Subset_Sampler(Sampler):
+    '''Shard a subset of a dataset (e.g the training indices of the stratified split) between the
+    processes. At each epoch, the subset is shuffled with the same seed in all the processes, padded
+    to a multiple of num_replicas, and process 'rank' takes one index every num_replicas.
+    All the processes get the same number of samples. Call set_epoch() at the start of each epoch.
+
+    Params :
+        indices (array) : indices of the subset (the same in all the processes)
+        num_replicas (int) : number of processes
+        rank (int) : rank of this process
+        shuffle (boolean) : If True, the subset is shuffled differently at each epoch
+        seed (int) : seed of the shuffling, must be the same in all the processes
+    '''
+    def __init__(self, indices, num_replicas, rank, shuffle=True, seed=0):
+        self.indices = list(indices)
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.num_samples = math.ceil(len(self.indices) / num_replicas)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        if self.shuffle:
+            g = torch.Generator()
+            g.manual_seed(self.seed + self.epoch)
+            order = torch.randperm(len(self.indices), generator=g).tolist()
+        else:
+            order = list(range(len(self.indices)))
+        total_size = self.num_samples * self.num_replicas
+        order = (order * math.ceil(total_size / max(len(order),1)))[:total_size] #pad by repeating
+        return iter([self.indices[i] for i in order[self.rank:total_size:self.num_replicas]])
+
+    def __len__(self):
+        return self.num_samples
+
+
+###############################
+#### Communication ############
+###############################
+
+def broadcast_parameters(*models):
+    '''Same initial weights in all the processes (copy those of rank 0)'''
+    for model in models:
+        for tensor in list(model.parameters()) + list(model.buffers()):
+            dist.broadcast(tensor.data, src=0)
+
+def average_gradients(*models):
+    '''Average the gradients of the models over all the processes, in a single all_reduce
+    (the gradients are flattened in one buffer). Call between backward() and optimizer.step()'''
+    params = [p for model in models for p in model.parameters() if p.requires_grad]
+    for p in params:
+        if p.grad is None:
+            p.grad = torch.zeros_like(p)
+    flat = torch.cat([p.grad.view(-1) for p in params])
+    dist.all_reduce(flat, op=dist.ReduceOp.SUM)
+    flat /= get_world_size()
+    offset = 0
+    for p in params:
+        n = p.numel()
+        p.grad.copy_(flat[offset:offset+n].view_as(p.grad))
+        offset += n
+
+def average_buffers(*models):
+    '''Average the floating point buffers (BatchNorm running statistics) over all the processes'''
+    for model in models:
+        for buffer in model.buffers():
+            if buffer.is_floating_point():
+                dist.all_reduce(buffer.data, op=dist.ReduceOp.SUM)
+                buffer.data /= get_world_size()
+
+def all_reduce_mean(value):
+    '''Mean of a python float over all the processes'''
+    if not is_distributed():
+        return value
+    tensor = torch.tensor([float(value)], dtype=torch.float64)
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor.item() / get_world_size()
+
+
+class All_Gather(torch.autograd.Function):
+    '''Concatenate a tensor of all the processes along dim 0. In the backward pass, each process
+    receives the sum (over all the processes) of the gradients of its own slice'''
+    @staticmethod
+    def forward(ctx, x):
+        gathered = [torch.zeros_like(x) for _ in range(get_world_size())]
+        dist.all_gather(gathered, x.contiguous())
+        ctx.batch_size = x.size(0)
+        return torch.cat(gathered, dim=0)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        grad = grad_output.contiguous()
+        dist.all_reduce(grad, op=dist.ReduceOp.SUM)
+        start = get_rank() * ctx.batch_size
+        return grad[start:start+ctx.batch_size]
+
+def all_gather_with_grad(x):
+    '''B x D tensor of each process -> (world_size x B) x D, rows of process r at [r*B, (r+1)*B)'''
+    if not is_distributed():
+        return x
+    return All_Gather.apply(x)
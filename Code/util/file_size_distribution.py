@@ -3,53 +3,51 @@
 # @Email:  sacha.haidinger@epfl.ch
 # @Project: Learning methods for Cell Profiling
 # @Last modified by:   sachahai
-# @Last modified time: 2020-08-31T10:54:00+10:00
+# @Last modified time: 2026-10-18T10:00:00+10:00
 
 '''
 Quick analysis of the shape ditribution of the single cell images of different datasets
+(the sizes are read from the file headers, c.f image_sizes.py). Run from Code/ :
+
+    python -m util.file_size_distribution
 '''
 
-import os
 import matplotlib.pyplot as plt
 import numpy as np
-from skimage import io
-
-#dataset_folder = '../DataSets/Chaffer_Data/'
-#dataset_folder = '../DataSets/Synthetic_Data_1/'
-dataset_folder = '../DataSets/Peter_Horvath_Subsample/'
-
-all_class_subfolder = [f for f in os.listdir(dataset_folder) if not f.startswith('.')]
-#Store shape -> Tuple
-shapes = []
-for class_subfoler in all_class_subfolder:
-    path_to_files = dataset_folder+class_subfoler+'/'
-    if os.path.isdir(path_to_files):
-
-        all_full_imgs = [f for f in os.listdir(path_to_files) if not f.startswith('.')]
-        for singe_cell in all_full_imgs:
-            img = io.imread(path_to_files+singe_cell)
-            shapes.append(img.shape)
-
-# %% Play with the shapes
-import seaborn
-seaborn.set()
-
-mean = np.mean([shapex[0] for shapex in shapes])
-median = np.median([shapex[0] for shapex in shapes])
-
-plt.figure(figsize=(10,6),dpi=300)
-seaborn.distplot([shapex[0] for shapex in shapes],hist=False,kde=True, rug=True, label='Height')
-seaborn.distplot([shapex[1] for shapex in shapes],hist=False,kde=True, rug=True,  label='Width')
-plt.xlabel('#pixels')
-plt.ylabel('frequencies')
-plt.title(f"Single cell image size distribution of dataset 2, over {len(shapes)} images")
-plt.axvline(median,ls='--',label='median')
-plt.axvline(64,lw=2,color='r',label='FIXED SIZE')
-plt.legend()
-plt.savefig('dataset2_distribution.png')
-
-# %% Analysis of height vs width ratio
-h = np.array([shapex[0] for shapex in shapes])
-w = np.array([shapex[1] for shapex in shapes])
-seaborn.distplot(h/w,rug=True)
-plt.title('Dataset 1, image ratio distribution')
+
+from util.image_sizes import survey_image_sizes, recommend_input_size
+
+
+if __name__ == '__main__':
+    #dataset_folder = 'DataSets/Chaffer_Data/'
+    #dataset_folder = 'DataSets/Synthetic_Data_1/'
+    dataset_folder = 'DataSets/Peter_Horvath_Subsample/'
+
+    sizes = survey_image_sizes(dataset_folder)
+    print(sizes[['height','width']].describe(percentiles=[0.5,0.9,0.99]))
+    input_size, table = recommend_input_size(sizes)
+    print(table.to_string(index=False))
+    print(f'Recommended input_size : {input_size}')
+
+    # %% Play with the shapes
+    import seaborn
+    seaborn.set()
+
+    median = np.median(sizes['height'])
+
+    plt.figure(figsize=(10,6),dpi=300)
+    seaborn.distplot(sizes['height'],hist=False,kde=True, rug=True, label='Height')
+    seaborn.distplot(sizes['width'],hist=False,kde=True, rug=True,  label='Width')
+    plt.xlabel('#pixels')
+    plt.ylabel('frequencies')
+    plt.title(f"Single cell image size distribution of dataset 2, over {len(sizes)} images")
+    plt.axvline(median,ls='--',label='median')
+    plt.axvline(input_size,lw=2,color='r',label='FIXED SIZE')
+    plt.legend()
+    plt.savefig('dataset2_distribution.png')
+
+    # %% Analysis of height vs width ratio
+    h = sizes['height'].to_numpy()
+    w = sizes['width'].to_numpy()
+    seaborn.distplot(h/w,rug=True)
+    plt.title('Dataset 1, image ratio distribution')
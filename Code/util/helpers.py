@@ -32,6 +32,9 @@ from torch import nn
 from torch import cuda
 from torchvision.utils import save_image, make_grid
 
+from util.checkpoint import Checkpoint_Writer, make_checkpoint, write_checkpoint, load_checkpoint as load_training_state
+from util.distributed import is_main_process
+
 ##############################################
 ######## Match Latent Code and Ground Truth
 ##############################################
@@ -151,13 +154,14 @@ def save_reconstruction(loader,VAE,save_path,train_on_gpu):
         - loader (DataLoader) : Dataloader that iterates the dataset by batch
         - VAE (nn.Module) :  trained Pytorch VAE model that will produce latent codes of dataset
         - save_path (string) : path where to save figures
-        - train_on_gpu (boolean) : Wheter infer latent codes on GPU or not.
+        - train_on_gpu (boolean) : Wheter infer latent codes on GPU or not (the model needs to be on the same device)
     '''
 
     data, _, _ = next(iter(loader))
     if train_on_gpu:
         data = Variable(data,requires_grad=False).cuda()
-    x_recon,_,_,_=VAE(data)
+    with torch.no_grad():
+        x_recon,_,_,_=VAE(data)
     img_grid = make_grid(torch.cat((data[:4,:3,:,:],nn.Sigmoid()(x_recon[:4,:3,:,:]))), nrow=4, padding=12, pad_value=1)
 
     pre,ext = os.path.splitext(save_path)
@@ -168,9 +172,10 @@ def save_reconstruction(loader,VAE,save_path,train_on_gpu):
     plt.title(f'Example data and its reconstruction')
     plt.savefig(pre+'reconstructions.png')
 
-    samples = torch.randn(8, VAE.zdim, 1, 1)
-    samples = Variable(samples,requires_grad=False).cuda()
-    recon = VAE.decode(samples)
+    #On the device of the data (CPU or GPU). For large grids and traversals, c.f latent_generation.py
+    samples = torch.randn(8, VAE.zdim, 1, 1, device=data.device)
+    with torch.no_grad():
+        recon = VAE.decode(samples)
     img_grid = make_grid(nn.Sigmoid()(recon[:,:3,:,:]), nrow=4, padding=12, pad_value=1)
 
     plt.figure(figsize=(10,5))
@@ -181,7 +186,65 @@ def save_reconstruction(loader,VAE,save_path,train_on_gpu):
 
 
 
-def plot_from_csv(path_to_csv,low_dim_names=['VAE_x_coord','VAE_y_coord','VAE_z_coord'],dim=3,num_class=7,column=None,as_str=False):
+def decimate_points(MetaData_csv,low_dim_names,max_points,method='density',group=None,n_bins=64,seed=0):
+    '''
+    Subset of at most max_points rows of a latent space DataFrame, to keep large plots light.
+
+    Params :
+        - MetaData_csv (pandas DataFrame) : one row per cell, with the latent codes
+        - low_dim_names ([string]) : columns of the latent codes (2 or 3)
+        - max_points (int) : point budget
+        - method (string) : 'random' -> uniform random subset
+                            'density' -> the latent space is cut in n_bins^dim bins, and at most k points are kept in
+                                each bin (k as large as the budget allows). Dense regions are thinned, sparse regions
+                                and outliers are kept
+        - group (string) : with 'density', the bins are also split by the values of this column (e.g 'GT_label'),
+                so that each class keeps its sparse regions
+        - n_bins (int) : number of bins per latent dimension
+        - seed (int) : random state of the subset
+
+    Return the DataFrame of the kept rows (in their original order)
+    '''
+    n = len(MetaData_csv)
+    if max_points is None or n <= max_points:
+        return MetaData_csv
+    rng = np.random.default_rng(seed)
+    if method == 'random':
+        keep = np.sort(rng.choice(n, max_points, replace=False))
+        return MetaData_csv.iloc[keep]
+    assert method == 'density', f"Unknown decimation method '{method}', expected 'random' or 'density'"
+
+    #Bin of each point (integer code, latent dimensions and group)
+    codes = MetaData_csv[low_dim_names].to_numpy(dtype=np.float64)
+    low, high = np.nanmin(codes, axis=0), np.nanmax(codes, axis=0)
+    bins = np.clip(((codes - low) / np.where(high > low, high - low, 1.) * n_bins).astype(np.int64), 0, n_bins-1)
+    code = (bins * n_bins**np.arange(bins.shape[1])).sum(axis=1)
+    if group is not None:
+        code = code + pd.factorize(MetaData_csv[group])[0] * n_bins**bins.shape[1]
+    _, bin_id, counts = np.unique(code, return_inverse=True, return_counts=True)
+
+    #Largest cap k per bin such that sum(min(counts,k)) <= max_points
+    lo, hi = 0, int(counts.max())
+    while lo < hi:
+        k = (lo + hi + 1) // 2
+        if np.minimum(counts, k).sum() <= max_points:
+            lo = k
+        else:
+            hi = k - 1
+    #Random rank of each point in its bin, the points of rank < k are kept
+    order = rng.permutation(n)
+    order = order[np.argsort(bin_id[order], kind='stable')]
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    rank = np.empty(n, dtype=np.int64)
+    rank[order] = np.arange(n) - starts[bin_id[order]]
+    if lo == 0:
+        #More non-empty bins than the budget : random subset of the bins, one point each
+        return MetaData_csv.iloc[np.sort(rng.choice(np.flatnonzero(rank == 0), max_points, replace=False))]
+    return MetaData_csv.iloc[np.flatnonzero(rank < lo)]
+
+
+def plot_from_csv(path_to_csv,low_dim_names=['VAE_x_coord','VAE_y_coord','VAE_z_coord'],dim=3,num_class=7,column=None,as_str=False,
+        max_points=200000,decimation='density'):
     '''
     Plot on a plotly figure the latent space produced by any methods, already stored in a csv file.
 
@@ -196,6 +259,9 @@ def plot_from_csv(path_to_csv,low_dim_names=['VAE_x_coord','VAE_y_coord','VAE_z_
                 than using the 'GT_Label' class identity
         - as_str (boolean) : If a 'column' name is given, and as_str is set to True, every unique value is considered as a
                 class and will be colored by a different color. If set to False and values are int or float, a colorbar is used.
+        - max_points (int) : point budget of the figure (None to plot all the points). Larger datasets are decimated
+                (c.f decimate_points), the exported html file stays small and interactive with millions of cells
+        - decimation (string) : 'density' or 'random', c.f decimate_points
 
     Example :
     plot_from_csv(path_to_csv=...,low_dim_names=...,num_class=7) : Latent Codes color-coded based on int values (1-7) stored in 'GT_Label' column
@@ -206,13 +272,21 @@ def plot_from_csv(path_to_csv,low_dim_names=['VAE_x_coord','VAE_y_coord','VAE_z_
     else:
         MetaData_csv = path_to_csv
 
+    class_colors = column is None or dim == 2
+    group = 'GT_label' if class_colors else (column if as_str else None)
+    MetaData_csv = decimate_points(MetaData_csv,low_dim_names[:dim],max_points,method=decimation,group=group)
+    #Split the frame once per class. float32 latent codes halve the size of the html file
+    if class_colors:
+        groups = {label: df[low_dim_names[:dim]].to_numpy(dtype=np.float32) for label, df in MetaData_csv.groupby('GT_label')}
+        empty = np.zeros((0,dim), dtype=np.float32)
+
     if dim == 3:
         if column==None:
         ##### Fig 1 : Plot each single cell in latent space with GT cluster labels
             traces = []
             for i in range(num_class):
-                scatter = go.Scatter3d(x=MetaData_csv[MetaData_csv['GT_label']==i+1][low_dim_names[0]].values,y=MetaData_csv[MetaData_csv['GT_label']==i+1][low_dim_names[1]].values,
-                    z=MetaData_csv[MetaData_csv['GT_label']==i+1][low_dim_names[2]].values, mode='markers',
+                codes = groups.get(i+1, empty)
+                scatter = go.Scatter3d(x=codes[:,0],y=codes[:,1],z=codes[:,2], mode='markers',
                     marker=dict(size=3, opacity=1),
                     name=f'Cluster {i+1}')
                 traces.append(scatter)
@@ -223,6 +297,7 @@ def plot_from_csv(path_to_csv,low_dim_names=['VAE_x_coord','VAE_y_coord','VAE_z_
             return fig_3d_1
         else :
             #Color from the info store in 'column' pass in argument
+            MetaData_csv = MetaData_csv[low_dim_names[:3]+[column]].astype({name:np.float32 for name in low_dim_names[:3]})
             if as_str:
                 MetaData_csv[column]=MetaData_csv[column].astype(str)
             fig = px.scatter_3d(MetaData_csv,x=low_dim_names[0],y=low_dim_names[1],z=low_dim_names[2],color=column,color_discrete_sequence=px.colors.qualitative.T10+px.colors.qualitative.Alphabet)
@@ -231,10 +306,11 @@ def plot_from_csv(path_to_csv,low_dim_names=['VAE_x_coord','VAE_y_coord','VAE_z_
 
     if dim == 2:
 
+        #Scattergl : WebGL rendering, stays interactive with hundreds of thousands of points
         traces = []
-        MS = MetaData_csv
         for i in range(num_class):
-            scatter = go.Scatter(x=MS[MetaData_csv['GT_label']==i+1][low_dim_names[0]].values,y=MS[MetaData_csv['GT_label']==i+1][low_dim_names[1]].values,
+            codes = groups.get(i+1, empty)
+            scatter = go.Scattergl(x=codes[:,0],y=codes[:,1],
                 mode='markers',
                 marker=dict(size=3, opacity=0.8),
                 name=f'Cluster {i+1}')
@@ -320,7 +396,12 @@ def plot_train_result(history, best_epoch=None,save_path=None, infoMAX = False):
 
 class EarlyStopping:
     """Early stops the training if validation loss doesn't improve after a given patience.
-    This class is obtained from Bjarten Implementation (GitHub open source), thanks to him"""
+    This class is obtained from Bjarten Implementation (GitHub open source), thanks to him
+
+    The best models are saved in the checkpoint format of util/checkpoint.py (reload them with
+    load_checkpoint()). Their state is copied to CPU in the training loop and written by a background
+    thread; if a new best model arrives before the previous one is written, only the latest is kept.
+    Call close() at the end of the training to wait for the last write."""
     def __init__(self, patience=7, verbose=False, delta=0, path='checkpoint.pt'):
         """
         Args:
@@ -342,6 +423,7 @@ class EarlyStopping:
         self.val_loss_min = np.Inf
         self.delta = delta
         self.path = path
+        self.writer = Checkpoint_Writer()
 
     def __call__(self, val_loss, VAE, MLP=None):
 
@@ -365,17 +447,35 @@ class EarlyStopping:
         self.stop_epoch = VAE.epochs
         if self.verbose:
             print(f'Validation loss decreased ({self.val_loss_min:.6f} --> {val_loss:.6f}).  Saving model ...')
-        #Save both models
+        #Save both models, CPU snapshot now, written in the background
+        #In distributed training, models are identical in all the processes, only the main one saves them
         pre, ext = os.path.splitext(self.path)
-        save_brute(VAE,pre+f'_VAE_.pth')
-        if MLP != None:
-            save_brute(MLP,pre+f'_MLP_.pth')
-        #torch.save(model.state_dict(), self.path)
+        if is_main_process():
+            self.writer.submit(make_checkpoint(VAE.epochs, {'model':VAE}), pre+f'_VAE_.pth')
+            if MLP != None:
+                self.writer.submit(make_checkpoint(VAE.epochs, {'model':MLP}), pre+f'_MLP_.pth')
         self.val_loss_min = val_loss
 
+    def flush(self):
+        '''Wait until the best models submitted so far are written'''
+        self.writer.flush()
+
+    def close(self):
+        self.writer.close()
+
+    def state_dict(self):
+        '''State needed to resume the early stopping (c.f util/checkpoint.py)'''
+        return {'counter':self.counter, 'best_score':self.best_score, 'early_stop':self.early_stop,
+            'stop_epoch':self.stop_epoch, 'val_loss_min':self.val_loss_min}
+
+    def load_state_dict(self, state):
+        for key, value in state.items():
+            setattr(self, key, value)
+
 
 def save_checkpoint(model, path):
-    """Save a NN model to path.
+    """Save a NN model to path, with its optimizer if attached (model.optimizer),
+    in the versioned checkpoint format of util/checkpoint.py
 
     Params
     --------
@@ -387,25 +487,8 @@ def save_checkpoint(model, path):
         None, save the `model` to `path`
 
     """
-    # Basic details, as mapping id to classe and number of epochs already trained
-    checkpoint = {
-        'epochs': model.epochs,
-        'zdim' : model.zdim,
-        'channels' : model.channels,
-        'layer_count' : model.layer_count,
-        'base' : model.base,
-        'loss' : model.loss,
-        'input_size' : model.input_size,
-        'model_type' : model.model_type
-    }
-    checkpoint['state_dict'] = model.state_dict() #Weights
-
-    # Add the optimizer
-    checkpoint['optimizer'] = model.optimizer
-    checkpoint['optimizer_state_dict'] = model.optimizer.state_dict()
-
-    # Save the data to the path
-    torch.save(checkpoint, path)
+    optimizers = {'model':model.optimizer} if hasattr(model, 'optimizer') else None
+    write_checkpoint(make_checkpoint(getattr(model, 'epochs', 0), {'model':model}, optimizers), path)
 
 def save_brute(model, path):
     '''Save the entire model
@@ -420,29 +503,20 @@ def load_brute(path):
     return torch.load(path)
 
 def load_checkpoint(path):
-    """Load a VAE network, pre-trained on single cell images
+    """Load a VAE network, pre-trained on single cell images.
+    The model is rebuilt from the config saved in the checkpoint (any model class of the repo)
 
     Params
     --------
-        path (str): saved model checkpoint. Must end in '.pth'
+        path (str): saved model checkpoint (c.f save_checkpoint). Must end in '.pth'
 
     Returns
     --------
-        None, load the `model` from `path`
+        model, optimizer (None if no optimizer was saved)
 
     """
-    # Load in checkpoint
-    train_on_gpu = cuda.is_available()
-    if train_on_gpu:
-        checkpoint = torch.load(path)
-    else :
-        checkpoint = torch.load(path,map_location='cpu')  #If saved from GPU, need to be reload on GPU as well !
-
-    if checkpoint['model_type'] == 'VAE_CNN_vanilla' :
-        model = VAE(zdim=checkpoint['zdim'],channels=checkpoint['channels'],base=checkpoint['base'],loss=checkpoint['loss'],layer_count=checkpoint['layer_count'],input_size=checkpoint['input_size'])
-
-    # Load in the state dict
-    model.load_state_dict(checkpoint['state_dict'])
+    checkpoint = load_training_state(path, restore_rng=False)
+    model = checkpoint['models']['model']
 
     total_params = sum(p.numel() for p in model.parameters())
     print(f'{total_params:,} total parameters.')
@@ -450,14 +524,10 @@ def load_checkpoint(path):
         p.numel() for p in model.parameters() if p.requires_grad)
     print(f'{total_trainable_params:,} total gradient parameters.')
 
-    if train_on_gpu:
-        model = model.to('cuda')
-
-    model.epochs = checkpoint['epochs']
+    model.epochs = checkpoint['epoch']
 
     # Optimizer
-    optimizer = checkpoint['optimizer']
-    optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+    optimizer = checkpoint['optimizers'].get('model')
 
     return model, optimizer
 
@@ -0,0 +1,154 @@
+# @Author: Sacha Haidinger <sachahai>
+# @Date:   2026-10-18T10:00:00+10:00
+# @Email:  sacha.haidinger@epfl.ch
+# @Project: Learning methods for Cell Profiling
+# @Last modified by:   sachahai
+# @Last modified time: 2026-10-18T10:00:00+10:00
+
+'''
+Size of the single cell images of a dataset, read from the file headers (no decoding) or from the
+index of a packed store. No plotting here : used by the data loading (util/bucketing.py) and by the
+analysis script file_size_distribution.py.
+
+survey_image_sizes() reads the headers in a pool of threads, and recommend_input_size() gives for each
+candidate input_size the fraction of cells that zPad_or_Rescale would zero pad or downscale, to choose
+the input_size of a dataset.
+
+    sizes = survey_image_sizes('DataSets/Peter_Horvath_Subsample/')
+    input_size, table = recommend_input_size(sizes)
+'''
+
+import os
+import json
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+from util.packed_store import is_packed_store, read_index
+
+IMG_EXTENSIONS = ('.png','.jpg','.tif','.tiff')
+
+
+###############################
+#### Survey ###################
+###############################
+
+def _tiff_shape(path):
+    '''Shape of a classic TIFF file from the tags of its first IFD (~20x faster than opening it with
+    tifffile). Files written by tifffile (e.g by build_dataset) store their shape in the ImageDescription :
+    H x W x C images with C not in (3,4) are saved as H pages of W x C, only the description has the shape.
+    Return None if the file can't be parsed this way (e.g BigTIFF)'''
+    with open(path, 'rb') as f:
+        header = f.read(8)
+        if len(header) < 8 or header[:2] not in (b'II', b'MM'):
+            return None
+        order = '<' if header[:2] == b'II' else '>'
+        magic, ifd_offset = struct.unpack(order+'HI', header[2:8])
+        if magic != 42:
+            return None
+        f.seek(ifd_offset)
+        n_tags, = struct.unpack(order+'H', f.read(2))
+        entries = f.read(12*n_tags)
+        tags = {}
+        for k in range(n_tags):
+            tag, dtype, count, value = struct.unpack(order+'HHI4s', entries[12*k:12*k+12])
+            if tag in (256, 257, 277):
+                tags[tag] = struct.unpack(order+('H' if dtype == 3 else 'I'), value[:2] if dtype == 3 else value)[0]
+            elif tag == 270 and dtype == 2:
+                if count <= 4:
+                    tags[tag] = value[:count]
+                else:
+                    f.seek(struct.unpack(order+'I', value)[0])
+                    tags[tag] = f.read(count)
+    description = tags.get(270, b'').rstrip(b'\x00')
+    if description.startswith(b'{'):
+        try:
+            return tuple(json.loads(description)['shape'])
+        except (ValueError, KeyError):
+            pass
+    if 256 not in tags or 257 not in tags:
+        return None
+    return tags[257], tags[256], tags.get(277, 1)
+
+
+def image_shape(path):
+    '''(height, width, channels) of an image file, read from its header only'''
+    if path.lower().endswith(('.tif','.tiff')):
+        shape = _tiff_shape(path)
+        if shape is None:
+            import tifffile
+            with tifffile.TiffFile(path) as tif:
+                shape = tif.series[0].shape
+    else:
+        with Image.open(path) as img:
+            shape = (img.height, img.width, len(img.getbands()))
+    return shape[0], shape[1], (shape[2] if len(shape) > 2 else 1)
+
+
+def survey_image_sizes(dataset_folder, n_workers=16):
+    '''
+    Size of all the single cell images of a dataset (one subfolder per class, c.f data_processing.py),
+    from the file headers. The files are read by a pool of threads (I/O bound).
+    For a packed store (c.f packed_store.py), the sizes are read from its index.
+
+    Params :
+        dataset_folder (string) : folder of the dataset
+        n_workers (int) : number of threads
+
+    Return a DataFrame, one row per image : file, class, height, width, channels
+    '''
+    if is_packed_store(dataset_folder):
+        index = read_index(dataset_folder)
+        return pd.DataFrame({'file':index['Unique_ID'], 'class':index['class'], 'height':index['height'],
+            'width':index['width'], 'channels':index['channels']})
+
+    files, classes = [], []
+    for class_subfolder in sorted(f for f in os.listdir(dataset_folder) if not f.startswith('.')):
+        path_to_files = os.path.join(dataset_folder, class_subfolder)
+        if os.path.isdir(path_to_files):
+            for single_cell in sorted(os.listdir(path_to_files)):
+                if single_cell.lower().endswith(IMG_EXTENSIONS) and not single_cell.startswith('.'):
+                    files.append(os.path.join(path_to_files, single_cell))
+                    classes.append(class_subfolder)
+
+    with ThreadPoolExecutor(n_workers) as executor:
+        shapes = list(executor.map(image_shape, files))
+
+    sizes = pd.DataFrame(shapes, columns=['height','width','channels'])
+    sizes.insert(0, 'class', classes)
+    sizes.insert(0, 'file', [os.path.basename(f) for f in files])
+    return sizes
+
+
+def recommend_input_size(sizes, candidates=(64,128), max_downscaled=0.05):
+    '''
+    Effect of zPad_or_Rescale for each candidate input_size : a cell is zero padded if it fits in
+    input_size x input_size, and downscaled (anti-aliased resize, expensive and lossy) otherwise.
+
+    Params :
+        sizes (DataFrame) : output of survey_image_sizes()
+        candidates (tuple) : input sizes to compare (64 and 128 are the sizes of the networks in models/)
+        max_downscaled (float) : the recommended input_size is the smallest candidate that downscales
+            at most this fraction of the cells (the largest candidate if none)
+
+    Return the recommended input_size, and a DataFrame with one row per candidate : fraction of cells
+    padded / downscaled, mean fraction of the input that is image (not padding) for the padded cells,
+    and median downscale factor (longest side / input_size) of the downscaled cells
+    '''
+    h = sizes['height'].to_numpy()
+    w = sizes['width'].to_numpy()
+    rows = []
+    for input_size in sorted(candidates):
+        padded = (h <= input_size) & (w <= input_size)
+        fill = h[padded] * w[padded] / input_size**2
+        factor = np.maximum(h[~padded], w[~padded]) / input_size
+        rows.append({'input_size':input_size, 'padded':padded.mean(), 'downscaled':1 - padded.mean(),
+            'padded_fill':fill.mean() if len(fill) else np.nan, 'downscale_factor':np.median(factor) if len(factor) else np.nan})
+    table = pd.DataFrame(rows)
+
+    ok = table[table['downscaled'] <= max_downscaled]
+    recommended = int(ok['input_size'].iloc[0] if len(ok) else table['input_size'].iloc[-1])
+    return recommended, table
@@ -0,0 +1,332 @@
+# @Author: Sacha Haidinger <sachahai>
+# @Date:   2026-10-18T10:00:00+10:00
+# @Email:  sacha.haidinger@epfl.ch
+# @Project: Learning methods for Cell Profiling
+# @Last modified by:   sachahai
+# @Last modified time: 2026-10-18T10:00:00+10:00
+
+'''
+Images generated by the decoder of a trained VAE over the latent space, to interpret its axes and clusters.
+
+    - generate_latent_grid() : regular grid of latent codes (e.g 32^3 points of a 3D latent space),
+        one mosaic per slice of the first latent dimension (rows : second dimension, columns : third)
+    - generate_cluster_traversals() : from the latent code mean of each cluster (e.g GT_label of the
+        metadata csv of metadata_latent_space), one row per latent dimension, moved across its range
+        while the other ones stay at the cluster mean. One mosaic per cluster
+
+All the codes go through decode_latents(), that decodes them in chunks on the device of the model (CPU or GPU).
+The chunk size is the largest one whose decoder activations fit in memory_cap_mb, estimated from a probe
+decoding. The mosaics are written (PNG) as soon as they are full, the images of the whole grid are never
+in memory at once. The number of decoded images per second is reported.
+
+    stats = generate_latent_grid(VAE, 'latent_grid/', points_per_dim=32, bounds=(-3,3))
+    stats = generate_cluster_traversals(VAE, 'traversals/', metadata_csv, label_column='GT_label')
+'''
+
+import os
+from timeit import default_timer as timer
+
+import numpy as np
+import pandas as pd
+import torch
+from PIL import Image
+
+from util.sprites import to_rgb_thumbnails
+
+
+###############################
+#### Latent codes #############
+###############################
+
+def latent_bounds(codes, quantile=0.01):
+    '''(zdim x 2) low / high bound of each latent dimension : quantiles of the latent codes (N x zdim)
+    of a dataset, robust to a few outliers'''
+    codes = np.asarray(codes, dtype=np.float64)
+    return np.stack([np.quantile(codes, quantile, axis=0), np.quantile(codes, 1-quantile, axis=0)], axis=1)
+
+
+def _per_dim_bounds(bounds, n_dims):
+    bounds = np.asarray(bounds, dtype=np.float64)
+    if bounds.ndim == 1:
+        bounds = np.tile(bounds, (n_dims,1))
+    assert bounds.shape == (n_dims,2), f'bounds should be (low, high) or one (low, high) per dimension ({n_dims})'
+    return bounds
+
+
+def latent_grid(zdim, points_per_dim=32, bounds=(-3.,3.), dims=None, center=None):
+    '''
+    Regular grid of latent codes, (points_per_dim^len(dims) x zdim) float32 ndarray. The first
+    dimension of dims varies the slowest
+
+    Params :
+        zdim (int) : dimension of the latent space
+        points_per_dim (int) : number of points along each dimension of the grid
+        bounds (tuple or array) : (low, high) of the grid, for all dims or one row per dimension of dims
+        dims (list of int) : latent dimensions of the grid (all of them if None)
+        center (array) : value of the latent dimensions that are not in the grid (0 if None)
+    '''
+    dims = list(range(zdim)) if dims is None else list(dims)
+    bounds = _per_dim_bounds(bounds, len(dims))
+    axes = [np.linspace(low, high, points_per_dim) for low, high in bounds]
+    mesh = np.meshgrid(*axes, indexing='ij')
+    codes = np.tile(np.zeros(zdim) if center is None else np.asarray(center, dtype=np.float64), (mesh[0].size,1))
+    for d, values in zip(dims, mesh):
+        codes[:,d] = values.ravel()
+    return codes.astype(np.float32)
+
+
+def cluster_traversals(codes, labels, n_steps=11, bounds=None):
+    '''
+    Traversal of each latent dimension through the mean latent code of each cluster
+
+    Params :
+        codes (array) : N x zdim latent codes
+        labels (array) : cluster of each code
+        n_steps (int) : number of points of each traversal
+        bounds (array) : (low, high) of the traversals, for all dimensions or one row per dimension
+            (latent_bounds of the codes if None)
+
+    Return the clusters (sorted), their mean codes (n_clusters x zdim) and the traversal codes,
+    (n_clusters * zdim * n_steps) x zdim float32 : cluster, then dimension, then step
+    '''
+    codes = np.asarray(codes, dtype=np.float64)
+    labels = np.asarray(labels)
+    zdim = codes.shape[1]
+    bounds = latent_bounds(codes) if bounds is None else _per_dim_bounds(bounds, zdim)
+    clusters = np.unique(labels)
+    means = np.stack([codes[labels == c].mean(axis=0) for c in clusters])
+    steps = np.stack([np.linspace(low, high, n_steps) for low, high in bounds]) # zdim x n_steps
+
+    traversals = np.repeat(means[:,None,None,:], zdim, axis=1).repeat(n_steps, axis=2) # clusters x zdim x n_steps x zdim
+    for d in range(zdim):
+        traversals[:,d,:,d] = steps[d]
+    return clusters, means, traversals.reshape(-1, zdim).astype(np.float32)
+
+
+###############################
+#### Decoding #################
+###############################
+
+def _model_device(VAE):
+    return next(VAE.parameters()).device
+
+
+def decode_bytes_per_sample(VAE):
+    '''Estimated memory (bytes) used to decode one latent code : largest input + output of a layer
+    of the decoder, plus the decoded image (float32 and its sigmoid), measured on a probe batch'''
+    sizes = []
+    def hook(module, inputs, output):
+        if torch.is_tensor(output):
+            sizes.append(output[0].numel() * output.element_size())
+    handles = [m.register_forward_hook(hook) for m in VAE.modules() if len(list(m.children())) == 0]
+    try:
+        with torch.no_grad():
+            z = torch.zeros(2, VAE.zdim, 1, 1, device=_model_device(VAE))
+            recon = VAE.decode(z)
+    finally:
+        for handle in handles:
+            handle.remove()
+    image = recon[0].numel() * recon.element_size()
+    layer_peak = max([a + b for a, b in zip(sizes[:-1], sizes[1:])] + sizes + [0])
+    return layer_peak + 2*image
+
+
+def decode_latents(VAE, codes, memory_cap_mb=1024, chunk_size=None):
+    '''
+    Decode latent codes in chunks, on the device of the model, without gradients and in eval mode.
+    Generator of (start index, B x C x H x W float tensor on the device, after sigmoid)
+
+    Params :
+        VAE (nn.Module) : trained VAE (decode() of models/)
+        codes (array or tensor) : N x zdim latent codes
+        memory_cap_mb (float) : memory budget of a chunk (decoder activations), in MB
+        chunk_size (int) : number of codes decoded at once (from memory_cap_mb if None)
+    '''
+    device = _model_device(VAE)
+    was_training = VAE.training
+    VAE.eval()
+    if chunk_size is None:
+        chunk_size = max(1, int(memory_cap_mb * 2**20 // decode_bytes_per_sample(VAE)))
+    codes = torch.as_tensor(codes, dtype=torch.float32)
+    try:
+        with torch.no_grad():
+            for start in range(0, len(codes), chunk_size):
+                z = codes[start:start+chunk_size].to(device, non_blocking=True)
+                yield start, torch.sigmoid(VAE.decode(z.view(-1, VAE.zdim, 1, 1)))
+    finally:
+        VAE.train(was_training)
+
+
+class Mosaic_Writer(object):
+    '''
+    Images written one after the other in the cells of a grid (white background). Each mosaic is
+    saved as a PNG as soon as it is full, and its canvas reused for the next one
+
+    Params :
+        save_folder (string) : where to save the mosaics
+        names (list of string) : file name (without extension) of each mosaic
+        per_mosaic (int) : number of images per mosaic
+        ncols (int) : number of images per row
+        image_size (int) : size of the images (pixels)
+        padding (int) : white pixels between the images
+    '''
+    def __init__(self, save_folder, names, per_mosaic, ncols, image_size, padding=2):
+        os.makedirs(save_folder, exist_ok=True)
+        self.save_folder = save_folder
+        self.names = list(names)
+        self.per_mosaic = per_mosaic
+        self.ncols = ncols
+        self.image_size = image_size
+        self.padding = padding
+        self.step = image_size + padding
+        nrows = (per_mosaic + ncols - 1) // ncols
+        self.canvas = np.full((nrows*self.step + padding, ncols*self.step + padding, 3), 255, dtype=np.uint8)
+        self.n = 0
+        self.paths = []
+
+    def _save(self, mosaic):
+        path = os.path.join(self.save_folder, self.names[mosaic] + '.png')
+        Image.fromarray(self.canvas).save(path)
+        self.paths.append(path)
+        self.canvas[:] = 255
+
+    def write(self, images):
+        '''images : B x image_size x image_size x 3 uint8 ndarray'''
+        for image in images:
+            slot = self.n % self.per_mosaic
+            y, x = (slot // self.ncols) * self.step + self.padding, (slot % self.ncols) * self.step + self.padding
+            self.canvas[y:y+self.image_size, x:x+self.image_size] = image
+            self.n += 1
+            if self.n % self.per_mosaic == 0:
+                self._save(self.n // self.per_mosaic - 1)
+
+    def close(self):
+        '''Save the last mosaic if incomplete. Return the paths of all the mosaics'''
+        if self.n % self.per_mosaic:
+            self._save(self.n // self.per_mosaic)
+        return self.paths
+
+
+def _decode_to_mosaics(VAE, codes, writer, thumb_size, memory_cap_mb, chunk_size):
+    '''Decode all the codes into the writer, return the throughput statistics'''
+    device = _model_device(VAE)
+    decode_seconds = 0.
+    start = timer()
+    tic = timer()
+    for _, images in decode_latents(VAE, codes, memory_cap_mb, chunk_size):
+        #Only the RGB channels leave the device
+        images = images[:,:3].float()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        decode_seconds += timer() - tic
+        writer.write(to_rgb_thumbnails(images.cpu(), thumb_size))
+        tic = timer()
+    paths = writer.close()
+    seconds = timer() - start
+    stats = {'images':len(codes), 'mosaics':len(paths), 'seconds':seconds, 'images_per_s':len(codes) / max(seconds,1e-9),
+        'decode_images_per_s':len(codes) / max(decode_seconds,1e-9), 'paths':paths}
+    print(f"{len(codes)} images decoded in {len(paths)} mosaics, in {seconds:.1f} seconds ({stats['images_per_s']:.0f} images/s, "
+        f"{stats['decode_images_per_s']:.0f} images/s decoding only)")
+    return stats
+
+
+def _image_size(VAE, thumb_size):
+    if thumb_size is not None:
+        return thumb_size
+    was_training = VAE.training
+    VAE.eval()
+    with torch.no_grad():
+        size = VAE.decode(torch.zeros(1, VAE.zdim, 1, 1, device=_model_device(VAE))).shape[-1]
+    VAE.train(was_training)
+    return size
+
+
+###############################
+#### Generation ###############
+###############################
+
+def generate_latent_grid(VAE, save_folder, points_per_dim=32, bounds=(-3.,3.), dims=None, center=None,
+    thumb_size=None, padding=2, memory_cap_mb=1024, chunk_size=None):
+    '''
+    Decode a regular grid of the latent space, and save it as mosaics : one per value of the first
+    dimension of the grid, whose rows / columns follow the second / third dimensions (a single mosaic
+    row for a 2D grid). The codes of the grid are saved in grid.csv (mosaic, row, column, code)
+
+    Params :
+        VAE (nn.Module) : trained VAE, on the device where to decode (CPU or GPU)
+        save_folder (string) : where to save the mosaics
+        points_per_dim (int) : number of points along each dimension of the grid
+        bounds (tuple or array) : (low, high) of the grid, for all dims or one row per dimension
+            (e.g latent_bounds() of the latent codes of a dataset). Default is +-3 std of the prior
+        dims (list of int) : latent dimensions of the grid, at most 3 (the first 3 if None)
+        center (array) : value of the other latent dimensions (0 if None)
+        thumb_size (int) : size of the images in the mosaics (size of the decoder output if None)
+        padding (int) : white pixels between the images
+        memory_cap_mb (float) : memory budget of the decoding of a chunk, in MB
+        chunk_size (int) : number of codes decoded at once (from memory_cap_mb if None)
+
+    Return a dictionary of statistics : number of images and mosaics, seconds, images per second
+    (with and without the writing of the mosaics), and the paths of the mosaics
+    '''
+    dims = list(range(min(VAE.zdim,3))) if dims is None else list(dims)
+    assert 1 <= len(dims) <= 3, 'The grid spans 1 to 3 latent dimensions'
+    codes = latent_grid(VAE.zdim, points_per_dim, bounds, dims, center)
+    per_mosaic = points_per_dim**(len(dims)-1) if len(dims) > 1 else points_per_dim
+    n_mosaics = len(codes) // per_mosaic
+
+    os.makedirs(save_folder, exist_ok=True)
+    names = [f'grid_{k:03d}' for k in range(n_mosaics)]
+    slot = np.arange(len(codes)) % per_mosaic
+    table = pd.DataFrame({'mosaic':np.repeat(names, per_mosaic), 'row':slot // points_per_dim if len(dims) == 3 else 0,
+        'column':slot % points_per_dim})
+    for d in range(VAE.zdim):
+        table[f'z{d}'] = codes[:,d]
+    table.to_csv(os.path.join(save_folder, 'grid.csv'), index=False)
+
+    image_size = _image_size(VAE, thumb_size)
+    writer = Mosaic_Writer(save_folder, names, per_mosaic, points_per_dim, image_size, padding)
+    return _decode_to_mosaics(VAE, codes, writer, image_size, memory_cap_mb, chunk_size)
+
+
+def generate_cluster_traversals(VAE, save_folder, metadata_csv, label_column='GT_label',
+    low_dim_names=['VAE_x_coord','VAE_y_coord','VAE_z_coord'], n_steps=11, bounds=None,
+    thumb_size=None, padding=2, memory_cap_mb=1024, chunk_size=None):
+    '''
+    Decode the traversals of each latent dimension through the mean latent code of each cluster
+    (c.f cluster_traversals), all the clusters in the same chunked decoding. One mosaic per cluster
+    (traversal_<cluster>.png), with one row per latent dimension and n_steps columns. The cluster
+    means are saved in cluster_means.csv
+
+    Params :
+        VAE (nn.Module) : trained VAE, on the device where to decode (CPU or GPU)
+        save_folder (string) : where to save the mosaics
+        metadata_csv (string or DataFrame) : latent codes and labels of a dataset (c.f metadata_latent_space)
+        label_column (string) : column of the clusters
+        low_dim_names (list of string) : columns of the latent codes (the first VAE.zdim are used)
+        n_steps (int) : number of points of each traversal
+        bounds (tuple or array) : (low, high) of the traversals, for all dimensions or one row per
+            dimension (1% - 99% quantiles of the latent codes if None)
+        thumb_size (int) : size of the images in the mosaics (size of the decoder output if None)
+        padding (int) : white pixels between the images
+        memory_cap_mb (float) : memory budget of the decoding of a chunk, in MB
+        chunk_size (int) : number of codes decoded at once (from memory_cap_mb if None)
+
+    Return a dictionary of statistics, as generate_latent_grid
+    '''
+    if isinstance(metadata_csv, str):
+        metadata_csv = pd.read_csv(metadata_csv)
+    metadata_csv = metadata_csv.dropna(subset=[label_column])
+    low_dim_names = list(low_dim_names)[:VAE.zdim]
+    assert len(low_dim_names) == VAE.zdim, f'{VAE.zdim} latent code columns are needed'
+    clusters, means, codes = cluster_traversals(metadata_csv[low_dim_names].to_numpy(),
+        metadata_csv[label_column].to_numpy(), n_steps, bounds)
+
+    os.makedirs(save_folder, exist_ok=True)
+    means_table = pd.DataFrame(means, columns=low_dim_names)
+    means_table.insert(0, label_column, clusters)
+    means_table.to_csv(os.path.join(save_folder, 'cluster_means.csv'), index=False)
+
+    image_size = _image_size(VAE, thumb_size)
+    names = [f'traversal_{c}' for c in clusters]
+    writer = Mosaic_Writer(save_folder, names, VAE.zdim*n_steps, n_steps, image_size, padding)
+    return _decode_to_mosaics(VAE, codes, writer, image_size, memory_cap_mb, chunk_size)
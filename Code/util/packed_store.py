@@ -0,0 +1,178 @@
+# @Author: Sacha Haidinger <sachahai>
+# @Date:   2026-10-18T10:00:00+10:00
+# @Email:  sacha.haidinger@epfl.ch
+# @Project: Learning methods for Cell Profiling
+# @Last modified by:   sachahai
+# @Last modified time: 2026-10-18T10:00:00+10:00
+
+'''
+Packed single cell dataset : all the cells in a few large files instead of one tiff file per cell.
+
+A packed store is a folder with :
+    - shard_XXXXX.bin : raw pixels (H x W x C, C order) of the cells, appended one after the other.
+            A new shard is started when the current one would exceed shard_size bytes
+    - index.csv : one row per cell, Unique_ID, class (subfolder name of the tiff dataset), shard,
+            offset and shape / dtype of the cell in the shard. Crops keep their native size
+    - metadata.csv : the metadata of the cells (same as the metadata csv of build_dataset())
+
+It is written by build_dataset(..., packed_folder=...) in the same pass as (or instead of) the tiff
+files, and read with memory maps by Packed_Dataset. get_train_val_dataloader() and
+get_inference_dataset() (c.f data_processing.py) use a Packed_Dataset when their folder is a packed store.
+'''
+
+import os
+
+import numpy as np
+import pandas as pd
+from skimage.util import img_as_float
+from torch.utils.data import Dataset
+
+INDEX_FILE = 'index.csv'
+METADATA_FILE = 'metadata.csv'
+INDEX_COLUMNS = ['Unique_ID','class','shard','offset','height','width','channels','dtype']
+
+
+def is_packed_store(folder):
+    return os.path.isfile(os.path.join(folder, INDEX_FILE))
+
+def shard_path(folder, shard):
+    return os.path.join(folder, f'shard_{shard:05d}.bin')
+
+def read_index(folder):
+    '''Index of a packed store. A cell written twice (build interrupted and resumed) keeps its last copy'''
+    index = pd.read_csv(os.path.join(folder, INDEX_FILE), dtype={'Unique_ID':str, 'class':str, 'dtype':str})
+    return index.drop_duplicates('Unique_ID', keep='last').reset_index(drop=True)
+
+
+###############################
+#### Writer ###################
+###############################
+
+class Packed_Store_Writer(object):
+    '''
+    Append cells to a packed store. The store can be reopened to append more cells (resumed build) :
+    the writing continues at the end of the last shard.
+
+    Params :
+        folder (string) : folder of the packed store (created if needed)
+        shard_size (int) : maximal size of a shard in bytes (a larger single cell gets its own shard)
+    '''
+    def __init__(self, folder, shard_size=256*2**20):
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.shard_size = shard_size
+        index_path = os.path.join(folder, INDEX_FILE)
+        if os.path.exists(index_path):
+            index = read_index(folder)
+            self.unique_ids = set(index['Unique_ID'])
+            self.shard = int(index['shard'].max()) if len(index) else 0
+        else:
+            with open(index_path, 'w') as f:
+                f.write(','.join(INDEX_COLUMNS)+'\n')
+            self.unique_ids = set()
+            self.shard = 0
+        self.shard_file = open(shard_path(folder, self.shard), 'ab')
+        self.index_file = open(index_path, 'a')
+        self.pending = [] #Index rows of the cells not flushed yet
+
+    def __contains__(self, unique_id):
+        return unique_id in self.unique_ids
+
+    def write(self, unique_id, class_name, img):
+        img = np.ascontiguousarray(img)
+        if img.ndim == 2:
+            img = img[:,:,None]
+        offset = self.shard_file.tell()
+        if offset > 0 and offset + img.nbytes > self.shard_size:
+            self._sync_shard()
+            self.shard_file.close()
+            self.shard += 1
+            self.shard_file = open(shard_path(self.folder, self.shard), 'ab')
+            offset = self.shard_file.tell()
+        self.shard_file.write(img.tobytes())
+        h, w, c = img.shape
+        self.pending.append(f'{unique_id},{class_name},{self.shard},{offset},{h},{w},{c},{img.dtype.str}\n')
+        self.unique_ids.add(unique_id)
+
+    def _sync_shard(self):
+        self.shard_file.flush()
+        os.fsync(self.shard_file.fileno())
+
+    def flush(self):
+        '''The index rows are kept in memory until the pixels of their cells are on disk : after a crash
+        (even a hard kill), every row of index.csv points to complete pixels'''
+        self._sync_shard()
+        self.index_file.write(''.join(self.pending))
+        self.index_file.flush()
+        os.fsync(self.index_file.fileno())
+        self.pending = []
+
+    def close(self, metadata=None):
+        '''Close the store, and save the metadata (DataFrame) of its cells if given'''
+        self.flush()
+        self.shard_file.close()
+        self.index_file.close()
+        if metadata is not None:
+            metadata.to_csv(os.path.join(self.folder, METADATA_FILE), index=False)
+
+
+###############################
+#### Reader ###################
+###############################
+
+class Packed_Dataset(Dataset):
+    '''
+    Dataset of a packed store, interchangeable with the DatasetFolder of a tiff dataset : classes,
+    class_to_idx and targets are the same, and samples are H x W x C float64 0-1 ndarray, before
+    transform. The shards are memory mapped when first read (in each DataLoader worker).
+
+    Params :
+        folder (string) : folder of the packed store
+        transform (callable) : applied to each sample, as in a DatasetFolder
+        keep_id (bool) : If True, samples are (image, Unique_ID), as with keep_Metadata_from_path
+    '''
+    def __init__(self, folder, transform=None, keep_id=False):
+        self.folder = folder
+        self.transform = transform
+        self.keep_id = keep_id
+        self.index = read_index(folder)
+        self.classes = sorted(self.index['class'].unique())
+        self.class_to_idx = {name: i for i, name in enumerate(self.classes)}
+        self.targets = [self.class_to_idx[name] for name in self.index['class']]
+        self.unique_ids = self.index['Unique_ID'].tolist()
+        self._columns = self.index[['shard','offset','height','width','channels','dtype']].to_numpy()
+        self._shards = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def _shard(self, shard):
+        if shard not in self._shards:
+            self._shards[shard] = np.memmap(shard_path(self.folder, shard), dtype=np.uint8, mode='r')
+        return self._shards[shard]
+
+    def __getstate__(self):
+        #Memory maps are not sent to the DataLoader workers, each one opens its own
+        state = self.__dict__.copy()
+        state['_shards'] = {}
+        return state
+
+    def read(self, i):
+        '''Cell i as stored (native size and dtype)'''
+        shard, offset, h, w, c, dtype = self._columns[i]
+        dtype = np.dtype(dtype)
+        nbytes = int(h) * int(w) * int(c) * dtype.itemsize
+        buffer = self._shard(int(shard))[int(offset):int(offset)+nbytes]
+        return np.array(buffer).view(dtype).reshape(int(h), int(w), int(c))
+
+    def __getitem__(self, i):
+        sample = img_as_float(self.read(i)) # float64 0 - 1.0
+        if self.keep_id:
+            sample = (sample, self.unique_ids[i])
+        if self.transform is not None:
+            sample = self.transform(sample)
+        return sample, self.targets[i]
+
+    def metadata(self):
+        '''Metadata of the cells (DataFrame), if saved by the builder'''
+        return pd.read_csv(os.path.join(self.folder, METADATA_FILE))
@@ -0,0 +1,148 @@
+# @Author: Sacha Haidinger <sachahai>
+# @Date:   2026-10-18T10:00:00+10:00
+# @Email:  sacha.haidinger@epfl.ch
+# @Project: Learning methods for Cell Profiling
+# @Last modified by:   sachahai
+# @Last modified time: 2026-10-18T10:00:00+10:00
+
+'''
+Thumbnails of all the single cells of a dataset, packed in a few sprite sheets (atlases).
+
+build_sprite_sheets() iterates the dataset once with get_inference_dataset (decoding and zero padding /
+rescaling in the DataLoader workers), downscales each batch to thumb_size x thumb_size with one
+anti-aliased interpolation, and writes the RGB thumbnails in a grid of sheet_size x sheet_size pixels :
+    - sheet_XXXX.png : the sprite sheets
+    - sprites.csv : Unique_ID, label, sheet, position (x, y in pixels) and size of each thumbnail
+
+Sprite_Atlas reads it back : the thumbnail of any cell, or a mosaic of cells, without reading the dataset
+(hover previews of Latent_viewer.py, inspection of the cells of a latent region in the human guidance workflow).
+
+    build_sprite_sheets('DataSets/Peter_Horvath_Subsample/', 'DataSets/Horvath_sprites/', input_size=64)
+    atlas = Sprite_Atlas('DataSets/Horvath_sprites/')
+    plt.imshow(atlas.mosaic(metadata_csv['Unique_ID'][:64]))
+'''
+
+import os
+from timeit import default_timer as timer
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+from util.data_processing import get_inference_dataset
+
+SPRITES_FILE = 'sprites.csv'
+
+
+def sheet_path(folder, sheet):
+    return os.path.join(folder, f'sheet_{sheet:04d}.png')
+
+
+def to_rgb_thumbnails(batch, thumb_size):
+    '''B x C x H x W float tensor (0-1) -> B x thumb_size x thumb_size x 3 uint8 ndarray.
+    First 3 channels, gray if only one, missing channels are black'''
+    if batch.shape[-1] != thumb_size or batch.shape[-2] != thumb_size:
+        batch = F.interpolate(batch, size=(thumb_size,thumb_size), mode='bilinear', align_corners=False, antialias=True)
+    if batch.shape[1] == 1:
+        batch = batch.expand(-1,3,-1,-1)
+    elif batch.shape[1] == 2:
+        batch = torch.cat([batch, torch.zeros_like(batch[:,:1])], dim=1)
+    batch = batch[:,:3]
+    return (batch.clamp(0,1) * 255 + 0.5).to(torch.uint8).permute(0,2,3,1).numpy()
+
+
+def build_sprite_sheets(dataset_dir, save_folder, input_size=64, thumb_size=48, sheet_size=2048, batchsize=256, num_workers=4):
+    '''
+    Render the thumbnails of all the cells of a dataset in sprite sheets
+
+    Params :
+        dataset_dir (string) : dataset (one subfolder per class, or packed store)
+        save_folder (string) : where to save the sprite sheets and their index
+        input_size (int) : size of the zero padded / rescaled images (as given to the VAE), before downscaling
+        thumb_size (int) : size of the thumbnails (pixels)
+        sheet_size (int) : size of the sprite sheets (pixels), (sheet_size // thumb_size)^2 thumbnails per sheet
+        batchsize (int) : number of cells rendered at once
+        num_workers (int) : DataLoader processes decoding the images
+
+    Return the index (DataFrame, one row per cell)
+    '''
+    start = timer()
+    os.makedirs(save_folder, exist_ok=True)
+    data, loader = get_inference_dataset(dataset_dir, batchsize, input_size, num_workers=num_workers)
+    per_row = sheet_size // thumb_size
+    per_sheet = per_row**2
+    sheet = np.zeros((per_row*thumb_size, per_row*thumb_size, 3), dtype=np.uint8)
+    index = {'Unique_ID':[], 'label':[], 'sheet':[], 'x':[], 'y':[]}
+    n = 0
+
+    for images, labels, file_names in loader:
+        thumbnails = to_rgb_thumbnails(images, thumb_size)
+        for thumbnail, label, unique_id in zip(thumbnails, labels.tolist(), file_names):
+            slot = n % per_sheet
+            y, x = (slot // per_row) * thumb_size, (slot % per_row) * thumb_size
+            sheet[y:y+thumb_size, x:x+thumb_size] = thumbnail
+            index['Unique_ID'].append(unique_id)
+            index['label'].append(data.classes[label])
+            index['sheet'].append(n // per_sheet)
+            index['x'].append(x)
+            index['y'].append(y)
+            n += 1
+            if n % per_sheet == 0: #Sheet full
+                Image.fromarray(sheet).save(sheet_path(save_folder, n // per_sheet - 1))
+                sheet[:] = 0
+    if n % per_sheet:
+        #Last sheet cropped to its used rows
+        rows = (n % per_sheet + per_row - 1) // per_row
+        Image.fromarray(sheet[:rows*thumb_size]).save(sheet_path(save_folder, n // per_sheet))
+
+    index = pd.DataFrame(index)
+    index['size'] = thumb_size
+    index.to_csv(os.path.join(save_folder, SPRITES_FILE), index=False)
+    seconds = timer() - start
+    print(f'{n} thumbnails in {(n + per_sheet - 1) // per_sheet} sprite sheets, in {seconds:.1f} seconds ({n / max(seconds,1e-9):.0f} cells/s)')
+    return index
+
+
+class Sprite_Atlas(object):
+    '''
+    Thumbnails of the cells from the sprite sheets of build_sprite_sheets(). The sheets are loaded
+    in memory the first time one of their thumbnails is asked
+
+    Params :
+        folder (string) : folder of the sprite sheets
+    '''
+    def __init__(self, folder):
+        self.folder = folder
+        self.index = pd.read_csv(os.path.join(folder, SPRITES_FILE), dtype={'Unique_ID':str, 'label':str})
+        self.positions = {uid: (s, x, y) for uid, s, x, y in zip(self.index['Unique_ID'], self.index['sheet'], self.index['x'], self.index['y'])}
+        self.thumb_size = int(self.index['size'].iloc[0]) if len(self.index) else 0
+        self.sheets = {}
+
+    def __contains__(self, unique_id):
+        return unique_id in self.positions
+
+    def __len__(self):
+        return len(self.index)
+
+    def _sheet(self, sheet):
+        return np.asarray(Image.open(sheet_path(self.folder, sheet)).convert('RGB'))
+
+    def get(self, unique_id):
+        '''thumb_size x thumb_size x 3 uint8 thumbnail of a cell'''
+        sheet, x, y = self.positions[unique_id]
+        if sheet not in self.sheets:
+            self.sheets[sheet] = self._sheet(sheet)
+        return self.sheets[sheet][y:y+self.thumb_size, x:x+self.thumb_size]
+
+    def mosaic(self, unique_ids, ncols=8, padding=2):
+        '''Grid of the thumbnails of several cells (ndarray, white background), e.g for plt.imshow'''
+        unique_ids = list(unique_ids)
+        nrows = max(1, (len(unique_ids) + ncols - 1) // ncols)
+        step = self.thumb_size + padding
+        grid = np.full((nrows*step + padding, ncols*step + padding, 3), 255, dtype=np.uint8)
+        for i, unique_id in enumerate(unique_ids):
+            y, x = (i // ncols) * step + padding, (i % ncols) * step + padding
+            grid[y:y+self.thumb_size, x:x+self.thumb_size] = self.get(unique_id)
+        return grid